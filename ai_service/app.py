@@ -1,28 +1,49 @@
+import time
+_T0 = time.perf_counter()  # début du chronométrage de démarrage (avant les imports)
+
 import os, hmac, csv
-import json
 import random
+import threading
 import datetime as dt
 from flask import Flask, request, jsonify, render_template
+from bson import ObjectId
 from dotenv import load_dotenv
 
+# torch / train_dkt / metrics ne sont importés qu'au premier usage (endpoints DKT, warm-up)
 from recommender import Recommender
-from train_dkt import train as train_dkt
-from metrics import dkt_holdout_metrics
+from model_registry import get_registry
+from startup import StartupReport
+from train_jobs import TrainJobManager, JobAlreadyRunning
+from response_writer import parse_response
+from bulk_ingest import iter_ndjson_lines, ingest_ndjson
 from collections import defaultdict
 
 # ---- charge les variables d'env avant de les lire ----
 load_dotenv()
 
 app = Flask(__name__)
+STARTUP = StartupReport(t0=_T0)
+STARTUP.record("imports", (time.perf_counter() - _T0) * 1000.0)
 
 # ---- sécurité légère (token partagé, optionnel) ----
 AI_SHARED_SECRET = os.getenv("AI_SHARED_SECRET", "")
-# routes autorisées sans token (santé + infos modèle)
-WHITELIST_PATHS = {"/health", "/model/info"}
+# routes autorisées sans token (santé, readiness + infos modèle)
+WHITELIST_PATHS = {"/health", "/ready", "/model/info"}
 WORDCOUNTS_PATH = os.getenv("WORDCOUNTS_PATH", "/data/word_counts.tsv")
+# phases préchargées au démarrage (vide = tout à la demande)
+AI_WARMUP = [p.strip() for p in os.getenv("AI_WARMUP", "catalog,model,words").split(",") if p.strip()]
+
+# ---- instance unique du moteur IA (créée au premier usage ou au warm-up) ----
+_rec = None
+_rec_lock = threading.Lock()
 
-# ---- instance unique du moteur IA ----
-rec = Recommender()
+def get_rec() -> Recommender:
+    global _rec
+    if _rec is None:
+        with _rec_lock:
+            if _rec is None:
+                _rec = Recommender()
+    return _rec
 
 @app.before_request
 def _auth_shared_token():
@@ -46,37 +67,78 @@ def _auth_shared_token():
 def health():
     return {"status": "ok"}, 200
 
-# ----------------- MODEL INFO (utile démo) -----------------
-@app.get("/model/info")
-def model_info():
-    meta_path = os.path.join("model", "dkt_meta.json")
-    pt_path = os.path.join("model", "dkt.pt")
-
-    def _mtime(p):
-        try:
-            return int(os.path.getmtime(p))
-        except Exception:
-            return 0
-
-    info = {
-        "model_file": pt_path,
-        "meta_file": meta_path,
-        "exists": os.path.exists(pt_path) and os.path.exists(meta_path),
-        "updated_at_epoch": max(_mtime(pt_path), _mtime(meta_path)),
-        "num_skills": None,
-    }
+# ----------------- WARM-UP / READINESS -----------------
+def warmup():
+    """Précharge catalogue, modèle DKT et stats de mots ; chaque phase est chronométrée."""
     try:
-        if os.path.exists(meta_path):
-            with open(meta_path, "r", encoding="utf-8") as f:
-                meta = json.load(f)
-                info["num_skills"] = meta.get("num_skills")
+        with STARTUP.phase("recommender"):
+            rec = get_rec()
+        if "catalog" in AI_WARMUP:
+            try:
+                with STARTUP.phase("catalog"):
+                    rec.catalog.refresh()
+            except Exception:
+                pass
+        if "model" in AI_WARMUP:
+            # pas bloquant : aucun modèle tant que le DKT n'a pas été entraîné
+            try:
+                with STARTUP.phase("model", required=False):
+                    dkt = rec._load_dkt()
+                    rec.dkt_batcher.predict(dkt.model, [(0, 1)])  # 1re passe : noyaux + thread du batcher
+            except Exception:
+                pass
+        if "words" in AI_WARMUP:
+            try:
+                with STARTUP.phase("words", required=False):
+                    _word_counts()
+            except Exception:
+                pass
     except Exception:
         pass
-    return {"success": True, "model": info}, 200
+    finally:
+        if not STARTUP.failed_required():
+            STARTUP.mark_ready()
+        STARTUP.warming = False
+        app.logger.info("[startup] %s", STARTUP.report())
+
+def start_warmup():
+    """Lance le warm-up en arrière-plan (une seule exécution à la fois)."""
+    with _rec_lock:
+        if STARTUP.warming or STARTUP.ready:
+            return
+        STARTUP.warming = True
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+@app.get("/ready")
+def ready():
+    # 1er appel sans __main__ (serveur WSGI) ou nouvel essai après un échec (Mongo indisponible...)
+    if not STARTUP.ready:
+        start_warmup()
+    return {"ready": STARTUP.ready, "startup": STARTUP.report()}, (200 if STARTUP.ready else 503)
+
+# ----------------- MODEL INFO (utile démo) -----------------
+@app.get("/model/info")
+def model_info():
+    # sonde publique : lecture du registre seul (ni Recommender, ni chargement du modèle)
+    return {"success": True, "model": get_registry().info()}, 200
+
+# ----------------- CACHE HISTORIQUE (dimensionnement) -----------------
+@app.get("/metrics/cache")
+def metrics_cache():
+    rec = get_rec()
+    return {
+        "success": True,
+        "history_cache": rec.histories.stats(),
+        "catalog": rec.catalog.stats(),
+        "dkt_states": rec.dkt_states.stats(),
+        "dkt_batcher": rec.dkt_batcher.stats(),
+        "response_writer": rec.response_writer.stats(),
+    }, 200
 
 # ----------------- ANALYSE -----------------
 @app.get("/analysis/user/<user_id>")
 def analysis_user(user_id):
+    rec = get_rec()
     try:
         data = rec.user_theme_stats(user_id)
         return jsonify({"success": True, "user_id": user_id, "themes": data})
@@ -84,18 +146,57 @@ def analysis_user(user_id):
         return jsonify({"success": False, "error": str(e)}), 500
 
 # ----------------- ENTRAÎNEMENT DKT -----------------
+# jobs dans un process séparé : le thread Flask rend la main immédiatement
+_train_jobs = None
+
+def get_train_jobs() -> TrainJobManager:
+    global _train_jobs
+    if _train_jobs is None:
+        with _rec_lock:
+            if _train_jobs is None:
+                # le registre recharge le nouveau modèle dès la fin du job
+                _train_jobs = TrainJobManager(on_success=lambda: get_rec().models.reload())
+    return _train_jobs
+
 @app.post("/train/dkt")
 def train_dkt_endpoint():
+    """
+    Body JSON: { "epochs": 8, "incremental": false, "world_size": 1 } → 202 + job_id (409 si
+    un entraînement est déjà en cours). incremental : reprise du modèle publié, sur les
+    nouvelles réponses ; world_size : nb de process d'entraînement data-parallel (défaut DKT_WORLD_SIZE).
+    """
     try:
-        epochs = int(request.json.get("epochs", 8)) if request.is_json else 8
-        train_dkt(epochs=epochs)
-        return {"success": True, "message": f"DKT trained for {epochs} epochs"}, 200
+        body = request.get_json(silent=True) or {}
+        params = {"epochs": int(body.get("epochs", 8)), "incremental": bool(body.get("incremental", False))}
+        if params["epochs"] < 1:
+            return {"success": False, "error": "epochs doit être >= 1"}, 400
+        if body.get("world_size") is not None:
+            params["world_size"] = max(1, int(body["world_size"]))
+        job = get_train_jobs().submit(**params)
+        return {"success": True, "job_id": job["job_id"], "job": job}, 202
+    except JobAlreadyRunning as e:
+        return {"success": False, "error": "job_running", "job_id": e.job_id}, 409
     except Exception as e:
         return {"success": False, "error": str(e)}, 500
 
+@app.get("/train/jobs/<job_id>")
+def train_job_status(job_id):
+    job = get_train_jobs().get(job_id)
+    if job is None:
+        return {"success": False, "error": "job introuvable"}, 404
+    return {"success": True, "job": job}, 200
+
+@app.post("/train/jobs/<job_id>/cancel")
+def train_job_cancel(job_id):
+    job = get_train_jobs().cancel(job_id)
+    if job is None:
+        return {"success": False, "error": "job introuvable"}, 404
+    return {"success": True, "job": job}, 200
+
 # ----------------- RECOMMANDATIONS -----------------
 @app.get("/recommendations")
 def recommendations():
+    rec = get_rec()
     try:
         user_id = request.args.get("user_id")
         if not user_id:
@@ -119,13 +220,15 @@ def recommendations():
         fallback_used = None
 
         recos = []
+        # snapshot d'historique unique, réutilisé en cas de fallback
+        hist = rec.user_history(user_id)
 
         def _heuristic():
-            return rec.recommended_questions(user_id, limit=limit, mix_ratio=mix_ratio)
+            return rec.recommended_questions(user_id, limit=limit, mix_ratio=mix_ratio, history=hist)
 
         try:
             if policy == "dkt":
-                recos = rec.recommended_questions_dkt(user_id, limit=limit, mix_ratio=mix_ratio)
+                recos = rec.recommended_questions_dkt(user_id, limit=limit, mix_ratio=mix_ratio, history=hist)
             elif policy == "bandit":
                 try:
                     recos = rec.recommended_questions_bandit(user_id, limit=limit, mix_ratio=mix_ratio)
@@ -183,11 +286,27 @@ def recommendations():
 # ----------------- METRIQUES DKT -----------------
 @app.get("/metrics/dkt")
 def metrics_dkt():
+    rec = get_rec()
     try:
         user_id = request.args.get("user_id")
         if not user_id:
             return {"success": False, "error": "user_id requis"}, 400
-        m = dkt_holdout_metrics(user_id)
+        from metrics import dkt_holdout_metrics
+        m = dkt_holdout_metrics(user_id, rec=rec)
+        return {"success": True, "metrics": m}, 200
+    except Exception as e:
+        return {"success": False, "error": str(e)}, 500
+
+@app.get("/metrics/dkt/global")
+def metrics_dkt_global():
+    """Évaluation walk-forward du DKT sur toute la population (global + par skill)."""
+    rec = get_rec()
+    try:
+        batch_size = int(request.args.get("batch_size", "64"))
+        limit_users = request.args.get("limit_users")
+        from metrics import dkt_global_metrics
+        m = dkt_global_metrics(rec=rec, batch_size=batch_size,
+                               max_users=int(limit_users) if limit_users else None)
         return {"success": True, "metrics": m}, 200
     except Exception as e:
         return {"success": False, "error": str(e)}, 500
@@ -195,26 +314,30 @@ def metrics_dkt():
 # ----------------- COMPARAISON POLICIES -----------------
 @app.get("/compare_policies")
 def compare_policies():
+    rec = get_rec()
     try:
         user_id = request.args.get("user_id")
         limit = int(request.args.get("limit", "10"))
         if not user_id:
             return {"success": False, "error": "user_id requis"}, 400
 
-        items_h = rec.recommended_questions(user_id, limit=limit, mix_ratio=0.5)
+        # un seul snapshot d'historique partagé par les 3 policies + résumés
+        hist = rec.user_history(user_id)
+
+        items_h = rec.recommended_questions(user_id, limit=limit, mix_ratio=0.5, history=hist)
         try:
             items_b = rec.recommended_questions_bandit(user_id, limit=limit, mix_ratio=0.5)
         except Exception:
             items_b = []
         try:
-            items_d = rec.recommended_questions_dkt(user_id, limit=limit, mix_ratio=0.5)
+            items_d = rec.recommended_questions_dkt(user_id, limit=limit, mix_ratio=0.5, history=hist)
         except Exception:
             items_d = []
 
         from metrics import summarize_with_dkt_p
-        sum_h = summarize_with_dkt_p(rec, user_id, items_h)
-        sum_b = summarize_with_dkt_p(rec, user_id, items_b)
-        sum_d = summarize_with_dkt_p(rec, user_id, items_d)
+        sum_h = summarize_with_dkt_p(rec, user_id, items_h, history=hist)
+        sum_b = summarize_with_dkt_p(rec, user_id, items_b, history=hist)
+        sum_d = summarize_with_dkt_p(rec, user_id, items_d, history=hist)
 
         return {
             "success": True,
@@ -237,6 +360,7 @@ def simulate_session():
     - Écrit une nouvelle session + responses dans Mongo
     - Retourne analyse avant/après + résumé
     """
+    rec = get_rec()
     try:
         data = request.get_json(force=True) or {}
         user_id = data.get("user_id")
@@ -245,47 +369,47 @@ def simulate_session():
         if not user_id:
             return {"success": False, "error": "user_id requis"}, 400
 
-        # analyse avant
-        before = rec.user_theme_stats(user_id)
+        # analyse avant (snapshot partagé par analyse, recos et DKT)
+        hist = rec.user_history(user_id)
+        before = rec.user_theme_stats(user_id, history=hist)
 
         # recos
         if policy == "dkt":
-            items = rec.recommended_questions_dkt(user_id, limit=limit, mix_ratio=0.5)
+            items = rec.recommended_questions_dkt(user_id, limit=limit, mix_ratio=0.5, history=hist)
         elif policy == "bandit":
             try:
                 items = rec.recommended_questions_bandit(user_id, limit=limit, mix_ratio=0.5)
             except Exception:
-                items = rec.recommended_questions(user_id, limit=limit, mix_ratio=0.5)
+                items = rec.recommended_questions(user_id, limit=limit, mix_ratio=0.5, history=hist)
         else:
-            items = rec.recommended_questions(user_id, limit=limit, mix_ratio=0.5)
+            items = rec.recommended_questions(user_id, limit=limit, mix_ratio=0.5, history=hist)
 
         # proba via DKT
-        rec._load_dkt()
-        seq = rec._user_sequence_for_dkt(user_id)
-        p_vec = rec._dkt_predict_vector(seq)
-        idx_of = rec._dkt_meta["skill2idx"]
+        dkt = rec._load_dkt()
+        p_vec = rec._dkt_user_vector(user_id, history=hist, dkt=dkt)
+        idx_of = dkt.skill2idx
 
         # créer une session
         now = dt.datetime.utcnow()
         sid = f"US_SIM_{user_id}_{int(now.timestamp())}"
-        rec.db.usersessions.insert_one({
-            "user_session_id": sid,
-            "user_id": user_id,
-            "started_at": now
-        })
+        rec.response_writer.ensure_session(sid, user_id, policy, started_at=now)
+        rec.note_session(user_id, sid)
 
         results = []
         for i, q in enumerate(items):
             key = f"{q['theme']}|||{q['difficulty']}"
             p = float(p_vec[idx_of.get(key, 0)]) if key in idx_of else 0.6
             correct = random.random() < p
-            rec.db.responses.insert_one({
+            resp = {
                 "session_id": sid,
                 "question_id": q["question_id"],
                 "is_correct": bool(correct),
                 "response_time": random.randint(1500, 12000),
-                "answered_at": now + dt.timedelta(seconds=30 * (i + 1))
-            })
+                "answered_at": now + dt.timedelta(seconds=30 * (i + 1)),
+                "_id": ObjectId(),
+            }
+            rec.response_writer.write_many([(user_id, resp, policy)])
+            rec.note_response(user_id, resp, question=q)
             results.append({
                 "question_id": q["question_id"],
                 "theme": q["theme"],
@@ -316,6 +440,7 @@ def session_start():
     Body JSON: { "user_id": "...", "policy": "dkt|heuristic|bandit", "session_id"?: "..." }
     Crée (idempotent) la session utilisateur dans usersessions.
     """
+    rec = get_rec()
     try:
         data = request.get_json(force=True) or {}
         user_id = data.get("user_id")
@@ -326,13 +451,9 @@ def session_start():
         now = dt.datetime.utcnow()
         session_id = data.get("session_id") or f"US_{user_id}_{int(now.timestamp())}"
 
-        if not rec.db.usersessions.find_one({"user_session_id": session_id}):
-            rec.db.usersessions.insert_one({
-                "user_session_id": session_id,
-                "user_id": user_id,
-                "started_at": now,
-                "policy": policy
-            })
+        if not rec.session_known(user_id, session_id):
+            rec.response_writer.ensure_session(session_id, user_id, policy, started_at=now)
+        rec.note_session(user_id, session_id)
 
         return {"success": True, "session_id": session_id, "policy": policy}, 200
     except Exception as e:
@@ -345,46 +466,64 @@ def record_response():
       "user_id": "...", "session_id": "...", "question_id": "...",
       "is_correct": true/false, "response_time_ms": 5200, "answered_at": ISO8601
     }
-    Enregistre une réponse dans responses (et crée la session si absente).
+    Enregistre une réponse dans responses (et crée la session si absente) via
+    l'écriture différée (response_writer.py : RESPONSE_ACK, RESPONSE_FLUSH_*).
     """
+    rec = get_rec()
     try:
         data = request.get_json(force=True) or {}
-        user_id = data.get("user_id")
-        session_id = data.get("session_id")
-        question_id = data.get("question_id")
-        is_correct = bool(data.get("is_correct"))
-        resp_ms = int(data.get("response_time_ms") or data.get("response_time") or 0)
-        answered_at = data.get("answered_at")
-
-        if not (user_id and session_id and question_id):
-            return {"success": False, "error": "user_id, session_id, question_id requis"}, 400
-
-        # assure l'existence de la session (souple)
-        if not rec.db.usersessions.find_one({"user_session_id": session_id}):
-            rec.db.usersessions.insert_one({
-                "user_session_id": session_id,
-                "user_id": user_id,
-                "started_at": dt.datetime.utcnow(),
-                "policy": data.get("policy") or "dkt"
-            })
+        try:
+            user_id, doc, policy = parse_response(data)
+        except ValueError as e:
+            return {"success": False, "error": str(e)}, 400
+        session_id = doc["session_id"]
+        # _id fixé ici : le même document part en écriture et dans l'historique en cache
+        doc["_id"] = ObjectId()
+
+        # session upsertée avec la réponse (souple) — sauf si déjà connue du cache
+        rec.response_writer.submit(doc, user_id, policy=policy,
+                                   session_known=rec.session_known(user_id, session_id))
+        rec.note_session(user_id, session_id)
+        # write-through : complète l'historique en cache au lieu de le purger
+        rec.note_response(user_id, doc)
+        return {"success": True, "saved": {k: v for k, v in doc.items() if k != "_id"}}, 200
+    except Exception as e:
+        return {"success": False, "error": str(e)}, 500
 
-        doc = {
-            "session_id": session_id,
-            "question_id": question_id,
-            "is_correct": is_correct,
-            "response_time": resp_ms,
-            "answered_at": dt.datetime.fromisoformat(answered_at) if answered_at else dt.datetime.utcnow()
-        }
-        rec.db.responses.insert_one(doc)
-        return {"success": True, "saved": doc}, 200
+@app.post("/responses/bulk")
+def record_responses_bulk():
+    """
+    Corps NDJSON (Content-Type: application/x-ndjson, Content-Encoding: gzip optionnel) :
+    une réponse par ligne, au format de /response. Lu et validé au fil de l'eau, écrit
+    par lots (bulk_ingest.py : RESPONSES_BULK_CHUNK) ; chaque session n'est upsertée
+    qu'une fois. Renvoie les compteurs et les erreurs par ligne.
+    """
+    rec = get_rec()
+    try:
+        encoding = (request.headers.get("Content-Encoding") or "").strip().lower()
+        if encoding not in ("", "identity", "gzip"):
+            return {"success": False, "error": f"Content-Encoding non supporté : {encoding}"}, 415
+        lines = iter_ndjson_lines(request.stream, gzipped=encoding == "gzip")
+        report = ingest_ndjson(rec.response_writer, lines)
+        # réponses possiblement antérieures à l'historique en cache : rechargé au prochain accès
+        for user_id in report.pop("users"):
+            rec.histories.invalidate(user_id)
+        report["success"] = "stream_error" not in report  # erreurs par ligne : dans le rapport
+        return report, 200 if report["success"] else 400
     except Exception as e:
         return {"success": False, "error": str(e)}, 500
 
-def _load_word_stats(theme: str):
-    stats = defaultdict(lambda: {"1": 0, "0": 0})
+_word_cache = {"mtime": None, "rows": None}
+
+def _word_counts():
+    """Lignes (word, outcome, theme, count) du TSV, parsées une fois et relues si le fichier change."""
     if not os.path.exists(WORDCOUNTS_PATH):
         return None
+    mtime = os.path.getmtime(WORDCOUNTS_PATH)
+    if _word_cache["rows"] is not None and _word_cache["mtime"] == mtime:
+        return _word_cache["rows"]
 
+    rows = []
     with open(WORDCOUNTS_PATH, "r", encoding="utf-8") as f:
         for line in f:
             parts = line.rstrip("\n").split("\t")
@@ -395,11 +534,23 @@ def _load_word_stats(theme: str):
                 count = int(count)
             except ValueError:
                 continue
-            if theme.lower() != "all" and th.lower() != theme.lower():
-                continue
             if outcome not in ("0", "1"):
                 continue
-            stats[word][outcome] += count
+            rows.append((word, outcome, th.lower(), count))
+    _word_cache.update(mtime=mtime, rows=rows)
+    return rows
+
+def _load_word_stats(theme: str):
+    stats = defaultdict(lambda: {"1": 0, "0": 0})
+    counts = _word_counts()
+    if counts is None:
+        return None
+
+    theme_l = theme.lower()
+    for word, outcome, th, count in counts:
+        if theme_l != "all" and th != theme_l:
+            continue
+        stats[word][outcome] += count
 
     rows = []
     for w, c in stats.items():
@@ -434,4 +585,8 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "5001"))
     debug = os.getenv("FLASK_DEBUG", "0") == "1"
+    if AI_WARMUP:
+        start_warmup()
+    else:
+        STARTUP.mark_ready()
     app.run(host=host, port=port, debug=debug)
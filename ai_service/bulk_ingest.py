@@ -0,0 +1,127 @@
+import os
+import json
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from response_writer import ResponseWriter, parse_response
+
+# ----------------------- Config -----------------------
+RESPONSES_BULK_CHUNK = int(os.getenv("RESPONSES_BULK_CHUNK", "1000"))            # réponses par insert_many
+RESPONSES_BULK_MAX_ERRORS = int(os.getenv("RESPONSES_BULK_MAX_ERRORS", "1000"))  # erreurs détaillées renvoyées
+RESPONSES_BULK_MAX_LINE = int(os.getenv("RESPONSES_BULK_MAX_LINE", str(64 * 1024)))  # octets max par ligne
+
+READ_SIZE = 64 * 1024
+
+def _inflated_blocks(stream) -> Iterator[bytes]:
+    """
+    Corps gzip décompressé par blocs d'au plus READ_SIZE octets (max_length +
+    unconsumed_tail : un petit corps très compressible ne gonfle pas en mémoire).
+    Gère les gzip multi-membres (concaténation de fichiers .gz, cf. RFC 1952).
+    """
+    inflate, in_member = zlib.decompressobj(16 + zlib.MAX_WBITS), False
+    while True:
+        data = stream.read(READ_SIZE)
+        if not data:
+            break
+        while True:
+            in_member = True
+            try:
+                out = inflate.decompress(data, READ_SIZE)
+            except zlib.error as e:
+                raise ValueError(f"flux gzip invalide : {e}")
+            if out:
+                yield out
+            if inflate.eof:
+                # membre terminé : la suite du bloc ouvre le membre suivant
+                data, in_member = inflate.unused_data, False
+                inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                if not data:
+                    break
+            elif inflate.unconsumed_tail or len(out) == READ_SIZE:
+                data = inflate.unconsumed_tail  # sortie plafonnée : reste à produire
+            else:
+                break
+    if in_member:
+        raise ValueError("flux gzip tronqué")
+
+
+def iter_ndjson_lines(stream, gzipped: bool = False, max_line: int = RESPONSES_BULK_MAX_LINE) -> Iterator[Optional[bytes]]:
+    """
+    Lignes (bytes, sans le \\n) d'un corps NDJSON lu par blocs, décompressé au fil de
+    l'eau si `gzipped` : le corps n'est jamais chargé en entier. Une ligne de plus de
+    `max_line` octets n'est pas gardée en mémoire : elle est renvoyée comme None.
+    """
+    blocks = _inflated_blocks(stream) if gzipped else iter(lambda: stream.read(READ_SIZE), b"")
+    buf, too_long = b"", False
+    for block in blocks:
+        buf += block
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            yield None if too_long or len(line) > max_line else line
+            too_long = False
+        if len(buf) > max_line:
+            too_long, buf = True, b""
+    if too_long or len(buf) > max_line:
+        yield None
+    elif buf:
+        yield buf
+
+def ingest_ndjson(writer: ResponseWriter, lines: Iterable[Optional[bytes]], chunk: int = RESPONSES_BULK_CHUNK,
+                  max_errors: int = RESPONSES_BULK_MAX_ERRORS) -> Dict[str, Any]:
+    """
+    Ingestion en masse (/responses/bulk) : chaque ligne est un corps de /response.
+    Lignes validées une à une (parse_response) et écrites par lots de `chunk` via
+    writer.write_many (sessions upsertées une seule fois, insert_many(ordered=False)).
+    Lignes vides ignorées. Renvoie les compteurs, les utilisateurs touchés (set) et les
+    erreurs par ligne ({"line": n (1-based), "error": "..."}, limitées à max_errors).
+    """
+    report = {"lines": 0, "inserted": 0, "failed": 0, "errors": [], "errors_truncated": False}
+    users = set()
+    batch: List[Tuple[str, Dict[str, Any], str]] = []
+    batch_lines: List[int] = []
+
+    def _error(line_no: int, msg: str):
+        report["failed"] += 1
+        if len(report["errors"]) < max_errors:
+            report["errors"].append({"line": line_no, "error": msg})
+        else:
+            report["errors_truncated"] = True
+
+    def _write():
+        try:
+            errors = writer.write_many(batch)
+        except Exception as e:
+            errors = {i: str(e) for i in range(len(batch))}
+        for i, (user_id, _, _) in enumerate(batch):
+            if i in errors:
+                _error(batch_lines[i], errors[i])
+            else:
+                report["inserted"] += 1
+                users.add(user_id)
+        batch.clear()
+        batch_lines.clear()
+
+    try:
+        for n, raw in enumerate(lines, start=1):
+            report["lines"] = n
+            if raw is None:
+                _error(n, "ligne trop longue")
+                continue
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                batch.append(parse_response(json.loads(raw)))
+            except ValueError as e:  # JSON invalide (JSONDecodeError) ou champ manquant/invalide
+                _error(n, str(e))
+                continue
+            batch_lines.append(n)
+            if len(batch) >= chunk:
+                _write()
+    except ValueError as e:
+        # corps illisible (gzip invalide/tronqué) : les lignes lues avant restent écrites
+        report["stream_error"] = str(e)
+    if batch:
+        _write()
+    report["users"] = users
+    return report
@@ -0,0 +1,211 @@
+import os
+import time
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from pymongo import ReturnDocument, UpdateOne
+
+from seen import bloom_slots
+
+# ----------------------- Config -----------------------
+CATALOG_REFRESH_S = float(os.getenv("CATALOG_REFRESH_S", "30"))    # intervalle de vérification de version
+CATALOG_MAX_AGE_S = float(os.getenv("CATALOG_MAX_AGE_S", "3600"))  # rechargement forcé (éditions de questions)
+
+_PROJECTION = {"_id": 0}
+
+class CatalogSnapshot:
+    """
+    Vue figée (immuable) de la collection `questions`, en colonnes :
+      - question_id[i], theme[i] (code), difficulty[i] (code)
+      - groups[(theme, difficulty)] -> positions (np.int32)
+      - dense_id[i] : identifiant entier stable (collection question_index),
+        base des bitsets de questions vues
+    Les documents d'origine sont gardés pour matérialiser les seuls items retournés.
+    """
+
+    def __init__(self, docs: List[Dict[str, Any]], version=None, dense_ids: Dict[str, int] = None):
+        self.version = version
+        self.loaded_at = time.time()
+        self.docs = docs
+        n = len(docs)
+
+        self.question_id = np.empty(n, dtype=object)
+        self.themes: List[str] = []
+        self.difficulties: List[str] = []
+        theme_code, diff_code = {}, {}
+        self.theme = np.empty(n, dtype=np.int32)
+        self.difficulty = np.empty(n, dtype=np.int32)
+        self.pos_of: Dict[str, int] = {}
+        groups: Dict[tuple, List[int]] = {}
+
+        for i, q in enumerate(docs):
+            qid = q.get("question_id")
+            t, d = q.get("theme"), q.get("difficulty")
+            if t not in theme_code:
+                theme_code[t] = len(self.themes)
+                self.themes.append(t)
+            if d not in diff_code:
+                diff_code[d] = len(self.difficulties)
+                self.difficulties.append(d)
+            self.question_id[i] = qid
+            self.theme[i] = theme_code[t]
+            self.difficulty[i] = diff_code[d]
+            if qid is not None and qid not in self.pos_of:
+                self.pos_of[qid] = i
+            groups.setdefault((t, d), []).append(i)
+
+        self.groups = {k: np.asarray(v, dtype=np.int32) for k, v in groups.items()}
+        self._empty = np.empty(0, dtype=np.int32)
+        self._skill_cache = (None, None)  # (skill2idx, array)
+
+        dense_ids = dense_ids or {}
+        self.dense_id = np.asarray([dense_ids.get(q, -1) for q in self.question_id], dtype=np.int64)
+        self.n_dense = int(self.dense_id.max()) + 1 if n else 0
+        self._bloom_cache = {}  # (m, k) -> np.ndarray [N, k]
+
+    def __len__(self):
+        return len(self.docs)
+
+    def get(self, question_id: str) -> Optional[Dict[str, Any]]:
+        """Document question (non copié : lecture seule) ou None."""
+        i = self.pos_of.get(question_id)
+        return self.docs[i] if i is not None else None
+
+    def positions(self, theme: str = None, difficulty: str = None) -> np.ndarray:
+        """Positions du groupe (theme, difficulty) ; None = toutes les valeurs de l'axe."""
+        if theme is not None and difficulty is not None:
+            return self.groups.get((theme, difficulty), self._empty)
+        keys = [k for k in self.groups
+                if (theme is None or k[0] == theme) and (difficulty is None or k[1] == difficulty)]
+        if not keys:
+            return self._empty
+        return np.sort(np.concatenate([self.groups[k] for k in keys]))
+
+    def dense_of(self, question_id: str) -> Optional[int]:
+        i = self.pos_of.get(question_id)
+        if i is None or self.dense_id[i] < 0:
+            return None
+        return int(self.dense_id[i])
+
+    def bloom_slots(self, m: int, k: int) -> np.ndarray:
+        """Positions Bloom [N, k] de chaque question, calculées une fois par snapshot."""
+        arr = self._bloom_cache.get((m, k))
+        if arr is None:
+            arr = np.asarray([bloom_slots(q, m, k) for q in self.question_id], dtype=np.int64).reshape(-1, k)
+            self._bloom_cache[(m, k)] = arr
+        return arr
+
+    def materialize(self, pos: int) -> Dict[str, Any]:
+        """Copie du document à la position `pos` (à enrichir par l'appelant)."""
+        return dict(self.docs[int(pos)])
+
+    def skill_index(self, skill2idx: Dict[str, int]) -> np.ndarray:
+        """
+        question -> index de skill DKT (theme|||difficulty), -1 si inconnu.
+        Mis en cache pour le dernier mapping (il ne change qu'avec le modèle).
+        """
+        cached_map, arr = self._skill_cache
+        if cached_map is skill2idx and arr is not None:
+            return arr
+        by_group = np.full((len(self.themes), len(self.difficulties)), -1, dtype=np.int32)
+        for ti, t in enumerate(self.themes):
+            for di, d in enumerate(self.difficulties):
+                by_group[ti, di] = skill2idx.get(f"{t}|||{d}", -1)
+        arr = by_group[self.theme, self.difficulty] if len(self.docs) else np.empty(0, dtype=np.int32)
+        self._skill_cache = (skill2idx, arr)
+        return arr
+
+
+class QuestionCatalog:
+    """
+    Catalogue de questions en mémoire (par process), chargé une fois puis
+    rafraîchi quand la version change (vérifiée au plus tous les CATALOG_REFRESH_S)
+    ou à expiration (CATALOG_MAX_AGE_S). La vérification tourne en arrière-plan
+    (comme ModelRegistry) : aucune requête ne paie le rechargement, sauf le tout
+    premier. Le snapshot est remplacé atomiquement : un lecteur garde une vue
+    cohérente pendant toute sa requête.
+    """
+
+    def __init__(self, db, refresh_s: float = CATALOG_REFRESH_S, max_age_s: float = CATALOG_MAX_AGE_S):
+        self.db = db
+        self.refresh_s = float(refresh_s)
+        self.max_age_s = float(max_age_s)
+        self._snap: Optional[CatalogSnapshot] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self.reloads = 0
+
+    def _dense_ids(self, qids: List[str]) -> Dict[str, int]:
+        """
+        question_id -> entier dense STABLE (append-only), persisté dans `question_index`
+        pour que les bitsets de questions vues restent valides d'un rechargement à l'autre.
+        """
+        coll = self.db.question_index
+        known = {d["question_id"]: int(d["pos"])
+                 for d in coll.find({}, {"_id": 0, "question_id": 1, "pos": 1})}
+        missing = [q for q in dict.fromkeys(qids) if q is not None and q not in known]
+        if missing:
+            # réserve un bloc d'ids (atomique entre workers), puis upsert idempotent
+            ctr = self.db.counters.find_one_and_update(
+                {"_id": "question_index"}, {"$inc": {"next": len(missing)}},
+                upsert=True, return_document=ReturnDocument.AFTER,
+            )
+            start = int(ctr["next"]) - len(missing)
+            coll.bulk_write([
+                UpdateOne({"question_id": q}, {"$setOnInsert": {"pos": start + i}}, upsert=True)
+                for i, q in enumerate(missing)
+            ], ordered=False)
+            for d in coll.find({"question_id": {"$in": missing}}, {"_id": 0, "question_id": 1, "pos": 1}):
+                known[d["question_id"]] = int(d["pos"])
+        return known
+
+    def _version(self):
+        """Empreinte bon marché : nb de documents + dernier _id inséré."""
+        coll = self.db.questions
+        last = next(iter(coll.find({}, {"_id": 1}).sort("_id", -1).limit(1)), None)
+        return (coll.estimated_document_count(), str(last["_id"]) if last else None)
+
+    def refresh(self, force: bool = False) -> CatalogSnapshot:
+        with self._lock:
+            snap = self._snap
+            version = self._version()
+            self._checked_at = time.monotonic()
+            expired = snap is not None and (time.time() - snap.loaded_at) > self.max_age_s
+            if force or snap is None or expired or snap.version != version:
+                docs = list(self.db.questions.find({}, _PROJECTION))
+                dense = self._dense_ids([q.get("question_id") for q in docs])
+                snap = CatalogSnapshot(docs, version=version, dense_ids=dense)
+                self._snap = snap
+                self.reloads += 1
+            return snap
+
+    def snapshot(self) -> CatalogSnapshot:
+        """Vue courante ; déclenche une vérification en arrière-plan si l'intervalle est écoulé."""
+        snap = self._snap
+        if snap is None:
+            return self.refresh()
+        if time.monotonic() - self._checked_at > self.refresh_s and not self._refreshing:
+            self._checked_at = time.monotonic()
+            self._refreshing = True
+            threading.Thread(target=self._background_refresh, name="catalog-refresh", daemon=True).start()
+        return snap
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            pass  # Mongo indisponible : on sert la dernière vue connue
+        finally:
+            self._refreshing = False
+
+    def stats(self) -> Dict[str, Any]:
+        snap = self._snap
+        return {
+            "loaded": snap is not None,
+            "questions": len(snap) if snap else 0,
+            "groups": len(snap.groups) if snap else 0,
+            "version": list(snap.version) if snap and snap.version else None,
+            "reloads": self.reloads,
+        }
@@ -0,0 +1,159 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# ----------------------- Config -----------------------
+DKT_BATCH_MAX = int(os.getenv("DKT_BATCH_MAX", "32"))           # nb max de séquences par passe LSTM
+DKT_BATCH_WAIT_MS = float(os.getenv("DKT_BATCH_WAIT_MS", "2"))  # attente max pour compléter un lot
+
+class _Request:
+    __slots__ = ("model", "seq", "state", "future", "enqueued_at")
+
+    def __init__(self, model, seq, state):
+        self.model = model
+        self.seq = seq
+        self.state = state
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class DKTBatcher:
+    """
+    Micro-batching de l'inférence DKT entre requêtes concurrentes.
+
+    Chaque appel `predict(model, seq, state)` est mis en file ; un thread unique
+    regroupe les demandes arrivées pendant DKT_BATCH_WAIT_MS (ou jusqu'à
+    DKT_BATCH_MAX séquences), les padde en un seul lot [B, T] d'indices d'interaction et fait UNE
+    passe LSTM (DKT.forward_last). Chaque appelant récupère son propre vecteur
+    p(correct) et son état (h, c) — identiques à une passe individuelle.
+    DKT_BATCH_MAX <= 1 : exécution directe dans le thread appelant.
+    """
+
+    def __init__(self, max_batch: int = DKT_BATCH_MAX, max_wait_ms: float = DKT_BATCH_WAIT_MS):
+        self.max_batch = int(max_batch)
+        self.max_wait_s = max(0.0, float(max_wait_ms)) / 1000.0
+        self._q: "queue.Queue[_Request]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.max_batch_seen = 0
+        self.wait_ms_total = 0.0
+        self.forward_ms_total = 0.0
+
+    # ---------------- API ----------------
+    def predict(self, model, seq: Sequence[Tuple[int, int]], state=None):
+        """
+        Avance `model` sur `seq` = [(skill_idx, correct)] (non vide) en partant de
+        `state` ((h, c) [1, 1, H] ou None). Renvoie (p [K] numpy, (h, c)).
+        """
+        return self.submit(model, seq, state).result()
+
+    def submit(self, model, seq: Sequence[Tuple[int, int]], state=None) -> Future:
+        """Comme `predict`, sans attendre : un même appelant peut mettre plusieurs séquences dans un lot."""
+        req = _Request(model, seq, state)
+        if self.max_batch <= 1:
+            try:
+                req.future.set_result(self._run(model, [req])[0])
+            except Exception as e:
+                req.future.set_exception(e)
+            return req.future
+        self._ensure_worker()
+        self._q.put(req)
+        depth = self._q.qsize()
+        if depth > self.max_queue_depth:
+            with self._stats_lock:
+                self.max_queue_depth = max(self.max_queue_depth, depth)
+        return req.future
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait_s * 1000.0,
+                "queue_depth": self._q.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "requests": self.requests,
+                "batches": self.batches,
+                "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+                "max_batch_size": self.max_batch_seen,
+                "avg_queue_wait_ms": round(self.wait_ms_total / self.requests, 3) if self.requests else 0.0,
+                "avg_forward_ms": round(self.forward_ms_total / self.batches, 3) if self.batches else 0.0,
+            }
+
+    # ---------------- Worker ----------------
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._loop, name="dkt-batcher", daemon=True)
+                self._worker.start()
+
+    def _loop(self):
+        while True:
+            batch = [self._q.get()]
+            deadline = time.perf_counter() + self.max_wait_s
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    batch.append(self._q.get(timeout=timeout) if timeout > 0 else self._q.get_nowait())
+                except queue.Empty:
+                    break
+            # un lot = un modèle (un rechargement peut intervenir entre deux requêtes)
+            groups: Dict[int, List[_Request]] = {}
+            for r in batch:
+                groups.setdefault(id(r.model), []).append(r)
+            for reqs in groups.values():
+                try:
+                    results = self._run(reqs[0].model, reqs)
+                except Exception as e:
+                    for r in reqs:
+                        r.future.set_exception(e)
+                    continue
+                for r, res in zip(reqs, results):
+                    r.future.set_result(res)
+
+    def _run(self, model, reqs: List[_Request]):
+        """Une passe LSTM pour tout le lot (padding à droite + états initiaux empilés)."""
+        import torch  # différé : le service démarre sans torch tant que le DKT n'est pas utilisé
+        from models.dkt import model_input
+
+        t0 = time.perf_counter()
+        K = model.num_skills
+        B = len(reqs)
+        lengths = np.asarray([len(r.seq) for r in reqs], dtype=np.int64)
+        codes = np.zeros((B, int(lengths.max())), dtype=np.int64)  # indices d'interaction, padding 0
+        for b, r in enumerate(reqs):
+            a = np.asarray(r.seq, dtype=np.int64).reshape(-1, 2)
+            codes[b, :len(a)] = a[:, 0] + K * (1 - a[:, 1])
+        x = model_input(model, torch.from_numpy(codes))
+
+        state = None
+        if any(r.state is not None for r in reqs):
+            H = next(r.state[0] for r in reqs if r.state is not None).shape[-1]
+            zero = torch.zeros(1, 1, H)
+            h0 = torch.cat([r.state[0] if r.state is not None else zero for r in reqs], dim=1)
+            c0 = torch.cat([r.state[1] if r.state is not None else zero for r in reqs], dim=1)
+            state = (h0, c0)
+
+        with torch.no_grad():
+            p, (h, c) = model.forward_last(x, torch.from_numpy(lengths), state)
+        p = p.cpu().numpy()
+        out = [(p[b].copy(), (h[:, b:b + 1].clone(), c[:, b:b + 1].clone())) for b in range(B)]
+
+        t1 = time.perf_counter()
+        with self._stats_lock:
+            self.requests += B
+            self.batches += 1
+            self.max_batch_seen = max(self.max_batch_seen, B)
+            self.wait_ms_total += sum((t0 - r.enqueued_at) * 1000.0 for r in reqs)
+            self.forward_ms_total += (t1 - t0) * 1000.0
+        return out
@@ -0,0 +1,205 @@
+import os
+import time
+import datetime as dt
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from bson import ObjectId
+from pymongo import MongoClient
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+DKT_EXTRACT_WORKERS = int(os.getenv("DKT_EXTRACT_WORKERS", str(min(8, os.cpu_count() or 1))))
+DKT_EXTRACT_SHARDS = int(os.getenv("DKT_EXTRACT_SHARDS", "0"))  # 0 = 4 x workers (load balancing)
+DKT_EXTRACT_POOL = os.getenv("DKT_EXTRACT_POOL", "thread").strip().lower()  # "thread" | "process" (spawned)
+
+_NO_TS = np.iinfo(np.int64).min  # answered_at that is not a date: ordered by its BSON type rank only
+_EPOCH = dt.datetime(1970, 1, 1)
+
+def _bson_sort_key(v) -> Tuple[int, Any]:
+    """Python sort key following Mongo's order across types (null < numbers < strings < ObjectId < bool < date)."""
+    if v is None:
+        return (0, 0)
+    if isinstance(v, bool):
+        return (5, v)
+    if isinstance(v, (int, float)):
+        return (1, v)
+    if isinstance(v, str):
+        return (2, v)
+    if isinstance(v, ObjectId):
+        return (4, v.binary)
+    if isinstance(v, dt.datetime):
+        return (6, v.replace(tzinfo=None))
+    return (3, str(v))
+
+def _ts_key(v) -> Tuple[int, int]:
+    """
+    Sort key of an answered_at value as (BSON type rank, microseconds since epoch).
+    The type rank follows Mongo's cross-type order (missing/null, numbers and strings
+    sort before dates); values of the same non-date type all share _NO_TS, so among
+    them the order falls back to _id instead of comparing the values themselves.
+    """
+    if isinstance(v, dt.datetime):
+        if v.tzinfo is not None:
+            v = v.astimezone(dt.timezone.utc).replace(tzinfo=None)
+        return _bson_sort_key(v)[0], (v - _EPOCH) // dt.timedelta(microseconds=1)
+    return _bson_sort_key(v)[0], _NO_TS
+
+# ---------- Lookup maps (loaded once, in the parent) ----------
+def load_lookups(db, skill2idx: Dict[str, int]):
+    """
+    The two $lookup sides as dicts:
+      sessions:  user_session_id -> [user index]  (users: user ids, in first-seen order)
+      questions: question_id -> [skill index]     (skills unknown to skill2idx left out)
+    Lists keep the $lookup + $unwind semantics (one row per matching document).
+    Session documents without user_session_id (per-question events) never match a response.
+    """
+    users: List[Any] = []
+    user_of: Dict[Any, int] = {}
+    sessions: Dict[Any, List[int]] = {}
+    for d in db.usersessions.find({"user_session_id": {"$exists": True, "$ne": None}},
+                                  {"_id": 0, "user_session_id": 1, "user_id": 1}):
+        uid = d.get("user_id")
+        key = uid if not isinstance(uid, (dict, list)) else repr(uid)
+        u = user_of.get(key)
+        if u is None:
+            u = user_of[key] = len(users)
+            users.append(uid)
+        sessions.setdefault(d["user_session_id"], []).append(u)
+
+    questions: Dict[Any, List[int]] = {}
+    for q in db.questions.find({}, {"_id": 0, "question_id": 1, "theme": 1, "difficulty": 1}):
+        s = skill2idx.get(f"{q.get('theme')}|||{q.get('difficulty')}")
+        if s is not None:
+            questions.setdefault(q.get("question_id"), []).append(s)
+    return users, sessions, questions
+
+# ---------- Shards ----------
+def shard_queries(coll, n: int) -> List[Dict[str, Any]]:
+    """
+    Split `coll` into about n contiguous _id ranges (ObjectId creation time, index-backed),
+    in _id order; non-ObjectId _ids get a shard of their own, placed first.
+    """
+    first = coll.find_one({}, {"_id": 1}, sort=[("_id", 1)])
+    last = coll.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    if first is None:
+        return []
+    others = {"_id": {"$not": {"$type": "objectId"}}}
+    oid_lo = coll.find_one({"_id": {"$type": "objectId"}}, {"_id": 1}, sort=[("_id", 1)])
+    if oid_lo is None or not isinstance(last["_id"], ObjectId):
+        return [{}]
+    t0, t1 = oid_lo["_id"].generation_time, last["_id"].generation_time
+    bounds = sorted({ObjectId.from_datetime(t0 + (t1 - t0) * i / n) for i in range(1, max(1, n))})
+    bounds = [b for b in bounds if oid_lo["_id"] < b <= last["_id"]]
+    edges = [None] + bounds + [None]
+    queries = [others]
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        rng = {"$type": "objectId"}
+        if lo is not None:
+            rng["$gte"] = lo
+        if hi is not None:
+            rng["$lt"] = hi
+        queries.append({"_id": rng})
+    return queries
+
+_STATE: Dict[str, Any] = {}
+
+def _init_worker(mongo_uri: str, db_name: str, sessions, questions, db=None):
+    """Per-worker state: its own client (process pool) or the parent's db (thread pool)."""
+    _STATE["db"] = db if db is not None else MongoClient(mongo_uri)[db_name]
+    _STATE["sessions"] = sessions
+    _STATE["questions"] = questions
+
+def _extract_shard(query: Dict[str, Any]):
+    """Rows (user, skill, correct, answered_at type rank, answered_at us) of one shard, in _id order."""
+    db, sessions, questions = _STATE["db"], _STATE["sessions"], _STATE["questions"]
+    u_col, s_col, c_col, k_col, t_col = array("i"), array("i"), array("b"), array("b"), array("q")
+    cur = db.responses.find(query, {"_id": 1, "session_id": 1, "question_id": 1, "is_correct": 1,
+                                    "answered_at": 1}).sort("_id", 1)
+    for r in cur:
+        us = sessions.get(r.get("session_id"))
+        if not us:
+            continue
+        qs = questions.get(r.get("question_id"))
+        if not qs:
+            continue
+        c = 1 if r.get("is_correct") else 0
+        k, t = _ts_key(r.get("answered_at"))
+        for u in us:
+            for s in qs:
+                u_col.append(u)
+                s_col.append(s)
+                c_col.append(c)
+                k_col.append(k)
+                t_col.append(t)
+    return (np.frombuffer(u_col, dtype=np.int32) if u_col else np.empty(0, np.int32),
+            np.frombuffer(s_col, dtype=np.int32) if s_col else np.empty(0, np.int32),
+            np.frombuffer(c_col, dtype=np.int8) if c_col else np.empty(0, np.int8),
+            np.frombuffer(k_col, dtype=np.int8) if k_col else np.empty(0, np.int8),
+            np.frombuffer(t_col, dtype=np.int64) if t_col else np.empty(0, np.int64))
+
+# ---------- Sequences ----------
+def extract_sequences(db, skill2idx: Dict[str, int], workers: int = DKT_EXTRACT_WORKERS,
+                      shards: int = DKT_EXTRACT_SHARDS, pool: str = DKT_EXTRACT_POOL,
+                      mongo_uri: str = MONGO_URI, stats: Dict[str, Any] = None):
+    """
+    Same per-user sequences as train_dkt.iter_sequences (users in user_id order, each
+    time-ordered, unknown skills dropped, users with fewer than 2 interactions skipped)
+    without the aggregation: lookups are joined client-side, `responses` is read in
+    parallel _id shards, then rows are grouped and sorted per user with NumPy.
+    Ties on answered_at keep _id order (see _ts_key for non-date values).
+    pool: "thread" (default) or "process"; worker processes are spawned, not forked,
+    since the caller usually already holds torch threads and a MongoClient. Yields int64 arrays [n, 2] of (skill_idx, is_correct).
+    stats: optional dict filled with timings and row counts.
+    """
+    t0 = time.perf_counter()
+    users, sessions, questions = load_lookups(db, skill2idx)
+    t_lookups = time.perf_counter()
+
+    workers = max(1, workers)
+    queries = shard_queries(db.responses, shards or 4 * workers)
+    if pool == "thread" or workers == 1:
+        executor = ThreadPoolExecutor(workers, initializer=_init_worker,
+                                      initargs=(mongo_uri, db.name, sessions, questions, db))
+    else:
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_worker,
+                                       initargs=(mongo_uri, db.name, sessions, questions))
+    with executor:
+        parts = list(executor.map(_extract_shard, queries))  # shard order = _id order
+    t_scan = time.perf_counter()
+
+    u = np.concatenate([p[0] for p in parts]) if parts else np.empty(0, np.int32)
+    s = np.concatenate([p[1] for p in parts]) if parts else np.empty(0, np.int32)
+    c = np.concatenate([p[2] for p in parts]) if parts else np.empty(0, np.int8)
+    kind = np.concatenate([p[3] for p in parts]) if parts else np.empty(0, np.int8)
+    ts = np.concatenate([p[4] for p in parts]) if parts else np.empty(0, np.int64)
+    del parts
+
+    # user_id order (Mongo's), then answered_at; lexsort is stable -> _id order on ties
+    by_user = sorted(range(len(users)), key=lambda i: _bson_sort_key(users[i]))
+    user_rank = np.empty(len(users), dtype=np.int64)
+    user_rank[by_user] = np.arange(len(users))
+    ranks = user_rank[u] if len(u) else np.empty(0, np.int64)
+    order = np.lexsort((ts, kind, ranks))
+    ranks, s, c = ranks[order], s[order].astype(np.int64), c[order].astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, ranks[1:] != ranks[:-1]]) if len(ranks) else np.empty(0, np.int64)
+    ends = np.r_[starts[1:], len(ranks)]
+    if stats is not None:
+        stats.update({
+            "rows": int(len(order)),
+            "users": int(len(starts)),
+            "shards": len(queries),
+            "workers": workers,
+            "lookups_ms": round((t_lookups - t0) * 1000, 1),
+            "scan_ms": round((t_scan - t_lookups) * 1000, 1),
+            "sort_ms": round((time.perf_counter() - t_scan) * 1000, 1),
+        })
+    for a, b in zip(starts.tolist(), ends.tolist()):
+        if b - a >= 2:
+            yield np.stack([s[a:b], c[a:b]], axis=1)
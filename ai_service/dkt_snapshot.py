@@ -0,0 +1,345 @@
+import os
+import json
+import time
+import fcntl
+import datetime as dt
+from array import array
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from bson import ObjectId
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DKT_SNAPSHOT_DIR = os.getenv("DKT_SNAPSHOT_DIR", os.path.join("data", "dkt_snapshot"))
+# responses whose _id is younger than this are left for the next refresh (writes still in flight)
+DKT_SNAPSHOT_LAG_S = float(os.getenv("DKT_SNAPSHOT_LAG_S", "60"))
+MERGE_CHUNK = 1 << 22  # events copied per step when merging (bounded memory)
+
+MANIFEST = "manifest.json"
+_ARRAYS = {"skill": np.int32, "correct": np.int8, "ts": np.int64}
+
+def _ts_ms(v) -> int:
+    if isinstance(v, dt.datetime):
+        if v.tzinfo is not None:
+            v = v.astimezone(dt.timezone.utc).replace(tzinfo=None)
+        return int((v - dt.datetime(1970, 1, 1)).total_seconds() * 1000)
+    return -1
+
+def _delta_pipeline(since: Optional[dt.datetime], upto: dt.datetime) -> List[Dict[str, Any]]:
+    """
+    Responses INSERTED in [since, upto), i.e. whose ObjectId _id was generated in that
+    window, whatever their answered_at (client-supplied timestamps, /responses/bulk
+    replays, write-behind lag), sorted by answered_at. The _id range comes first
+    (primary index), so an incremental refresh only pays the $lookups for the new
+    responses. Without `since` (full build), non-ObjectId _ids are included as well.
+    """
+    window = {"$type": "objectId", "$lt": ObjectId.from_datetime(upto)}
+    if since is not None:
+        window["$gte"] = ObjectId.from_datetime(since)
+        match = {"_id": window}
+    else:
+        match = {"$or": [{"_id": window}, {"_id": {"$not": {"$type": "objectId"}}}]}
+    return [
+        {"$match": match},
+        {"$sort": {"answered_at": 1, "_id": 1}},
+        {"$lookup": {"from": "usersessions", "localField": "session_id", "foreignField": "user_session_id", "as": "us"}},
+        {"$unwind": "$us"},
+        {"$lookup": {"from": "questions", "localField": "question_id", "foreignField": "question_id", "as": "q"}},
+        {"$unwind": "$q"},
+        {"$project": {
+            "_id": 1,
+            "user_id": "$us.user_id",
+            "answered_at": 1,
+            "is_correct": 1,
+            "theme": "$q.theme",
+            "difficulty": "$q.difficulty",
+        }},
+    ]
+
+
+class DKTSnapshot:
+    """
+    On-disk copy of the DKT training sequences, so that training, global evaluation
+    and sweeps stop re-running the responses x usersessions x questions aggregation.
+
+    Layout (generation `g`, swapped atomically through manifest.json):
+      skill.g.npy   int32 [N]  index into manifest["skills"] ("theme|||difficulty")
+      correct.g.npy int8  [N]
+      ts.g.npy      int64 [N]  answered_at, epoch milliseconds
+      offsets.g.npy int64 [U+1] events of user u = [offsets[u], offsets[u+1]), time-ordered
+      ingested.g.npy int64 [U]  latest insertion time (_id, epoch ms) among the user's events
+      users.g.json  user ids, aligned with offsets
+    Arrays are memory-mapped read-only. `refresh` appends the responses inserted since
+    the watermark (manifest["watermark"], on the ObjectId _id generation time, not on
+    answered_at); skill and user indices are append-only, so they stay valid across
+    refreshes. A back-dated response is merged into its user's events at its answered_at
+    position, so sequences keep the order of the full aggregation.
+    """
+
+    def __init__(self, path: str = DKT_SNAPSHOT_DIR):
+        self.path = path
+        self.manifest: Dict[str, Any] = {}
+        self.skills: List[str] = []
+        self.users: List[str] = []
+        self.skill = self.correct = self.ts = None
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.ingested: Optional[np.ndarray] = None
+
+    # ---------------- reading ----------------
+    def _file(self, name: str, gen: int, ext: str = "npy") -> str:
+        return os.path.join(self.path, f"{name}.{gen}.{ext}")
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.path, MANIFEST))
+
+    def open(self) -> "DKTSnapshot":
+        """(Re)map the current generation; an absent snapshot reads as empty."""
+        if not self.exists():
+            return self
+        with open(os.path.join(self.path, MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        gen = manifest["generation"]
+        for name in _ARRAYS:
+            setattr(self, name, np.load(self._file(name, gen), mmap_mode="r"))
+        self.offsets = np.load(self._file("offsets", gen))
+        ingested = self._file("ingested", gen)
+        self.ingested = np.load(ingested) if os.path.exists(ingested) else None  # older generations: none
+        with open(self._file("users", gen, "json"), "r", encoding="utf-8") as f:
+            self.users = json.load(f)
+        self.skills = manifest["skills"]
+        self.manifest = manifest
+        return self
+
+    def __len__(self):
+        return len(self.users)
+
+    def num_events(self) -> int:
+        return int(self.offsets[-1])
+
+    def skill_lut(self, skill2idx: Dict[str, int]) -> np.ndarray:
+        """Snapshot skill index -> model skill index (-1 = unknown to this model)."""
+        return np.asarray([skill2idx.get(k, -1) for k in self.skills] or [-1], dtype=np.int64)
+
+    def users_since(self, when: dt.datetime) -> np.ndarray:
+        """
+        Indices of the users with at least one response inserted at or after `when` (a
+        previous watermark), whatever its answered_at. Snapshots written before the
+        per-user insertion times existed fall back to answered_at.
+        """
+        if self.ts is None or not self.users:
+            return np.empty(0, dtype=np.int64)
+        if self.ingested is not None:
+            return np.flatnonzero(self.ingested >= _ts_ms(when))
+        last_ts = self.ts[self.offsets[1:] - 1]  # per-user events are time-ordered
+        return np.flatnonzero(last_ts > _ts_ms(when))
+
+    def iter_sequences(self, skill2idx: Dict[str, int], shard: int = 0, num_shards: int = 1, users=None):
+        """
+        Per-user sequences as int64 arrays [n, 2] of (skill_idx, is_correct), like
+        train_dkt.iter_sequences (skills unknown to `skill2idx` dropped, users with
+        fewer than 2 interactions skipped). shard/num_shards: every num_shards-th user.
+        users: optional subset of user indices (e.g. users_since).
+        """
+        if self.skill is None:
+            return
+        lut = self.skill_lut(skill2idx)
+        selected = range(len(self.users)) if users is None else [int(u) for u in users]
+        for u in selected[shard::num_shards]:
+            a, b = int(self.offsets[u]), int(self.offsets[u + 1])
+            s = lut[self.skill[a:b]]
+            keep = s >= 0
+            if int(keep.sum()) < 2:
+                continue
+            yield np.stack([s[keep], self.correct[a:b][keep].astype(np.int64)], axis=1)
+
+    def info(self) -> Dict[str, Any]:
+        m = self.manifest
+        return {
+            "path": self.path,
+            "exists": self.exists(),
+            "generation": m.get("generation"),
+            "users": len(self.users),
+            "events": self.num_events(),
+            "skills": len(self.skills),
+            "watermark": m.get("watermark"),
+            "updated_at": m.get("updated_at"),
+        }
+
+    # ---------------- refresh ----------------
+    def refresh(self, db, full: bool = False, lag_s: float = DKT_SNAPSHOT_LAG_S) -> Dict[str, Any]:
+        """
+        Append the responses inserted since the watermark (everything if `full` or no
+        snapshot yet), then publish a new generation. Serialized across processes by a
+        lock file; readers keep their mapping of the previous generation.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._refresh(db, full, lag_s)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _refresh(self, db, full: bool, lag_s: float) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        self.open()
+        prev_gen = self.manifest.get("generation")
+        if full:
+            self.__init__(self.path)
+        since = dt.datetime.fromisoformat(self.manifest["watermark"]) if self.manifest.get("watermark") else None
+        # ObjectId timestamps have second resolution: keep the watermark on a second boundary
+        # (never ahead of the clock: later inserts would fall behind the watermark)
+        upto = (dt.datetime.utcnow() - dt.timedelta(seconds=max(0.0, lag_s))).replace(microsecond=0)
+
+        skill_of = {k: i for i, k in enumerate(self.skills)}
+        user_of = {u: i for i, u in enumerate(self.users)}
+        skills, users = list(self.skills), list(self.users)
+        # delta held in compact typed arrays (21 bytes per response), not Python objects
+        d_user, d_skill, d_correct, d_ts = array("q"), array("i"), array("b"), array("q")
+        ingested = np.zeros(0, dtype=np.int64)
+        for r in db.responses.aggregate(_delta_pipeline(since, upto), allowDiskUse=True):
+            key = f"{r.get('theme')}|||{r.get('difficulty')}"
+            s = skill_of.get(key)
+            if s is None:
+                s = skill_of[key] = len(skills)
+                skills.append(key)
+            uid = str(r.get("user_id"))
+            u = user_of.get(uid)
+            if u is None:
+                u = user_of[uid] = len(users)
+                users.append(uid)
+            d_user.append(u)
+            d_skill.append(s)
+            d_correct.append(1 if r.get("is_correct") else 0)
+            d_ts.append(_ts_ms(r.get("answered_at")))
+            if u >= len(ingested):
+                ingested = np.concatenate([ingested, np.zeros(max(1024, u + 1 - len(ingested)), dtype=np.int64)])
+            oid = r.get("_id")
+            if isinstance(oid, ObjectId):
+                ingested[u] = max(ingested[u], _ts_ms(oid.generation_time))
+
+        n_new = len(d_user)
+        if n_new == 0 and self.exists() and not full:
+            self.manifest["watermark"] = upto.isoformat()
+            self._write_manifest(self.manifest)
+            return {**self.info(), "appended": 0, "new_users": 0, "ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+        gen = int(prev_gen or 0) + 1
+        offsets = self._merge(gen, len(users), np.frombuffer(d_user, dtype=np.int64),
+                              {"skill": d_skill, "correct": d_correct, "ts": d_ts})
+        np.save(self._file("offsets", gen), offsets)
+        merged = np.zeros(len(users), dtype=np.int64)
+        if self.ingested is not None:
+            merged[:len(self.ingested)] = self.ingested
+        n = min(len(users), len(ingested))
+        merged[:n] = np.maximum(merged[:n], ingested[:n])
+        np.save(self._file("ingested", gen), merged)
+        with open(self._file("users", gen, "json"), "w", encoding="utf-8") as f:
+            json.dump(users, f)
+        new_users = len(users) - len(self.users)
+        # manifest last: it is what switches readers to the new generation
+        self._write_manifest({
+            "generation": gen,
+            "skills": skills,
+            "watermark": upto.isoformat(),
+            "updated_at": dt.datetime.utcnow().isoformat(),
+            "users": len(users),
+            "events": int(offsets[-1]),
+        })
+        if prev_gen is not None:
+            self._remove_generation(prev_gen)
+        self.open()
+        return {**self.info(), "appended": n_new, "new_users": new_users,
+                "ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+    def _merge(self, gen: int, n_users: int, d_user: np.ndarray, delta: Dict[str, array]) -> np.ndarray:
+        """
+        Write generation `gen` = old events followed, per user, by the delta events
+        (already time-ordered). Every event gets its destination index, then arrays are
+        copied chunk by chunk into the new memmaps; the few users whose delta starts
+        before their last old event (back-dated responses) get their block re-sorted by
+        ts, old events first on ties. Returns the new offsets.
+        """
+        old_off = self.offsets
+        old_len = np.zeros(n_users, dtype=np.int64)
+        old_len[:len(old_off) - 1] = np.diff(old_off)
+        add_len = np.bincount(d_user, minlength=n_users).astype(np.int64)
+        offsets = np.zeros(n_users + 1, dtype=np.int64)
+        np.cumsum(old_len + add_len, out=offsets[1:])
+
+        outs = {name: np.lib.format.open_memmap(self._file(name, gen), mode="w+", dtype=dtype,
+                                                shape=(int(offsets[-1]),))
+                for name, dtype in _ARRAYS.items()}
+
+        # old events keep their order; each user block moves to its new offset
+        n_old = int(old_off[-1])
+        for c0 in range(0, n_old, MERGE_CHUNK):
+            c1 = min(n_old, c0 + MERGE_CHUNK)
+            pos = np.arange(c0, c1, dtype=np.int64)
+            u = np.searchsorted(old_off, pos, side="right") - 1
+            dest = offsets[u] + (pos - old_off[u])
+            for name in _ARRAYS:
+                outs[name][dest] = getattr(self, name)[c0:c1]
+
+        # delta events land after the user's old events, in arrival (= time) order
+        if len(d_user):
+            order = np.argsort(d_user, kind="stable")
+            su = d_user[order]
+            first = np.searchsorted(su, su, side="left")
+            dest = np.empty(len(d_user), dtype=np.int64)
+            dest[order] = offsets[su] + old_len[su] + (np.arange(len(su)) - first)
+            for name, dtype in _ARRAYS.items():
+                outs[name][dest] = np.frombuffer(delta[name], dtype=dtype)
+
+            d_ts = np.frombuffer(delta["ts"], dtype=np.int64)
+            touched = np.unique(d_user)
+            touched = touched[old_len[touched] > 0]
+            first_new = np.full(n_users, np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(first_new, d_user, d_ts)
+            last_old = outs["ts"][offsets[touched] + old_len[touched] - 1]
+            for u in touched[first_new[touched] < last_old].tolist():
+                a, b = int(offsets[u]), int(offsets[u + 1])
+                order = np.argsort(outs["ts"][a:b], kind="stable")
+                for name in _ARRAYS:
+                    outs[name][a:b] = outs[name][a:b][order]
+
+        for arr in outs.values():
+            arr.flush()
+        return offsets
+
+    def _write_manifest(self, manifest: Dict[str, Any]):
+        tmp = os.path.join(self.path, f"{MANIFEST}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def _remove_generation(self, gen: int):
+        for name in list(_ARRAYS) + ["offsets", "ingested"]:
+            try:
+                os.remove(self._file(name, gen))
+            except OSError:
+                pass
+        try:
+            os.remove(self._file("users", gen, "json"))
+        except OSError:
+            pass
+
+
+def refreshed_snapshot(db, path: str = DKT_SNAPSHOT_DIR) -> DKTSnapshot:
+    """Snapshot brought up to date (incremental append) and mapped for reading."""
+    snap = DKTSnapshot(path)
+    stats = snap.refresh(db)
+    print(f"[DKT] snapshot: +{stats['appended']} responses, {stats['users']} users, "
+          f"{stats['events']} events ({stats['ms']} ms)")
+    return snap
+
+# ---------- CLI ----------
+if __name__ == "__main__":
+    from pymongo import MongoClient
+
+    client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017/"))
+    db = client[os.getenv("MONGO_DB", "quiz_app")]
+    stats = DKTSnapshot().refresh(db, full=os.getenv("DKT_SNAPSHOT_FULL", "0") == "1")
+    print(json.dumps(stats, indent=2))
@@ -0,0 +1,12 @@
+import os
+import json
+
+from metrics import dkt_global_metrics
+
+# ---------- CLI ----------
+if __name__ == "__main__":
+    # simple CLI via envs (optional)
+    BATCH = int(os.getenv("DKT_EVAL_BATCH", "64"))
+    LIMIT = os.getenv("DKT_EVAL_LIMIT_USERS")
+    m = dkt_global_metrics(batch_size=BATCH, max_users=int(LIMIT) if LIMIT else None)
+    print(json.dumps(m, ensure_ascii=False, indent=2))
@@ -0,0 +1,138 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict
+
+# ----------------------- Config -----------------------
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "2048"))    # nb max d'utilisateurs en cache
+HISTORY_CACHE_TTL_S = float(os.getenv("HISTORY_CACHE_TTL_S", "300"))  # durée de vie d'une entrée
+
+class UserHistoryCache:
+    """
+    Cache LRU + TTL (par process) des historiques utilisateurs normalisés.
+
+    - get(user_id)          : renvoie l'historique en cache ou le charge via `loader`
+    - append(user_id, ev)   : write-through d'un nouvel événement (/response)
+    - add_session(uid, sid) : write-through d'une nouvelle session (/session/start)
+
+    Les écritures ne purgent PAS l'entrée : elles la complètent, ce qui évite de
+    relire tout `usersessions` après chaque réponse dans la boucle de jeu.
+    Une écriture (ou invalidation) pendant le chargement d'un utilisateur hors cache
+    empêche de mettre ce chargement en cache : il a pu lire Mongo avant elle.
+    """
+
+    def __init__(self, loader: Callable[[str], Any],
+                 max_entries: int = HISTORY_CACHE_SIZE, ttl_s: float = HISTORY_CACHE_TTL_S):
+        self._loader = loader
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_s = float(ttl_s)
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # user_id -> (expires_at, history)
+        self._lock = threading.Lock()
+        self._loading: Dict[str, int] = {}  # user_id -> chargements en cours
+        self._stale: set = set()            # chargements en cours dépassés par une écriture
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.appends = 0
+
+    def _lookup(self, user_id: str):
+        """Entrée vivante (et promue en tête LRU) ou None. Appelé sous verrou."""
+        entry = self._data.get(user_id)
+        if entry is None:
+            return None
+        expires_at, hist = entry
+        if expires_at < time.monotonic():
+            del self._data[user_id]
+            self.expirations += 1
+            return None
+        self._data.move_to_end(user_id)
+        return hist
+
+    def get(self, user_id: str):
+        user_id = str(user_id)
+        with self._lock:
+            hist = self._lookup(user_id)
+            if hist is not None:
+                self.hits += 1
+                return hist
+            self.misses += 1
+            self._loading[user_id] = self._loading.get(user_id, 0) + 1
+
+        # chargement hors verrou (I/O Mongo)
+        try:
+            hist = self._loader(user_id)
+        finally:
+            with self._lock:
+                left = self._loading.pop(user_id) - 1
+                stale = user_id in self._stale
+                if left:
+                    self._loading[user_id] = left
+                else:
+                    self._stale.discard(user_id)
+        if stale:
+            return hist  # servi à cet appel, relu au prochain
+        with self._lock:
+            self._data[user_id] = (time.monotonic() + self.ttl_s, hist)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return hist
+
+    def peek(self, user_id: str):
+        """Historique en cache sans chargement ni effet sur les compteurs hit/miss."""
+        with self._lock:
+            return self._lookup(str(user_id))
+
+    def append(self, user_id: str, event: Dict[str, Any], response_id=None):
+        """
+        Ajoute l'événement si l'utilisateur est en cache (renvoie le résultat de
+        UserHistory.append, None si response_id y est déjà). Sinon None : le prochain
+        get lira Mongo.
+        """
+        with self._lock:
+            hist = self._lookup(str(user_id))
+            if hist is None:
+                self._mark_stale(str(user_id))
+                return None
+            self.appends += 1
+        return hist.append(event, response_id=response_id)  # verrou propre à l'historique
+
+    def add_session(self, user_id: str, session_id: str) -> bool:
+        with self._lock:
+            hist = self._lookup(str(user_id))
+        if hist is None:
+            return False
+        hist.add_session(session_id)
+        return True
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._data.pop(str(user_id), None)
+            self._mark_stale(str(user_id))
+
+    def _mark_stale(self, user_id: str):
+        """Appelé sous verrou."""
+        if user_id in self._loading:
+            self._stale.add(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl_s,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "appends": self.appends,
+            }
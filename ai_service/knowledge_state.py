@@ -0,0 +1,138 @@
+import os
+import threading
+import datetime as dt
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+# ----------------------- Config -----------------------
+DKT_STATE_CACHE_SIZE = int(os.getenv("DKT_STATE_CACHE_SIZE", "4096"))  # nb max d'états en mémoire
+DKT_STATE_PERSIST = os.getenv("DKT_STATE_PERSIST", "").strip().lower()  # "" (mémoire) | "mongo"
+
+class KnowledgeState:
+    """
+    État de connaissance DKT d'un utilisateur après `n_events` événements d'historique :
+      - h, c : état caché/cellule du LSTM ([1, 1, H]) ou None (aucune interaction)
+      - p    : dernière sortie, p(correct) au prochain pas pour chaque skill ([K])
+    Lié à une version de modèle : un autre modèle impose une reconstruction.
+    """
+
+    __slots__ = ("h", "c", "p", "n_events", "model_version")
+
+    def __init__(self, h, c, p: np.ndarray, n_events: int, model_version: str):
+        self.h, self.c = h, c
+        self.p = p
+        self.n_events = int(n_events)
+        self.model_version = model_version
+
+    @property
+    def lstm_state(self):
+        return (self.h, self.c) if self.h is not None else None
+
+    # --- (dé)sérialisation Mongo : tenseurs float32 -> bytes
+    def to_doc(self, user_id: str) -> Dict[str, Any]:
+        def _b(t):
+            return None if t is None else t.detach().cpu().numpy().astype(np.float32).tobytes()
+        return {
+            "user_id": str(user_id),
+            "model_version": self.model_version,
+            "n_events": self.n_events,
+            "h": _b(self.h),
+            "c": _b(self.c),
+            "p": self.p.astype(np.float32).tobytes(),
+            "updated_at": dt.datetime.utcnow(),
+        }
+
+    @classmethod
+    def from_doc(cls, doc: Dict[str, Any]) -> "KnowledgeState":
+        import torch  # différé : inutile tant qu'aucun état n'est relu depuis Mongo
+
+        def _t(b):
+            if b is None:
+                return None
+            return torch.from_numpy(np.frombuffer(bytes(b), dtype=np.float32).copy()).view(1, 1, -1)
+        p = np.frombuffer(bytes(doc["p"]), dtype=np.float32).copy()
+        return cls(_t(doc.get("h")), _t(doc.get("c")), p, doc["n_events"], doc["model_version"])
+
+
+class KnowledgeStateStore:
+    """
+    Store par utilisateur des états DKT (LRU en mémoire, persistance Mongo optionnelle
+    via DKT_STATE_PERSIST=mongo, collection `dkt_states`). Un état d'une autre
+    version de modèle est ignoré (puis reconstruit par l'appelant).
+    """
+
+    def __init__(self, db=None, max_entries: int = DKT_STATE_CACHE_SIZE, persist: str = DKT_STATE_PERSIST):
+        self.coll = db["dkt_states"] if (db is not None and persist == "mongo") else None
+        self.max_entries = max(1, int(max_entries))
+        self._data: "OrderedDict[str, KnowledgeState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.steps = 0
+
+    def get(self, user_id: str, model_version: str) -> Optional[KnowledgeState]:
+        user_id = str(user_id)
+        with self._lock:
+            st = self._data.get(user_id)
+            if st is not None and st.model_version == model_version:
+                self._data.move_to_end(user_id)
+                self.hits += 1
+                return st
+        if self.coll is not None:
+            doc = self.coll.find_one({"user_id": user_id, "model_version": model_version}, {"_id": 0})
+            if doc:
+                st = KnowledgeState.from_doc(doc)
+                self._remember(user_id, st)
+                with self._lock:
+                    self.hits += 1
+                return st
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, user_id: str, st: KnowledgeState):
+        with self._lock:
+            self._data[user_id] = st
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def put(self, user_id: str, st: KnowledgeState, rebuilt: bool = False):
+        user_id = str(user_id)
+        self._remember(user_id, st)
+        with self._lock:
+            if rebuilt:
+                self.rebuilds += 1
+            else:
+                self.steps += 1
+        if self.coll is not None:
+            self.coll.replace_one({"user_id": user_id}, st.to_doc(user_id), upsert=True)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._data.pop(str(user_id), None)
+        if self.coll is not None:
+            self.coll.delete_one({"user_id": str(user_id)})
+
+    def on_model_change(self, model_version: str):
+        """Nouveau modèle : purge les états des autres versions (reconstruits à la demande)."""
+        with self._lock:
+            for uid in [u for u, st in self._data.items() if st.model_version != model_version]:
+                del self._data[uid]
+        if self.coll is not None:
+            self.coll.delete_many({"model_version": {"$ne": model_version}})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "persist": "mongo" if self.coll is not None else None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "rebuilds": self.rebuilds,
+                "steps": self.steps,
+            }
@@ -1,55 +1,77 @@
 import math
 import json
 import numpy as np
+import torch
 from typing import Dict, Any
 from recommender import Recommender
+from models.dkt import model_input
 
 EPS = 1e-9
 
-def dkt_holdout_metrics(user_id: str) -> Dict[str, Any]:
-    """
-    Walk-forward: à chaque interaction t, on prédit p(correct_t) à partir de l'historique < t.
-    Retourne des métriques standard: logloss, brier, accuracy.
-    """
-    rec = Recommender()
-    rec._load_dkt()
-    seq = rec._user_sequence_for_dkt(user_id)  # [(skill_idx, correct)]
-    K = rec._dkt_meta["num_skills"]
-    if len(seq) < 3:
-        return {"user_id": user_id, "n": 0, "message": "séquence trop courte"}
+def _auc(y: np.ndarray, p: np.ndarray):
+    """AUC ROC (Mann-Whitney, rangs moyens pour les ex-aequo). None si une seule classe."""
+    pos = y == 1.0
+    n_pos = int(pos.sum())
+    n_neg = int(y.size - n_pos)
+    if n_pos == 0 or n_neg == 0:
+        return None
+    order = np.argsort(p, kind="mergesort")
+    _, inv, counts = np.unique(p[order], return_inverse=True, return_counts=True)
+    avg_rank = np.cumsum(counts) - (counts - 1) / 2.0  # rangs 1-based moyennés
+    ranks = np.empty(p.size, dtype=np.float64)
+    ranks[order] = avg_rank[inv]
+    return float((ranks[pos].sum() - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_neg))
 
-    preds, trues = [], []
-    for t in range(1, len(seq)):
-        # build prefix [0..t-1] pour prédire sur l'item à t
-        prefix = seq[:t]
-        p_vec = rec._dkt_predict_vector(prefix)  # taille K
-        s_t, c_t = seq[t]
-        preds.append(float(p_vec[s_t]))
-        trues.append(float(c_t))
-
-    y = np.array(trues, dtype=np.float64)
-    p = np.clip(np.array(preds, dtype=np.float64), EPS, 1 - EPS)
+def _binary_metrics(y: np.ndarray, p: np.ndarray) -> Dict[str, Any]:
+    """logloss, brier, accuracy@0.5, AUC et part des p dans la zone 0.55–0.75."""
+    y = np.asarray(y, dtype=np.float64)
+    p = np.clip(np.asarray(p, dtype=np.float64), EPS, 1 - EPS)
 
     logloss = float(-np.mean(y * np.log(p) + (1 - y) * np.log(1 - p)))
     brier   = float(np.mean((p - y) ** 2))
     acc     = float(np.mean((p >= 0.5) == (y == 1.0)))
     sweet   = float(np.mean((p >= 0.55) & (p <= 0.75)))
+    auc     = _auc(y, p)
 
     return {
-        "user_id": user_id,
         "n": int(len(y)),
         "logloss": round(logloss, 4),
         "brier": round(brier, 4),
         "accuracy@0.5": round(acc, 4),
+        "auc": round(auc, 4) if auc is not None else None,
         "pct_in_0.55_0.75": round(sweet, 4)
     }
 
-def summarize_with_dkt_p(rec: Recommender, user_id: str, items):
+def dkt_holdout_metrics(user_id: str, rec: Recommender = None) -> Dict[str, Any]:
+    """
+    Walk-forward: à chaque interaction t, on prédit p(correct_t) à partir de l'historique < t.
+    Le LSTM étant causal, toutes ces prédictions sortent d'UNE seule passe avant sur
+    seq[:-1] : la sortie au pas t-1 est exactement la prédiction pour l'item t.
+    Retourne des métriques standard: logloss, brier, accuracy, AUC.
+    """
+    rec = rec or Recommender()
+    dkt = rec._load_dkt()
+    seq = rec._user_sequence_for_dkt(user_id, dkt=dkt)  # [(skill_idx, correct)]
+    K = dkt.num_skills
+    if len(seq) < 3:
+        return {"user_id": user_id, "n": 0, "message": "séquence trop courte"}
+
+    inp = np.asarray(seq[:-1], dtype=np.int64)
+    x = model_input(dkt.model, torch.from_numpy(inp[None, :, 0] + K * (1 - inp[None, :, 1])))  # [1, T-1, ...]
+    with torch.no_grad():
+        yhat = dkt.model(x)[0].cpu().numpy()   # [T-1, K]
+
+    nxt = np.asarray(seq[1:], dtype=np.int64)       # [(s_t, c_t)] pour t = 1..T-1
+    preds = yhat[np.arange(len(nxt)), nxt[:, 0]]
+    trues = nxt[:, 1].astype(np.float64)
+
+    return {"user_id": user_id, **_binary_metrics(trues, preds)}
+
+def summarize_with_dkt_p(rec: Recommender, user_id: str, items, history=None):
     """Calcule p(correct) (via DKT) pour une liste d'items, + diversité par thème."""
-    rec._load_dkt()
-    seq = rec._user_sequence_for_dkt(user_id)
-    p_vec = rec._dkt_predict_vector(seq)
-    idx_of = rec._dkt_meta["skill2idx"]
+    dkt = rec._load_dkt()
+    p_vec = rec._dkt_user_vector(user_id, history=history, dkt=dkt)
+    idx_of = dkt.skill2idx
     ps = []
     themes = set()
     for q in items:
@@ -66,3 +88,159 @@ def summarize_with_dkt_p(rec: Recommender, user_id: str, items):
         "n": int(arr.size),
         "themes": int(len(themes))
     }
+
+# ----------------------- Évaluation globale (population) -----------------------
+AUC_BINS = 1000  # AUC par histogramme : mémoire fixe quel que soit le nombre de prédictions
+
+class _StreamingMetrics:
+    """Accumulateur de métriques binaires global + par skill, en mémoire bornée."""
+
+    def __init__(self, num_skills: int, bins: int = AUC_BINS):
+        self.K, self.bins = num_skills, bins
+        self.n = np.zeros(num_skills, dtype=np.int64)
+        self.logloss = np.zeros(num_skills, dtype=np.float64)
+        self.brier = np.zeros(num_skills, dtype=np.float64)
+        self.correct = np.zeros(num_skills, dtype=np.int64)  # prédictions justes @0.5
+        self.pos = np.zeros((num_skills, bins), dtype=np.int64)
+        self.neg = np.zeros((num_skills, bins), dtype=np.int64)
+
+    def update(self, skills: np.ndarray, y: np.ndarray, p: np.ndarray):
+        y = y.astype(np.float64)
+        p = np.clip(p.astype(np.float64), EPS, 1 - EPS)
+        np.add.at(self.n, skills, 1)
+        np.add.at(self.logloss, skills, -(y * np.log(p) + (1 - y) * np.log(1 - p)))
+        np.add.at(self.brier, skills, (p - y) ** 2)
+        np.add.at(self.correct, skills, ((p >= 0.5) == (y == 1.0)).astype(np.int64))
+        b = np.minimum((p * self.bins).astype(np.int64), self.bins - 1)
+        np.add.at(self.pos, (skills[y == 1.0], b[y == 1.0]), 1)
+        np.add.at(self.neg, (skills[y == 0.0], b[y == 0.0]), 1)
+
+    @staticmethod
+    def _hist_auc(pos: np.ndarray, neg: np.ndarray):
+        n_pos, n_neg = int(pos.sum()), int(neg.sum())
+        if n_pos == 0 or n_neg == 0:
+            return None
+        neg_below = np.cumsum(neg) - neg
+        return float((pos * (neg_below + 0.5 * neg)).sum() / (n_pos * n_neg))
+
+    def _summary(self, n, logloss, brier, correct, pos, neg) -> Dict[str, Any]:
+        if n == 0:
+            return {"n": 0}
+        auc = self._hist_auc(pos, neg)
+        return {
+            "n": int(n),
+            "logloss": round(float(logloss / n), 4),
+            "brier": round(float(brier / n), 4),
+            "accuracy@0.5": round(float(correct / n), 4),
+            "auc": round(auc, 4) if auc is not None else None,
+        }
+
+    def result(self, idx2skill: Dict[str, str] = None) -> Dict[str, Any]:
+        overall = self._summary(self.n.sum(), self.logloss.sum(), self.brier.sum(), self.correct.sum(),
+                                self.pos.sum(axis=0), self.neg.sum(axis=0))
+        per_skill = []
+        for k in np.flatnonzero(self.n):
+            row = self._summary(self.n[k], self.logloss[k], self.brier[k], self.correct[k], self.pos[k], self.neg[k])
+            row["skill_idx"] = int(k)
+            row["skill"] = (idx2skill or {}).get(str(k))
+            per_skill.append(row)
+        return {"overall": overall, "per_skill": per_skill}
+
+
+def _eval_batch(model, K: int, seqs, acc: _StreamingMetrics, seg_len: int):
+    """
+    Walk-forward sur un lot de séquences de longueurs proches : entrées seq[:-1], cibles
+    seq[1:], padding masqué. Le temps est découpé en segments de `seg_len` pas en
+    propageant (h, c), donc la mémoire reste bornée même pour de très longues séquences.
+    """
+    arrs = [np.asarray(s, dtype=np.int64) for s in seqs]
+    B = len(arrs)
+    T = max(len(a) for a in arrs) - 1
+    state = None
+    for t0 in range(0, T, seg_len):
+        t1 = min(T, t0 + seg_len)
+        W = t1 - t0
+        codes = np.zeros((B, W), dtype=np.int64)  # indices d'interaction (padding 0, masqué)
+        tgt_s = np.zeros((B, W), dtype=np.int64)
+        tgt_c = np.zeros((B, W), dtype=np.int64)
+        mask = np.zeros((B, W), dtype=bool)
+        for b, a in enumerate(arrs):
+            e = min(t1, len(a) - 1)
+            if e <= t0:
+                continue
+            inp, tgt = a[t0:e], a[t0 + 1:e + 1]
+            codes[b, :e - t0] = inp[:, 0] + K * (1 - inp[:, 1])
+            tgt_s[b, :e - t0] = tgt[:, 0]
+            tgt_c[b, :e - t0] = tgt[:, 1]
+            mask[b, :e - t0] = True
+        with torch.no_grad():
+            yhat, state = model.forward_with_state(model_input(model, torch.from_numpy(codes)), state)
+        p = np.take_along_axis(yhat.cpu().numpy(), tgt_s[..., None], axis=2)[..., 0]
+        acc.update(tgt_s[mask], tgt_c[mask], p[mask])
+
+
+def evaluate_sequences(model, num_skills: int, sequences, batch_size: int = 64, chunk_users: int = 2048,
+                       seg_len: int = 256, max_users: int = None, idx2skill: Dict[str, str] = None) -> Dict[str, Any]:
+    """
+    Walk-forward d'un modèle DKT sur des séquences [(skill_idx, correct), ...] lues en flux :
+    paquets de `chunk_users`, triés par longueur puis passés par lots de `batch_size`
+    (bucketing : peu de padding) → mémoire bornée. Global + par skill.
+    """
+    acc = _StreamingMetrics(num_skills)
+    n_users = 0
+
+    def _flush(chunk):
+        chunk.sort(key=len)
+        for i in range(0, len(chunk), batch_size):
+            _eval_batch(model, num_skills, chunk[i:i + batch_size], acc, seg_len)
+
+    chunk = []
+    for seq in sequences:
+        if len(seq) < 2:
+            continue
+        chunk.append(seq)
+        n_users += 1
+        if len(chunk) >= chunk_users:
+            _flush(chunk)
+            chunk = []
+        if max_users and n_users >= max_users:
+            break
+    if chunk:
+        _flush(chunk)
+
+    out = acc.result(idx2skill)
+    out["users"] = n_users
+    return out
+
+def dkt_global_metrics(rec: Recommender = None, sequences=None, batch_size: int = 64,
+                       chunk_users: int = 2048, seg_len: int = 256, max_users: int = None) -> Dict[str, Any]:
+    """
+    Évaluation walk-forward du DKT sur TOUTE la population (logloss, Brier, accuracy,
+    AUC ; global et par skill), mémoire bornée (voir evaluate_sequences).
+    Par défaut (DKT_SNAPSHOT=1) les séquences viennent du snapshot disque de
+    l'entraînement, lu tel quel : sa mise à jour revient à l'entraînement ou au CLI
+    dkt_snapshot (`data_until` du résultat = son watermark). Sans snapshot sur
+    disque, l'agrégation Mongo.
+    """
+    from train_dkt import DKT_SNAPSHOT, iter_sequences
+    from dkt_snapshot import DKTSnapshot
+
+    rec = rec or Recommender()
+    dkt = rec._load_dkt()
+    model, meta = dkt.model, dkt.meta
+    K = int(meta["num_skills"])
+    data_until = None
+    if sequences is None:
+        snap = DKTSnapshot().open() if DKT_SNAPSHOT else None
+        if snap is not None and snap.exists():
+            sequences = snap.iter_sequences(meta["skill2idx"])
+            data_until = snap.manifest.get("watermark")
+        else:
+            sequences = iter_sequences(rec.db, meta["skill2idx"])
+
+    out = evaluate_sequences(model, K, sequences, batch_size=batch_size, chunk_users=chunk_users,
+                             seg_len=seg_len, max_users=max_users, idx2skill=meta.get("idx2skill"))
+    out["model_trained_at"] = meta.get("trained_at")
+    if data_until is not None:
+        out["data_until"] = data_until
+    return out
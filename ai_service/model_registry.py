@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import threading
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+
+# même .env pour le service et l'entraînement : un seul MODEL_DIR
+load_dotenv()
+
+# ----------------------- Config -----------------------
+MODEL_DIR = os.getenv("MODEL_DIR", "model")
+META_FILE = "dkt_meta.json"
+MODEL_FILE = "dkt.pt"
+DKT_USE_SERVING = os.getenv("DKT_USE_SERVING", "1") == "1"                # préférer l'artefact TorchScript
+DKT_SERVING_MAX_DIFF = float(os.getenv("DKT_SERVING_MAX_DIFF", "0.02"))  # écart max toléré vs modèle eager
+MODEL_CHECK_S = float(os.getenv("MODEL_CHECK_S", "5"))                    # intervalle de vérification (stat)
+
+def meta_path(model_dir: str = MODEL_DIR) -> str:
+    return os.path.join(model_dir, META_FILE)
+
+def model_path(model_dir: str = MODEL_DIR) -> str:
+    return os.path.join(model_dir, MODEL_FILE)
+
+
+class LoadedModel:
+    """Modèle DKT chargé + meta, immuable : une requête garde la même vue de bout en bout."""
+
+    __slots__ = ("model", "meta", "version", "backend", "fingerprint", "loaded_at")
+
+    def __init__(self, model, meta: Dict[str, Any], version: str, backend: str, fingerprint):
+        self.model = model
+        self.meta = meta
+        self.version = version
+        self.backend = backend
+        self.fingerprint = fingerprint
+        self.loaded_at = time.time()
+
+    @property
+    def num_skills(self) -> int:
+        return int(self.meta["num_skills"])
+
+    @property
+    def skill2idx(self) -> Dict[str, int]:
+        return self.meta["skill2idx"]
+
+
+class ModelRegistry:
+    """
+    Registre DKT unique par process (voir get_registry) :
+      - charge checkpoint + meta une seule fois ;
+      - vérifie au plus tous les MODEL_CHECK_S l'empreinte des fichiers (os.stat, très peu coûteux) ;
+      - recharge en tâche de fond quand un nouveau modèle apparaît, puis remplace la
+        référence d'un coup (swap atomique) : les requêtes en cours gardent l'ancien
+        modèle, aucune ne paie le chargement (sauf le tout premier, faute de modèle).
+    """
+
+    def __init__(self, model_dir: str = MODEL_DIR, check_s: float = MODEL_CHECK_S):
+        self.model_dir = model_dir
+        self.check_s = float(check_s)
+        self._current: Optional[LoadedModel] = None
+        self._checked_at = 0.0
+        self._load_lock = threading.Lock()
+        self._reloading = False
+        self.reloads = 0
+        self.load_errors = 0
+        self.last_error: Optional[str] = None
+
+    # ---------------- lecture ----------------
+    def peek(self) -> Optional[LoadedModel]:
+        """Modèle courant sans aucune vérification (None si jamais chargé)."""
+        return self._current
+
+    def current(self) -> Optional[LoadedModel]:
+        """Modèle courant ; déclenche une vérification en arrière-plan si l'intervalle est écoulé."""
+        cur = self._current
+        if cur is None:
+            return self.reload()
+        if time.monotonic() - self._checked_at > self.check_s and not self._reloading:
+            self._checked_at = time.monotonic()
+            self._reloading = True
+            threading.Thread(target=self._background_check, name="dkt-reload", daemon=True).start()
+        return cur
+
+    def get(self) -> LoadedModel:
+        cur = self.current()
+        if cur is None:
+            raise RuntimeError(f"DKT model not found in {self.model_dir} (train it via POST /train/dkt)")
+        return cur
+
+    # ---------------- chargement ----------------
+    def _fingerprint(self):
+        """(mtime_ns, taille) de la meta et du checkpoint ; None si l'un manque."""
+        try:
+            m, p = os.stat(meta_path(self.model_dir)), os.stat(model_path(self.model_dir))
+        except OSError:
+            return None
+        return (m.st_mtime_ns, m.st_size, p.st_mtime_ns, p.st_size)
+
+    def _background_check(self):
+        try:
+            self.reload()
+        finally:
+            self._reloading = False
+
+    def reload(self, force: bool = False) -> Optional[LoadedModel]:
+        """
+        Recharge si l'empreinte a changé (ou `force`). En cas d'échec (fichiers en cours
+        d'écriture, meta incohérente...), le modèle courant reste servi.
+        """
+        with self._load_lock:
+            self._checked_at = time.monotonic()
+            fp = self._fingerprint()
+            cur = self._current
+            if fp is None or (not force and cur is not None and cur.fingerprint == fp):
+                return cur
+            if cur is not None and not force and fp[0] < fp[2]:
+                # checkpoint plus récent que la meta : publication en cours (train_dkt écrit la meta en dernier)
+                return cur
+            try:
+                loaded = self._load(fp)
+            except Exception as e:
+                self.load_errors += 1
+                self.last_error = str(e)
+                return cur
+            self._current = loaded  # swap atomique
+            self.reloads += 1
+            self.last_error = None
+            return loaded
+
+    def _load(self, fp) -> LoadedModel:
+        import torch  # import lourd différé au premier chargement de modèle
+        from models.dkt import build_dkt
+
+        with open(meta_path(self.model_dir), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        pt_path = model_path(self.model_dir)
+        model, backend = self._load_serving(meta), "serving"
+        if model is None:
+            model = build_dkt(int(meta["num_skills"]), arch=meta.get("arch") or "onehot",
+                              hidden_size=int(meta.get("hidden_size", 128)), embed_dim=int(meta.get("embed_dim") or 64))
+            model.load_state_dict(torch.load(pt_path, map_location="cpu"))
+            backend = "eager"
+        model.eval()
+        # le backend fait partie de la version : les états int8 et float32 ne se mélangent pas
+        version = f"{meta.get('trained_at') or int(os.path.getmtime(pt_path))}:{backend}"
+        return LoadedModel(model, meta, version, backend, fp)
+
+    def _load_serving(self, meta: Dict[str, Any]):
+        """
+        Artefact TorchScript (éventuellement quantifié int8) écrit par train_dkt, s'il existe
+        et si sa parité mesurée à l'entraînement est acceptable ; sinon None (modèle eager).
+        """
+        import torch
+
+        serving = meta.get("serving") or {}
+        if not DKT_USE_SERVING or not serving.get("file"):
+            return None
+        path = os.path.join(self.model_dir, serving["file"])
+        max_diff = (serving.get("parity") or {}).get("max_abs_diff")
+        if not os.path.exists(path) or max_diff is None or max_diff > DKT_SERVING_MAX_DIFF:
+            return None
+        try:
+            return torch.jit.load(path, map_location="cpu")
+        except Exception:
+            return None
+
+    # ---------------- infos ----------------
+    def info(self) -> Dict[str, Any]:
+        """Infos modèle sans relire le disque (hormis un stat si rien n'est chargé)."""
+        cur = self._current
+        fp = cur.fingerprint if cur is not None else self._fingerprint()
+        meta = cur.meta if cur is not None else {}
+        return {
+            "model_dir": self.model_dir,
+            "model_file": model_path(self.model_dir),
+            "meta_file": meta_path(self.model_dir),
+            "exists": fp is not None,
+            "loaded": cur is not None,
+            "updated_at_epoch": int(max(fp[0], fp[2]) // 1_000_000_000) if fp else 0,
+            "num_skills": meta.get("num_skills"),
+            "trained_at": meta.get("trained_at"),
+            "version": cur.version if cur is not None else None,
+            "backend": cur.backend if cur is not None else None,
+            "serving": meta.get("serving"),
+            "reloads": self.reloads,
+            "load_errors": self.load_errors,
+            "last_error": self.last_error,
+        }
+
+
+_registry: Optional[ModelRegistry] = None
+_registry_lock = threading.Lock()
+
+def get_registry() -> ModelRegistry:
+    """Registre partagé par tout le process (service, métriques, évaluation)."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry()
+    return _registry
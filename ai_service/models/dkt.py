@@ -1,7 +1,27 @@
+from typing import Optional, Tuple
+
 import torch
 import torch.nn as nn
 
-class DKT(nn.Module):
+State = Optional[Tuple[torch.Tensor, torch.Tensor]]
+
+class _LSTMBase(nn.Module):
+    """Socle commun des variantes DKT (attend un sous-module self.lstm)."""
+
+    def _lstm_out(self, x, lengths: Optional[torch.Tensor] = None):
+        """
+        Sorties LSTM [B, T, H]. Avec `lengths`, le lot est empaqueté (pack_padded_sequence) :
+        aucun calcul sur le padding, sorties nulles aux pas de padding.
+        """
+        if lengths is None:
+            out, _ = self.lstm(x)
+            return out
+        packed = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        out, _ = self.lstm(packed)
+        out, _ = nn.utils.rnn.pad_packed_sequence(out, batch_first=True, total_length=x.size(1))
+        return out
+
+class DKT(_LSTMBase):
     """
     Deep Knowledge Tracing (DKT) via LSTM.
     Input:  one-hot concat (skill_correct, skill_incorrect) of size 2*K
@@ -12,15 +32,142 @@ class DKT(nn.Module):
     def __init__(self, num_skills: int, hidden_size: int = 128, dropout: float = 0.1):
         super().__init__()
         self.num_skills = num_skills
+        self.input_kind = "onehot"  # voir model_input
         self.input_size = 2 * num_skills
         self.lstm = nn.LSTM(self.input_size, hidden_size, batch_first=True)
         self.drop = nn.Dropout(dropout)
         self.out = nn.Linear(hidden_size, num_skills)
         self.sigmoid = nn.Sigmoid()
 
-    def forward(self, x, lengths=None):
-        # x: [B, T, 2K]
-        packed_out, _ = self.lstm(x)  # [B, T, H]
+    def forward(self, x, lengths: Optional[torch.Tensor] = None):
+        # x: [B, T, 2K] ; lengths [B] (optional): padded steps are skipped via packing
+        packed_out = self._lstm_out(x, lengths)  # [B, T, H]
         h = self.drop(packed_out)
         y = self.out(h)               # [B, T, K]
         return self.sigmoid(y)        # probabilities
+
+    @torch.jit.export
+    def forward_with_state(self, x, state: State = None):
+        """
+        Comme forward, mais part de `state` = (h, c) et le renvoie :
+        permet d'avancer l'état de connaissance pas à pas (inférence incrémentale).
+        """
+        out, state = self.lstm(x, state)  # [B, T, H]
+        y = self.out(self.drop(out))      # [B, T, K]
+        return self.sigmoid(y), state
+
+    @torch.jit.export
+    def forward_last(self, x, lengths, state: State = None):
+        """
+        Lot de séquences de longueurs variables (padding à droite) : renvoie seulement
+        p(correct) au dernier pas réel de chaque séquence ([B, K]) et l'état final (h, c)
+        de chacune. Le padding est ignoré via pack_padded_sequence.
+        """
+        packed = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        _, (h, c) = self.lstm(packed, state)  # h: [1, B, H] = sortie au dernier pas réel
+        y = self.out(self.drop(h[-1]))       # [B, K]
+        return self.sigmoid(y), (h, c)
+
+
+class DKTEmbed(_LSTMBase):
+    """
+    Variante DKT à entrée par indices d'interaction (skill si correct, K + skill sinon)
+    via nn.Embedding(2K, d) : la projection d'entrée ne dépend plus de K.
+    Mêmes sorties et même API de service que DKT (forward / forward_with_state /
+    forward_last, tête complète sur K) ; à l'entraînement, target_logits ne calcule
+    que le logit du skill effectivement répondu au pas suivant.
+    Input:  indices [B, T] (long)
+    Output: per time step, predicted P(correct) for each skill, shape [B, T, K]
+    """
+    def __init__(self, num_skills: int, hidden_size: int = 128, embed_dim: int = 64, dropout: float = 0.1):
+        super().__init__()
+        self.num_skills = num_skills
+        self.input_kind = "index"
+        self.embed = nn.Embedding(2 * num_skills, embed_dim)
+        self.lstm = nn.LSTM(embed_dim, hidden_size, batch_first=True)
+        self.drop = nn.Dropout(dropout)
+        self.out = nn.Linear(hidden_size, num_skills)
+        self.sigmoid = nn.Sigmoid()
+
+    def forward(self, codes, lengths: Optional[torch.Tensor] = None):
+        out = self._lstm_out(self.embed(codes), lengths)  # [B, T, H]
+        return self.sigmoid(self.out(self.drop(out)))          # [B, T, K]
+
+    @torch.jit.export
+    def forward_with_state(self, codes, state: State = None):
+        out, state = self.lstm(self.embed(codes), state)
+        return self.sigmoid(self.out(self.drop(out))), state
+
+    @torch.jit.export
+    def forward_last(self, codes, lengths, state: State = None):
+        packed = nn.utils.rnn.pack_padded_sequence(self.embed(codes), lengths.cpu(), batch_first=True,
+                                                   enforce_sorted=False)
+        _, (h, c) = self.lstm(packed, state)
+        return self.sigmoid(self.out(self.drop(h[-1]))), (h, c)
+
+    def target_logits(self, codes, next_skill, lengths: Optional[torch.Tensor] = None):
+        """
+        Entraînement : logit du seul skill répondu au pas suivant ([B, T]) — produit
+        scalaire avec la ligne correspondante de la tête, au lieu des K logits.
+        """
+        out = self._lstm_out(self.embed(codes), lengths)  # [B, T, H]
+        h = self.drop(out)
+        w = self.out.weight[next_skill]           # [B, T, H]
+        return (h * w).sum(-1) + self.out.bias[next_skill]
+
+
+def build_dkt(num_skills: int, arch: str = "onehot", hidden_size: int = 128, embed_dim: int = 64,
+              dropout: float = 0.1) -> nn.Module:
+    """Instancie la variante décrite par la meta (arch = "onehot" | "embed")."""
+    if arch == "embed":
+        return DKTEmbed(num_skills, hidden_size=hidden_size, embed_dim=embed_dim, dropout=dropout)
+    return DKT(num_skills, hidden_size=hidden_size, dropout=dropout)
+
+
+def _interaction_rows(old_k: int, new_k: int) -> torch.Tensor:
+    """Position, dans l'espace 2*new_k, des 2*old_k interactions (correct puis incorrect)."""
+    idx = torch.arange(2 * old_k)
+    return torch.where(idx < old_k, idx, idx - old_k + new_k)
+
+def grow_skills(model: nn.Module, num_skills: int) -> nn.Module:
+    """
+    Nouveau modèle sur `num_skills` >= K skills, initialisé depuis `model` (warm start) :
+    les skills existants gardent leurs indices et leurs poids, les nouveaux (ajoutés en
+    fin, K..num_skills-1) partent d'une entrée nulle (one-hot) ou d'un embedding neuf,
+    et d'une ligne de tête fraîchement initialisée.
+    """
+    old_k = int(model.num_skills)
+    if num_skills < old_k:
+        raise ValueError(f"cannot shrink DKT from {old_k} to {num_skills} skills")
+    arch = "embed" if model.input_kind == "index" else "onehot"
+    embed_dim = model.embed.embedding_dim if arch == "embed" else 64
+    new = build_dkt(num_skills, arch=arch, hidden_size=model.lstm.hidden_size, embed_dim=embed_dim,
+                    dropout=model.drop.p)
+    old_sd, sd = model.state_dict(), new.state_dict()
+    rows = _interaction_rows(old_k, num_skills)
+    with torch.no_grad():
+        for name, t in old_sd.items():
+            if name == "lstm.weight_ih_l0" and arch == "onehot":
+                sd[name].zero_()
+                sd[name][:, rows] = t  # colonnes = interactions
+            elif name == "embed.weight":
+                sd[name][rows] = t
+            elif name in ("out.weight", "out.bias"):
+                sd[name][:old_k] = t
+            else:
+                sd[name].copy_(t)
+    new.load_state_dict(sd)
+    return new
+
+
+def model_input(model, codes: torch.Tensor) -> torch.Tensor:
+    """
+    Indices d'interaction [B, T] (long) -> entrée attendue par `model` : les indices
+    tels quels (DKTEmbed) ou leur one-hot [B, T, 2K] (DKT). Valable aussi pour les
+    modèles TorchScript (attribut input_kind conservé).
+    Les positions de padding sont ignorées par les appelants (masque ou pack).
+    """
+    if getattr(model, "input_kind", "onehot") == "index":
+        return codes
+    return nn.functional.one_hot(codes, 2 * int(model.num_skills)).float()
+
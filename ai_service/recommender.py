@@ -1,12 +1,20 @@
 import os
+import bisect
 import random
+import threading
 import datetime as dt
 from typing import List, Dict, Any
 from pymongo import MongoClient
 import json
-import torch
 import numpy as np
-from models.dkt import DKT
+from model_registry import LoadedModel, get_registry
+from history_cache import UserHistoryCache
+from catalog import QuestionCatalog
+from seen import SeenStore, new_seen_filter, SEEN_PERSIST
+from knowledge_state import KnowledgeState, KnowledgeStateStore
+from dkt_batcher import DKTBatcher
+from response_writer import ResponseWriter
+from theme_rollups import THEME_ROLLUPS, rollups_usable, theme_counters as rollup_theme_counters
 
 # ----------------------- Config -----------------------
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
@@ -34,16 +42,19 @@ def _connect_db():
 
 # ----------------------- Helpers -----------------------
 def _as_dt(x):
-    """Parse des dates hétérogènes en datetime (UTC) ou None."""
+    """Parse des dates hétérogènes en datetime UTC naïf (comme pymongo) ou None."""
     if isinstance(x, dt.datetime):
-        return x
-    if x is None:
-        return None
-    s = str(x)
-    try:
-        return dt.datetime.fromisoformat(s.replace("Z", ""))
-    except Exception:
+        d = x
+    elif x is None:
         return None
+    else:
+        try:
+            d = dt.datetime.fromisoformat(str(x).replace("Z", "+00:00"))
+        except Exception:
+            return None
+    if d.tzinfo is not None:
+        d = d.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return d
 
 def _norm_bool(v) -> bool:
     """Convertit diverses représentations en booléen."""
@@ -86,11 +97,33 @@ def _normalize_event(doc: Dict[str, Any], qp: Dict[str, Any] = None) -> Dict[str
         "ts": _as_dt(ts),
     }
 
-def iter_user_history(db, user_id: str):
+def _normalize_response(resp: Dict[str, Any], q: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Normalise une réponse de la collection `responses` (écrite par /response,
+    /simulate/session ou le seed) sur le même format que `_normalize_event`.
+    - q : document question (theme, difficulty) ou None si inconnue
+    """
+    rt = resp.get("response_time_ms", resp.get("response_time"))
+    return {
+        "theme": (q or {}).get("theme"),
+        "difficulty": (q or {}).get("difficulty"),
+        "question_id": resp.get("question_id"),
+        "correct": _norm_bool(resp.get("is_correct")),
+        "response_time_ms": (rt if isinstance(rt, (int, float)) else None),
+        "ts": _as_dt(resp.get("answered_at")),
+    }
+
+def iter_user_history(db, user_id: str, sessions: set = None, catalog=None, response_ids: set = None):
     """
     Itère l'historique fusionné de l'utilisateur :
       - sessions complètes avec questions_played[] (Game/Kahoot)
       - événements 'training' légers (user-sessions/record)
+      - réponses unitaires (`responses`) des sessions ouvertes côté IA
+        (/session/start, /response), qui n'ont pas de questions_played[]
+
+    - sessions : si fourni, reçoit les user_session_id rencontrés
+    - response_ids : si fourni, reçoit les _id des réponses unitaires lues
+    - catalog  : QuestionCatalog optionnel pour résoudre theme/difficulty sans requête
     """
     coll = db["usersessions"]
     cur = coll.find(
@@ -100,10 +133,14 @@ def iter_user_history(db, user_id: str):
             "question_id": 1, "correct": 1, "response_time_ms": 1,
             "questions_played": 1,
             "createdAt": 1, "end_time": 1, "start_time": 1,
-            "source": 1,
+            "source": 1, "user_session_id": 1,
         },
     )
+    bare_sessions = []
     for doc in cur:
+        sid = doc.get("user_session_id")
+        if sid and sessions is not None:
+            sessions.add(sid)
         qps = doc.get("questions_played") or []
         if qps:
             for qp in qps:
@@ -111,41 +148,209 @@ def iter_user_history(db, user_id: str):
         else:
             if doc.get("question_id"):
                 yield _normalize_event(doc, qp=None)
+            elif sid:
+                bare_sessions.append(sid)
+
+    if not bare_sessions:
+        return
+    resps = list(db["responses"].find(
+        {"session_id": {"$in": bare_sessions}},
+        {"_id": 1, "question_id": 1, "is_correct": 1, "response_time": 1, "answered_at": 1},
+    ))
+    if response_ids is not None:
+        response_ids.update(r["_id"] for r in resps)
+    if catalog is not None:
+        qlookup = catalog.snapshot().get
+    else:
+        qids = list({r.get("question_id") for r in resps if r.get("question_id")})
+        qlookup = {q["question_id"]: q for q in db["questions"].find(
+            {"question_id": {"$in": qids}}, {"_id": 0, "question_id": 1, "theme": 1, "difficulty": 1}
+        )}.get if qids else {}.get
+    for r in resps:
+        yield _normalize_response(r, qlookup(r.get("question_id")))
+
+def _event_ts_key(ev):
+    return ev.get("ts") or dt.datetime.min
 
-def _all_seen_question_ids(db, user_id: str) -> set:
-    """Toutes les questions vues (Game + Training)."""
-    seen = set()
-    for ev in iter_user_history(db, user_id):
-        if ev.get("question_id"):
-            seen.add(ev["question_id"])
-    return seen
-
-def _recent_seen_question_ids(db, user_id: str, last_events: int = 20) -> set:
-    """Questions vues sur les N derniers événements (Game + Training)."""
-    events = list(iter_user_history(db, user_id))
-    events.sort(key=lambda e: (e["ts"] or dt.datetime.min), reverse=True)
-    s = set()
-    for ev in events[:last_events]:
-        if ev.get("question_id"):
-            s.add(ev["question_id"])
-    return s
-
-def _recent_mastered_question_ids(db, user_id: str, correct_min: int = 2, window_events: int = 6) -> set:
+class UserHistory:
     """
-    Questions répondues correctement au moins `correct_min` fois
-    sur les `window_events` derniers événements (Game + Training).
-    => On les considère ‘maîtrisées récemment’ et on les exclut.
+    Instantané de l'historique fusionné d'un utilisateur (Game + Training),
+    construit en UN SEUL passage sur le curseur `usersessions`.
+
+    Partagé par toutes les étapes d'une requête (stats, exclusions, DKT, métriques)
+    pour ne plus relire Mongo ni re-parser les dates à chaque helper.
+
+    Un historique en cache est complété par /response pendant que d'autres requêtes
+    le lisent : les mutations se font sous `lock`, et les lectures passent par les
+    copies (events_snapshot, seen_snapshot, ...) prises sous ce même verrou.
     """
-    events = list(iter_user_history(db, user_id))
-    events.sort(key=lambda e: (e.get("ts") or dt.datetime.min), reverse=True)
-    counts = {}
-    for ev in events[:window_events]:
+
+    def __init__(self, user_id: str, events, now: dt.datetime = None, sessions: set = None,
+                 response_ids: set = None):
+        self.user_id = str(user_id)
+        self.now = now or dt.datetime.utcnow()
+        self.recent_from = self.now - dt.timedelta(days=WINDOW)
+        self.prev_from = self.now - dt.timedelta(days=2 * WINDOW)
+
+        self.events: List[Dict[str, Any]] = []   # ordre chronologique
+        self.seen: set = set()
+        self.played_themes: set = set()
+        self.sessions: set = sessions if sessions is not None else set()  # user_session_id connus
+        self.response_ids: set = response_ids if response_ids is not None else set()  # _id `responses` comptés
+        self.seen_filter = None  # bitset/Bloom des questions vues (cf. Recommender.seen_mask)
+        # theme -> compteurs globaux / fenêtre récente / fenêtre précédente
+        self.theme_counters: Dict[str, Dict[str, float]] = {}
+        self.lock = threading.RLock()
+        self.version = 0  # incrémenté à chaque ajout
+
+        for ev in events:
+            self.events.append(ev)
+            self._accumulate(ev)
+        self.events.sort(key=_event_ts_key)
+
+    @classmethod
+    def load(cls, db, user_id: str, catalog=None, pending=None) -> "UserHistory":
+        """
+        - pending : user_id -> réponses (format `responses`) acceptées mais pas encore
+          écrites (ResponseWriter.pending_for). Lu avant ET après Mongo : une réponse
+          écrite entre-temps est dans l'une des deux lectures, les doublons sont
+          écartés par _id.
+        """
+        sessions, response_ids = set(), set()
+        before = pending(user_id) if pending is not None else []
+        # `sessions` n'est rempli qu'une fois le générateur consommé
+        events = list(iter_user_history(db, user_id, sessions=sessions, catalog=catalog,
+                                        response_ids=response_ids))
+        if pending is not None:
+            lookup = catalog.snapshot().get if catalog is not None else (lambda _qid: None)
+            for r in before + pending(user_id):
+                if r["_id"] in response_ids:
+                    continue
+                response_ids.add(r["_id"])
+                sessions.add(r.get("session_id"))
+                events.append(_normalize_response(r, lookup(r.get("question_id"))))
+        return cls(user_id, events, sessions=sessions, response_ids=response_ids)
+
+    def append(self, ev: Dict[str, Any], response_id=None):
+        """
+        Ajout incrémental (write-through depuis /response) : maintient l'ordre
+        chronologique et les compteurs sans relire Mongo. Un événement postérieur
+        au snapshot compte dans la fenêtre récente.
+        - response_id : _id de la réponse ; déjà présente (lue par load, via Mongo ou
+          le tampon d'écriture) -> ignorée, renvoie None.
+        Renvoie (nb d'événements après l'ajout, ajouté en fin de séquence ?).
+        """
+        key = _event_ts_key(ev)
+        with self.lock:
+            if response_id is not None:
+                if response_id in self.response_ids:
+                    return None
+                self.response_ids.add(response_id)
+            tail = not self.events or key >= _event_ts_key(self.events[-1])
+            if tail:
+                self.events.append(ev)
+            else:
+                bisect.insort(self.events, ev, key=_event_ts_key)
+            self._accumulate(ev, clamp_now=True)
+            self.version += 1
+            return len(self.events), tail
+
+    def add_session(self, session_id: str):
+        with self.lock:
+            self.sessions.add(session_id)
+
+    def has_session(self, session_id: str) -> bool:
+        with self.lock:
+            return session_id in self.sessions
+
+    # ---- lectures cohérentes (copies prises sous verrou) ----
+    def events_snapshot(self):
+        """(copie des événements, version) : séquence cohérente même si une réponse arrive."""
+        with self.lock:
+            return list(self.events), self.version
+
+    def seen_snapshot(self) -> set:
+        with self.lock:
+            return set(self.seen)
+
+    def played_themes_snapshot(self) -> set:
+        with self.lock:
+            return set(self.played_themes)
+
+    def counters_snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {t: dict(c) for t, c in self.theme_counters.items()}
+
+    def _accumulate(self, ev: Dict[str, Any], clamp_now: bool = False):
         qid = ev.get("question_id")
-        if not qid:
-            continue
-        if ev.get("correct") is True:
-            counts[qid] = counts.get(qid, 0) + 1
-    return {qid for qid, c in counts.items() if c >= correct_min}
+        if qid:
+            self.seen.add(qid)
+
+        theme = ev.get("theme")
+        if not theme:
+            return
+        self.played_themes.add(theme)
+
+        ts = ev.get("ts") or self.now
+        if clamp_now and ts > self.now:
+            ts = self.now
+        corr = bool(ev.get("correct", False))
+        rt = ev.get("response_time_ms")
+
+        c = self.theme_counters.get(theme)
+        if c is None:
+            c = self.theme_counters[theme] = {
+                "attempts": 0, "correct": 0, "time": 0.0,
+                "r_attempts": 0, "r_correct": 0,
+                "p_attempts": 0, "p_correct": 0,
+            }
+
+        # Global
+        c["attempts"] += 1
+        if corr:
+            c["correct"] += 1
+        if isinstance(rt, (int, float)):
+            c["time"] += float(rt)
+
+        # Récente
+        if self.recent_from <= ts <= self.now:
+            c["r_attempts"] += 1
+            if corr:
+                c["r_correct"] += 1
+
+        # Précédente
+        if self.prev_from < ts <= self.recent_from:
+            c["p_attempts"] += 1
+            if corr:
+                c["p_correct"] += 1
+
+    def __bool__(self):
+        with self.lock:
+            return bool(self.events)
+
+    def latest(self, n: int) -> List[Dict[str, Any]]:
+        """Les `n` derniers événements, du plus récent au plus ancien."""
+        with self.lock:
+            return self.events[-n:][::-1] if n > 0 else []
+
+    def recent_seen(self, last_events: int = 20) -> set:
+        """Questions vues sur les N derniers événements (Game + Training)."""
+        return {ev["question_id"] for ev in self.latest(last_events) if ev.get("question_id")}
+
+    def recent_mastered(self, correct_min: int = 2, window_events: int = 6) -> set:
+        """
+        Questions répondues correctement au moins `correct_min` fois
+        sur les `window_events` derniers événements (Game + Training).
+        => On les considère ‘maîtrisées récemment’ et on les exclut.
+        """
+        counts = {}
+        for ev in self.latest(window_events):
+            qid = ev.get("question_id")
+            if not qid:
+                continue
+            if ev.get("correct") is True:
+                counts[qid] = counts.get(qid, 0) + 1
+        return {qid for qid, c in counts.items() if c >= correct_min}
 
 def _diversify(items, max_per_theme: int = 2):
     """Ré-ordonne/filtre pour éviter 5 items du même thème à la suite."""
@@ -164,6 +369,23 @@ def _diversify(items, max_per_theme: int = 2):
                     break
     return out
 
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices des k meilleurs scores, triés par score décroissant, ex-aequo départagés
+    par indice croissant (même résultat qu'un tri stable complet) — via argpartition.
+    """
+    n = scores.size
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        kth = scores[np.argpartition(scores, n - k)[n - k]]  # k-ième plus grande valeur
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - above.size]
+        sel = np.concatenate([above, ties])
+    else:
+        sel = np.arange(n)
+    return sel[np.lexsort((sel, -scores[sel]))]
+
 # ----------------------- Recommender -----------------------
 class Recommender:
     """
@@ -175,9 +397,150 @@ class Recommender:
 
     def __init__(self):
         self.client, self.db = _connect_db()
+        self.models = get_registry()   # modèle DKT partagé par le process (rechargement à chaud)
+        self._dkt_version = None       # dernière version vue (purge des états à chaque changement)
+        self.dkt_states = KnowledgeStateStore(self.db)
+        self.dkt_batcher = DKTBatcher()  # inférence DKT regroupée entre requêtes concurrentes
+        self.catalog = QuestionCatalog(self.db)
+        self.seen_store = SeenStore(self.db)
+        self._post: Dict[str, List[Dict[str, Any]]] = {}  # user_id -> réponses à répercuter (cf. _apply_post_writes)
+        self._post_lock = threading.Lock()
+        # écritures de /response regroupées (write-behind) ; entretient les cumuls par thème si activés
+        self.response_writer = ResponseWriter(self.db, rollup_event=self._rollup_event if THEME_ROLLUPS else None)
+        self.histories = UserHistoryCache(loader=lambda uid: UserHistory.load(
+            self.db, uid, catalog=self.catalog, pending=self.response_writer.pending_for))
+
+    # ----------------- HISTORIQUE -----------------
+    def user_history(self, user_id: str) -> UserHistory:
+        """Snapshot de l'historique (cache LRU/TTL, sinon 1 passage Mongo), à partager au sein d'une requête."""
+        return self.histories.get(user_id)
+
+    def note_session(self, user_id: str, session_id: str):
+        """Write-through : session créée/connue pour cet utilisateur."""
+        self.histories.add_session(user_id, session_id)
+
+    def note_response(self, user_id: str, resp: Dict[str, Any], question: Dict[str, Any] = None):
+        """
+        Write-through : ajoute une réponse (format `responses`) à l'historique en cache.
+        Utilisateur hors cache : rien à compléter (un chargement en cours est écarté, cf. UserHistoryCache.append).
+        `resp` doit porter le même _id que le document soumis à response_writer : une
+        réponse déjà lue au chargement de l'historique n'est pas comptée deux fois.
+        Seuls l'historique et le filtre des questions vues sont mis à jour ici (mémoire) ;
+        les bits `user_seen` et le pas DKT sont faits par le thread d'écriture (_apply_post_writes).
+        """
+        cat = self.catalog.snapshot()
+        q = question or cat.get(resp.get("question_id"))
+        ev = _normalize_response(resp, q)
+        placed = self.histories.append(user_id, ev, response_id=resp.get("_id"))
+        if placed is None:
+            return
+        n_after, tail = placed
+
+        hist = self.histories.peek(user_id)
+        filt = hist.seen_filter if hist is not None else None
+        updates = []
+        if filt is not None:
+            with hist.lock:
+                updates = filt.add(cat, [resp.get("question_id")])
+        item = {"ev": ev, "n": n_after, "tail": tail, "hist": hist, "filt": filt, "updates": updates}
+        with self._post_lock:
+            first = not self._post
+            self._post.setdefault(str(user_id), []).append(item)
+        if first:
+            self.response_writer.defer(self._apply_post_writes)
+
+    def _apply_post_writes(self) -> int:
+        """
+        Répercute les réponses notées depuis le dernier passage (thread d'écriture) :
+        par utilisateur, UN $bit fusionné sur `user_seen` et UNE avance DKT de
+        plusieurs pas ; les avances de tous les utilisateurs partagent un lot LSTM.
+        Renvoie le nb d'opérations Mongo.
+        """
+        with self._post_lock:
+            work, self._post = self._post, {}
+        ops = 0
+        dkt = self.models.peek()
+        steps = []
+        for user_id, items in work.items():
+            if SEEN_PERSIST:
+                ops += self._persist_seen(user_id, items)
+            if dkt is not None:
+                step = self._dkt_advance(user_id, items, dkt)
+                if step is not None:
+                    steps.append(step)
+        persisted = self.dkt_states.coll is not None
+        for user_id, st, n, fut in steps:
+            if fut is None:
+                if n is None:
+                    self.dkt_states.invalidate(user_id)
+                else:
+                    self.dkt_states.put(user_id, KnowledgeState(st.h, st.c, st.p, n, st.model_version))
+            else:
+                try:
+                    p, (h, c) = fut.result()
+                except Exception:
+                    self.dkt_states.invalidate(user_id)  # reconstruit à la prochaine prédiction
+                else:
+                    self.dkt_states.put(user_id, KnowledgeState(h, c, p, n, st.model_version))
+            ops += 1 if persisted else 0
+        return ops
+
+    def _persist_seen(self, user_id: str, items: List[Dict[str, Any]]) -> int:
+        merged: Dict[int, int] = {}
+        hist = filt = None
+        for it in items:
+            if it["updates"]:
+                hist, filt = it["hist"], it["filt"]
+                for w, m in it["updates"]:
+                    merged[w] = merged.get(w, 0) | m
+        if not merged:
+            return 0
+        try:
+            if max(merged) >= getattr(filt, "persisted_words", 0):
+                with hist.lock:  # tableau agrandi : réécrit en entier, à l'abri d'un filt.add concurrent
+                    self.seen_store.add_bits(user_id, filt, sorted(merged.items()))
+            else:
+                self.seen_store.add_bits(user_id, filt, sorted(merged.items()))
+        except Exception:
+            # les réponses sont déjà écrites : on repartira de l'historique au prochain chargement
+            self.histories.invalidate(user_id)
+        return 1
+
+    def seen_mask(self, hist: UserHistory, cat) -> np.ndarray:
+        """
+        Masque (aligné sur le catalogue) des questions déjà vues, via un bitset
+        (ou Bloom) persisté par utilisateur. Chargé une fois par historique en cache,
+        complété depuis l'historique (écritures faites hors ai_service) puis
+        mis à jour incrémentalement par /response.
+        """
+        filt = hist.seen_filter
+        if filt is None:
+            loaded = self.seen_store.load(hist.user_id, cat) if SEEN_PERSIST else None
+            fresh = loaded is None
+            with hist.lock:
+                filt = hist.seen_filter
+                if filt is None:
+                    filt = new_seen_filter(cat) if fresh else loaded
+                    added = filt.add(cat, hist.seen)
+                    hist.seen_filter = filt
+                else:
+                    fresh, added = False, []  # posé entre-temps par une requête concurrente
+            if SEEN_PERSIST and (fresh or added):
+                self.seen_store.save(hist.user_id, filt)
+        with hist.lock:
+            return filt.mask(cat)
+
+    def _rollup_event(self, resp: Dict[str, Any]) -> Dict[str, Any]:
+        """Réponse écrite -> événement normalisé (thème via le catalogue) pour les cumuls journaliers."""
+        return _normalize_response(resp, self.catalog.snapshot().get(resp.get("question_id")))
+
+    def session_known(self, user_id: str, session_id: str) -> bool:
+        """Session déjà vue dans l'historique en cache (évite un find_one)."""
+        hist = self.histories.peek(user_id)
+        return hist is not None and hist.has_session(session_id)
 
     # ----------------- ANALYSE PAR THEME -----------------
-    def user_theme_stats(self, user_id: str) -> List[Dict[str, Any]]:
+    def user_theme_stats(self, user_id: str, history: UserHistory = None) -> List[Dict[str, Any]]:
         """
         Taux de réussite, nb d’essais, temps moyen, et tendance récente par thème.
         Basé sur l'historique fusionné (Game + Training).
@@ -185,59 +548,32 @@ class Recommender:
         Tendance = delta du taux de réussite entre
           - fenêtre récente: [now - WINDOW, now]
           - fenêtre précédente: ]now - 2*WINDOW, now - WINDOW]
-        """
-        now = dt.datetime.utcnow()
-        recent_from = now - dt.timedelta(days=WINDOW)
-        prev_from   = now - dt.timedelta(days=2 * WINDOW)
-        prev_to     = recent_from
-
-        evs = list(iter_user_history(self.db, user_id))
-
-        g_attempts, g_correct, g_time = {}, {}, {}
-        r_attempts, r_correct = {}, {}
-        p_attempts, p_correct = {}, {}
 
-        for e in evs:
-            theme = e.get("theme")
-            if not theme:
-                continue
-            ts = e.get("ts") or now
-            corr = bool(e.get("correct", False))
-            rt = e.get("response_time_ms")
+        THEME_ROLLUPS=1 : compteurs lus dans les cumuls journaliers (theme_rollups.py),
+        au plus 2*WINDOW + 1 jours + le cumul global par thème, quel que soit
+        l'historique ; `history` n'est alors pas utilisé, sauf si les cumuls de
+        l'utilisateur sont incomplets (rollups_usable : reconstruction en cours,
+        sessions écrites par le backend Node depuis la dernière reconstruction).
+        """
+        if THEME_ROLLUPS and rollups_usable(self.db, user_id):
+            counters = rollup_theme_counters(self.db, user_id, WINDOW)
+        else:
+            hist = history if history is not None else self.user_history(user_id)
+            counters = hist.counters_snapshot()
 
-            # Global
-            g_attempts[theme] = g_attempts.get(theme, 0) + 1
-            if corr:
-                g_correct[theme] = g_correct.get(theme, 0) + 1
-            if isinstance(rt, (int, float)):
-                g_time[theme] = g_time.get(theme, 0.0) + float(rt)
-
-            # Récente
-            if recent_from <= ts <= now:
-                r_attempts[theme] = r_attempts.get(theme, 0) + 1
-                if corr:
-                    r_correct[theme] = r_correct.get(theme, 0) + 1
-
-            # Précédente
-            if prev_from < ts <= prev_to:
-                p_attempts[theme] = p_attempts.get(theme, 0) + 1
-                if corr:
-                    p_correct[theme] = p_correct.get(theme, 0) + 1
-
-        themes = set(g_attempts.keys()) | set(r_attempts.keys()) | set(p_attempts.keys())
         out = []
-        for t in themes:
-            attempts = int(g_attempts.get(t, 0))
-            correct  = int(g_correct.get(t, 0))
-            avg_time = (g_time.get(t, 0.0) / attempts) if attempts > 0 else 0.0
+        for t, c in counters.items():
+            attempts = int(c["attempts"])
+            correct  = int(c["correct"])
+            avg_time = (c["time"] / attempts) if attempts > 0 else 0.0
             sr = (correct / attempts) if attempts > 0 else 0.0
 
-            attempts_r = int(r_attempts.get(t, 0))
-            correct_r  = int(r_correct.get(t, 0))
+            attempts_r = int(c["r_attempts"])
+            correct_r  = int(c["r_correct"])
             sr_recent  = (attempts_r and (correct_r / attempts_r)) or None
 
-            attempts_p = int(p_attempts.get(t, 0))
-            correct_p  = int(p_correct.get(t, 0))
+            attempts_p = int(c["p_attempts"])
+            correct_p  = int(c["p_correct"])
             sr_prev    = (attempts_p and (correct_p / attempts_p)) or None
 
             trend = None
@@ -276,7 +612,8 @@ class Recommender:
         return "difficile"
 
     # ----------------- RECOMMANDATIONS (heuristiques) ------------------
-    def recommended_questions(self, user_id: str, limit: int = 10, mix_ratio: float = 0.5) -> List[Dict[str, Any]]:
+    def recommended_questions(self, user_id: str, limit: int = 10, mix_ratio: float = 0.5,
+                              history: UserHistory = None) -> List[Dict[str, Any]]:
         """
         mix_ratio ~ proportion de 'révision' vs 'challenge' (0.5 = 50/50)
         Règles:
@@ -286,18 +623,36 @@ class Recommender:
             qu’EN FIN de sélection, et relâchées si ça vide tout
         - Fallbacks progressifs pour garantir au moins `limit` items
         """
-        stats = self.user_theme_stats(user_id)
+        hist = history if history is not None else self.user_history(user_id)
+        stats = self.user_theme_stats(user_id, history=hist)
         theme_by_name = {s["theme"]: s for s in stats}
         ordered_themes = list(theme_by_name.keys())
 
         # --- Exclusions “dures”
-        seen_all = _all_seen_question_ids(self.db, user_id)
-        mastered_recent = _recent_mastered_question_ids(self.db, user_id, correct_min=2, window_events=6)
-        exclude_hard = set(seen_all) | set(mastered_recent)
+        # Candidats tirés du catalogue en mémoire (pas d'aller-retour Mongo),
+        # exclusions = masques booléens alignés sur les positions du catalogue
+        cat = self.catalog.snapshot()
+        mastered_mask = np.zeros(len(cat), dtype=bool)
+        mastered_pos = [cat.pos_of[q] for q in hist.recent_mastered(correct_min=2, window_events=6)
+                        if q in cat.pos_of]
+        mastered_mask[mastered_pos] = True
+        exclude_hard = self.seen_mask(hist, cat) | mastered_mask
 
         # --- Exclusion “douce” (anti-répétition courte) appliquée A LA FIN
-        recent_seen = _recent_seen_question_ids(self.db, user_id, last_events=10)
+        recent_seen = hist.recent_seen(last_events=10)
+
+        def candidates(positions, exclude_mask) -> List[int]:
+            return positions[~exclude_mask[positions]].tolist()
 
+        def item(p: int, reason_type: str, reason: str, theme_mastery, target_difficulty) -> Dict[str, Any]:
+            q = cat.materialize(p)
+            q["reason_type"] = reason_type
+            q["reason"] = reason
+            q["theme_mastery"] = theme_mastery
+            q["target_difficulty"] = target_difficulty if target_difficulty is not None else q.get("difficulty")
+            return q
+
+        # paniers = (position, reason_type, reason, theme_mastery, target_difficulty), matérialisés après tirage
         pool_revision, pool_challenge = [], []
 
         def harder(d: str) -> str:
@@ -310,68 +665,41 @@ class Recommender:
             diff = self.target_difficulty(mastery)
 
             # Révision (diff courante)
-            for q in self.db.questions.find({
-                "theme": theme,
-                "difficulty": diff,
-                "question_id": {"$nin": list(exclude_hard)},
-            }, {"_id": 0}):
-                q = dict(q)
-                q["reason_type"] = "revision"
-                q["reason"] = f"Thème {theme} faiblement maîtrisé (mastery={mastery:.2f}). Révision en {diff}."
-                q["theme_mastery"] = round(mastery, 4)
-                q["target_difficulty"] = diff
-                pool_revision.append(q)
+            reason = f"Thème {theme} faiblement maîtrisé (mastery={mastery:.2f}). Révision en {diff}."
+            for p in candidates(cat.positions(theme, diff), exclude_hard):
+                pool_revision.append((p, "revision", reason, round(mastery, 4), diff))
 
             # Challenge (cran au-dessus)
             hd = harder(diff)
-            for q in self.db.questions.find({
-                "theme": theme,
-                "difficulty": hd,
-                "question_id": {"$nin": list(exclude_hard)},
-            }, {"_id": 0}):
-                q = dict(q)
-                q["reason_type"] = "challenge"
-                q["reason"] = f"Progression sur {theme}. Challenge en {hd}."
-                q["theme_mastery"] = round(mastery, 4)
-                q["target_difficulty"] = hd
-                pool_challenge.append(q)
+            reason = f"Progression sur {theme}. Challenge en {hd}."
+            for p in candidates(cat.positions(theme, hd), exclude_hard):
+                pool_challenge.append((p, "challenge", reason, round(mastery, 4), hd))
 
         # 2) Fallback #1 — rien dans révision/challenge
         if not pool_revision and not pool_challenge:
             # si l'utilisateur a de l'historique, évite "cold_start"
-            has_history = any(iter_user_history(self.db, user_id))
-            base_query = {"difficulty": "facile"}
-            if has_history:
-                played_themes = {e.get("theme") for e in iter_user_history(self.db, user_id) if e.get("theme")}
-                if played_themes:
-                    base_query = {"difficulty": "facile", "theme": {"$in": list(played_themes)}}
-
-            candidates = [q for q in self.db.questions.find(base_query, {"_id": 0})
-                        if q["question_id"] not in exclude_hard]
-            random.shuffle(candidates)
+            has_history = bool(hist)
+            base = cat.positions(difficulty="facile")
+            played_themes = hist.played_themes_snapshot() if has_history else set()
+            if played_themes:
+                played = {cat.themes.index(t) for t in played_themes if t in cat.themes}
+                base = base[np.isin(cat.theme[base], list(played))]
+
+            cands = candidates(base, exclude_hard)
+            random.shuffle(cands)
             out = []
-            for q in candidates[:limit]:
+            for p in cands[:limit]:
                 if has_history:
-                    q["reason_type"] = "revision"
-                    q["reason"] = "Révision douce sur vos thèmes joués."
+                    out.append(item(p, "revision", "Révision douce sur vos thèmes joués.", None, "facile"))
                 else:
-                    q["reason_type"] = "cold_start"
-                    q["reason"] = "Nouveau joueur : démarrage en facile."
-                q["theme_mastery"] = None
-                q["target_difficulty"] = "facile"
-                out.append(q)
+                    out.append(item(p, "cold_start", "Nouveau joueur : démarrage en facile.", None, "facile"))
 
             # si malgré tout c'est vide, relâche encore : n'exclure que “maîtrisées récemment”
             if not out:
-                candidates = [q for q in self.db.questions.find(base_query, {"_id": 0})
-                            if q["question_id"] not in mastered_recent]
-                random.shuffle(candidates)
-                out = candidates[:limit]
-                for q in out:
-                    q["reason_type"] = "refresh"
-                    q["reason"] = "Relance sans exclure tout l'historique."
-                    q["theme_mastery"] = None
-                    q["target_difficulty"] = q.get("difficulty")
+                cands = candidates(base, mastered_mask)
+                random.shuffle(cands)
+                out = [item(p, "refresh", "Relance sans exclure tout l'historique.", None, None)
+                       for p in cands[:limit]]
 
             return out[:limit]
 
@@ -380,22 +708,14 @@ class Recommender:
         random.shuffle(pool_challenge)
         k_rev = int(round(limit * mix_ratio))
         k_ch  = limit - k_rev
-        recos = pool_revision[:k_rev] + pool_challenge[:k_ch]
+        recos = [item(*e) for e in pool_revision[:k_rev] + pool_challenge[:k_ch]]
 
         # Complément si insuffisant
         if len(recos) < limit:
             missing = limit - len(recos)
-            extra = list(self.db.questions.find(
-                {"question_id": {"$nin": list(exclude_hard)}},
-                {"_id": 0}
-            ).limit(missing * 2))
+            extra = np.flatnonzero(~exclude_hard)[:missing * 2].tolist()
             random.shuffle(extra)
-            for q in extra:
-                q["reason_type"] = "fill"
-                q["reason"] = "Complément de panier."
-                q["theme_mastery"] = None
-                q["target_difficulty"] = q.get("difficulty")
-            recos += extra[:missing]
+            recos += [item(p, "fill", "Complément de panier.", None, None) for p in extra[:missing]]
 
         # Dédoublonner
         uniq = {}
@@ -415,97 +735,151 @@ class Recommender:
         recos = _diversify(recos, max_per_theme=2)
         return recos[:limit]
 
-        def _dkt_predict_vector(self, seq):
-            """
-            Given a user sequence, return vector p(correct) for next step for all skills (size K).
-            If no history, return uniform 0.6 baseline.
-            """
-            K = self._dkt_meta["num_skills"]
-            if len(seq) < 1:
-                return np.full(K, 0.6, dtype=np.float32)
-
-            # Build X of shape [1, T, 2K]
-            T = len(seq)
-            x = np.zeros((1, T, 2*K), dtype=np.float32)
-            for t in range(T):
-                s, c = seq[t]
-                if c == 1:
-                    x[0, t, s] = 1.0
-                else:
-                    x[0, t, K + s] = 1.0
-            x = torch.from_numpy(x)
-            with torch.no_grad():
-                yhat = self._dkt_model(x)   # [1, T, K]
-                p = yhat[0, -1, :].detach().cpu().numpy()  # last time step
-            return p
-
-    def recommended_questions_dkt(self, user_id: str, limit: int = 10, mix_ratio: float = 0.5):
+    # ----------------- DKT -----------------
+    def _load_dkt(self) -> LoadedModel:
+        """
+        Modèle DKT courant (registre du process). À garder pour toute la requête :
+        modèle et meta restent cohérents même si un rechargement intervient entre-temps.
+        """
+        dkt = self.models.get()
+        if dkt.version != self._dkt_version:
+            self._dkt_version = dkt.version
+            self.dkt_states.on_model_change(dkt.version)
+        return dkt
+
+    def _user_sequence_for_dkt(self, user_id: str, history: UserHistory = None, dkt: LoadedModel = None):
+        """Séquence chronologique [(skill_idx, correct)] de l'utilisateur (skill = theme|||difficulty)."""
+        dkt = dkt or self._load_dkt()
+        hist = history if history is not None else self.user_history(user_id)
+        events, _ = hist.events_snapshot()
+        return self._dkt_sequence(events, dkt)
+
+    @staticmethod
+    def _dkt_sequence(events: List[Dict[str, Any]], dkt: LoadedModel):
+        idx_of = dkt.skill2idx
+        seq = []
+        for ev in events:
+            sidx = idx_of.get(f"{ev.get('theme')}|||{ev.get('difficulty')}")
+            if sidx is not None:
+                seq.append((sidx, 1 if ev.get("correct") else 0))
+        return seq
+
+    def _dkt_predict_vector(self, seq, dkt: LoadedModel = None):
+        """
+        Given a user sequence, return vector p(correct) for next step for all skills (size K).
+        If no history, return uniform 0.6 baseline.
+        """
+        dkt = dkt or self._load_dkt()
+        if len(seq) < 1:
+            return np.full(dkt.num_skills, 0.6, dtype=np.float32)
+
+        p, _ = self.dkt_batcher.predict(dkt.model, seq)  # last time step
+        return p
+
+    def _dkt_user_vector(self, user_id: str, history: UserHistory = None, dkt: LoadedModel = None) -> np.ndarray:
+        """
+        p(correct) courant pour chaque skill, lu dans l'état de connaissance incrémental
+        (O(1) en longueur d'historique). L'état n'est reconstruit (1 passe LSTM sur
+        toute la séquence) qu'au premier appel, après un changement de modèle ou si
+        l'historique a divergé de l'état (n_events différent).
+        Passer `dkt` pour que le vecteur corresponde à la meta utilisée par l'appelant.
+        La séquence et son nombre d'événements sont lus dans la même copie ; si une
+        réponse arrive pendant la reconstruction, le résultat sert à cette requête
+        mais n'est pas gardé (il ne décrit plus l'historique courant).
+        """
+        dkt = dkt or self._load_dkt()
+        hist = history if history is not None else self.user_history(user_id)
+        events, version = hist.events_snapshot()
+        n = len(events)
+        st = self.dkt_states.get(hist.user_id, dkt.version)
+        if st is not None and st.n_events == n:
+            return st.p
+
+        seq = self._dkt_sequence(events, dkt)
+        if not seq:
+            st = KnowledgeState(None, None, np.full(dkt.num_skills, 0.6, dtype=np.float32), n, dkt.version)
+        else:
+            p, (h, c) = self.dkt_batcher.predict(dkt.model, seq)
+            st = KnowledgeState(h, c, p, n, dkt.version)
+        with hist.lock:
+            if hist.version == version:
+                self.dkt_states.put(hist.user_id, st, rebuilt=True)
+        return st.p
+
+    def _dkt_advance(self, user_id: str, items: List[Dict[str, Any]], dkt: LoadedModel):
+        """
+        Avance de l'état de connaissance pour les réponses `items` (dans l'ordre d'ajout
+        à l'historique). Les réponses déjà couvertes par l'état (reconstruit entre-temps)
+        sont sautées. Sans état, ou si une réponse a été insérée dans le passé, l'état est
+        abandonné : il sera reconstruit à la prochaine prédiction.
+        Renvoie None (rien à faire) ou (user_id, état, nb d'événements (None = abandon), Future du lot LSTM ou None).
+        """
+        st = self.dkt_states.get(user_id, dkt.version)
+        if st is None:
+            return None
+        n, seq = st.n_events, []
+        for it in items:
+            if it["n"] <= st.n_events:
+                continue
+            if not it["tail"] or it["n"] != n + 1:
+                return user_id, st, None, None
+            n += 1
+            ev = it["ev"]
+            sidx = dkt.skill2idx.get(f"{ev.get('theme')}|||{ev.get('difficulty')}")
+            if sidx is not None:  # skill hors mapping : absent de la séquence DKT
+                seq.append((sidx, 1 if ev.get("correct") else 0))
+        if n == st.n_events:
+            return None
+        fut = self.dkt_batcher.submit(dkt.model, seq, st.lstm_state) if seq else None
+        return user_id, st, n, fut
+
+    def recommended_questions_dkt(self, user_id: str, limit: int = 10, mix_ratio: float = 0.5,
+                                  history: UserHistory = None):
         """
         Recommande en maximisant l'apprentissage : viser p(correct) ≈ 0.6–0.7.
         On construit deux paniers:
           - revision: proche de 0.70
           - challenge: proche de 0.55
         """
-        self._load_dkt()
-
-        # Questions déjà vues (fusion : responses + training)
-        seen = _all_seen_question_ids(self.db, user_id)
-
-        seq = self._user_sequence_for_dkt(user_id)
-        p_vec = self._dkt_predict_vector(seq)  # size K
+        dkt = self._load_dkt()
+        hist = history if history is not None else self.user_history(user_id)
 
-        K = self._dkt_meta["num_skills"]
-        idx_of = self._dkt_meta["skill2idx"]  # str->idx
-
-        def target_score(p, target):
-            # plus proche du target => meilleur score
-            return -float((p - target) ** 2)
+        p_vec = self._dkt_user_vector(user_id, history=hist, dkt=dkt)  # size K
+        idx_of = dkt.skill2idx  # str->idx
 
         target_rev = 0.70
         target_ch  = 0.55
-        rev_pool, ch_pool = [], []
 
-        # Parcourir questions candidates (non vues)
-        cursor = self.db.questions.find({}, {"_id": 0})
-        for q in cursor:
-            qid = q["question_id"]
-            if qid in seen:
-                continue
-            key = f"{q['theme']}|||{q['difficulty']}"
-            if key not in idx_of:
-                continue
-            sidx = idx_of[key]
-            p = float(p_vec[sidx])
-
-            q_rev = dict(q)
-            q_rev["reason_type"] = "revision"
-            q_rev["reason"] = f"DKT: p(correct)≈{p:.2f}, proche cible 0.70"
-            q_rev["target_difficulty"] = q["difficulty"]
-            q_rev["_score"] = target_score(p, target_rev)
-            rev_pool.append(q_rev)
-
-            q_ch = dict(q)
-            q_ch["reason_type"] = "challenge"
-            q_ch["reason"] = f"DKT: p(correct)≈{p:.2f}, proche cible 0.55"
-            q_ch["target_difficulty"] = q["difficulty"]
-            q_ch["_score"] = target_score(p, target_ch)
-            ch_pool.append(q_ch)
-
-        rev_pool.sort(key=lambda x: x["_score"], reverse=True)
-        ch_pool.sort(key=lambda x: x["_score"], reverse=True)
+        # Candidats (non vues, skill connu) : tout en vecteurs alignés sur le catalogue
+        cat = self.catalog.snapshot()
+        skill_of = cat.skill_index(idx_of)  # question -> skill (-1 si hors mapping)
+        ok = ~self.seen_mask(hist, cat) & (skill_of >= 0)  # vues = fusion responses + training
+        pos = np.flatnonzero(ok)
+        p = np.asarray(p_vec, dtype=np.float64)[skill_of[pos]]
+
+        # plus proche du target => meilleur score
+        score_rev = -(p - target_rev) ** 2
+        score_ch  = -(p - target_ch) ** 2
 
         k_rev = int(round(limit * mix_ratio))
         k_ch  = limit - k_rev
-        items = rev_pool[:k_rev] + ch_pool[:k_ch]
+        picked = [(i, "revision", target_rev, score_rev) for i in _top_k(score_rev, k_rev)] + \
+                 [(i, "challenge", target_ch, score_ch) for i in _top_k(score_ch, k_ch)]
 
         # Dédoublonnage par question_id, garder meilleur score
         best = {}
-        for it in items:
-            qid = it["question_id"]
-            if qid not in best or it["_score"] > best[qid]["_score"]:
-                best[qid] = it
-        items = list(best.values())
-        items.sort(key=lambda x: x["_score"], reverse=True)
-        for it in items:
-            it.pop("_score", None)
-        return items[:limit]
+        for i, reason_type, target, scores in picked:
+            qid = cat.question_id[pos[i]]
+            if qid not in best or scores[i] > best[qid][3]:
+                best[qid] = (i, reason_type, target, float(scores[i]))
+        ranked = sorted(best.values(), key=lambda x: x[3], reverse=True)[:limit]
+
+        # Seuls les `limit` items retenus sont matérialisés en dict
+        items = []
+        for i, reason_type, target, _ in ranked:
+            q = cat.materialize(pos[i])
+            q["reason_type"] = reason_type
+            q["reason"] = f"DKT: p(correct)≈{p[i]:.2f}, proche cible {target:.2f}"
+            q["target_difficulty"] = q["difficulty"]
+            items.append(q)
+        return items
@@ -0,0 +1,420 @@
+import os
+import time
+import atexit
+import threading
+import datetime as dt
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from theme_rollups import apply_live
+
+# ----------------------- Config -----------------------
+RESPONSE_FLUSH_MAX = int(os.getenv("RESPONSE_FLUSH_MAX", "500"))         # nb max de réponses par insert_many
+RESPONSE_FLUSH_MS = float(os.getenv("RESPONSE_FLUSH_MS", "50"))          # attente max avant écriture du tampon (before_flush)
+RESPONSE_ACK = os.getenv("RESPONSE_ACK", "after_flush").strip().lower()   # "after_flush" | "before_flush"
+RESPONSE_FLUSH_RETRIES = int(os.getenv("RESPONSE_FLUSH_RETRIES", "3"))   # nouvelles tentatives (erreurs réseau)
+RESPONSE_KNOWN_SESSIONS = int(os.getenv("RESPONSE_KNOWN_SESSIONS", "50000"))  # sessions déjà upsertées, mémorisées
+
+ACK_MODES = ("before_flush", "after_flush")
+_DUPLICATE_KEY = 11000
+
+def session_upsert(session_id: str, user_id: str, policy: str = "dkt", started_at: dt.datetime = None) -> UpdateOne:
+    """Crée la session si absente, en UNE opération (sans find_one préalable) ; une session existante reste intacte."""
+    return UpdateOne({"user_session_id": session_id}, {"$setOnInsert": {
+        "user_session_id": session_id,
+        "user_id": user_id,
+        "started_at": started_at or dt.datetime.utcnow(),
+        "policy": policy,
+    }}, upsert=True)
+
+
+def parse_response(data: Dict[str, Any]) -> Tuple[str, Dict[str, Any], str]:
+    """
+    Corps JSON d'une réponse (/response, ligne de /responses/bulk) -> (user_id, doc `responses`, policy).
+    Lève ValueError si un champ requis manque ou si answered_at n'est pas une date ISO 8601.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("objet JSON attendu")
+    user_id = data.get("user_id")
+    session_id = data.get("session_id")
+    question_id = data.get("question_id")
+    if not (user_id and session_id and question_id):
+        raise ValueError("user_id, session_id, question_id requis")
+    answered_at = data.get("answered_at")
+    try:
+        resp_ms = int(data.get("response_time_ms") or data.get("response_time") or 0)
+        when = dt.datetime.fromisoformat(answered_at.replace("Z", "+00:00")) if answered_at else dt.datetime.utcnow()
+    except (TypeError, ValueError, AttributeError) as e:
+        raise ValueError(f"champ invalide : {e}")
+    if when.tzinfo is not None:
+        # horodatages naïfs en UTC partout (comme pymongo) : comparables avec l'historique en cache
+        when = when.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    doc = {
+        "session_id": session_id,
+        "question_id": question_id,
+        "is_correct": bool(data.get("is_correct")),
+        "response_time": resp_ms,
+        "answered_at": when,
+    }
+    return user_id, doc, data.get("policy") or "dkt"
+
+
+class ResponseWriter:
+    """
+    Écriture différée (write-behind) des réponses de /response.
+
+    `submit` ajoute la réponse à un tampon en mémoire ; un thread unique l'écrit :
+    un bulk_write d'upserts pour les sessions nouvelles (une fois par session),
+    puis un insert_many(ordered=False) pour toutes les réponses du lot.
+
+    Durabilité (RESPONSE_ACK) :
+      - after_flush  (défaut) : `submit` attend l'écriture du lot qui contient la réponse.
+        Le thread écrit dès qu'il est libre (commit groupé : les réponses arrivées
+        pendant une écriture partagent le insert_many suivant)
+      - before_flush : `submit` rend la main dès la mise en tampon ; le lot part quand
+        RESPONSE_FLUSH_MAX réponses sont en attente ou après RESPONSE_FLUSH_MS (latence
+        minimale ; une réponse peut être perdue si le process meurt avant l'écriture)
+    Les réponses en tampon ou en cours d'écriture restent lisibles via `pending_for`
+    (le chargement d'un historique les fusionne : on relit ses propres écritures).
+    Le tampon est vidé à l'arrêt du process (atexit). Les _id sont posés à la mise en
+    tampon : une nouvelle tentative après erreur réseau ne duplique rien.
+    RESPONSE_FLUSH_MAX <= 1 : écriture directe dans le thread appelant.
+
+    `defer(task)` : travail dérivé d'une réponse (bits `user_seen`, état DKT), exécuté
+    par le même thread après le lot en cours, hors du chemin de la requête.
+
+    `rollup_event` (optionnel : réponse -> événement normalisé) : après chaque lot écrit,
+    un bulk_write de $inc entretient les cumuls journaliers par thème (theme_rollups.apply_live,
+    qui met de côté les réponses des utilisateurs en cours de reconstruction).
+    Non rejoué en cas d'erreur (un $inc n'est pas idempotent) : le backfill corrige.
+    """
+
+    def __init__(self, db, max_batch: int = RESPONSE_FLUSH_MAX, flush_ms: float = RESPONSE_FLUSH_MS,
+                 ack: str = RESPONSE_ACK, retries: int = RESPONSE_FLUSH_RETRIES,
+                 known_sessions: int = RESPONSE_KNOWN_SESSIONS,
+                 rollup_event: Callable[[Dict[str, Any]], Dict[str, Any]] = None):
+        if ack not in ACK_MODES:
+            raise ValueError(f"RESPONSE_ACK must be one of {ACK_MODES}, got {ack!r}")
+        self.db = db
+        self.max_batch = int(max_batch)
+        self.flush_s = max(0.0, float(flush_ms)) / 1000.0
+        self.ack = ack
+        self.retries = max(0, int(retries))
+        self.known_max = max(0, int(known_sessions))
+        self.rollup_event = rollup_event
+        self._cond = threading.Condition()
+        self._responses: List[Dict[str, Any]] = []
+        self._users: List[str] = []
+        self._futures: List[Optional[Future]] = []
+        self._sessions: Dict[str, UpdateOne] = {}
+        self._inflight: List[Tuple[List[Dict[str, Any]], List[str]]] = []  # lots détachés, en cours d'écriture
+        self._tasks: List[Callable[[], int]] = []  # cf. defer
+        self._known: "OrderedDict[str, None]" = OrderedDict()  # sessions présentes en base (LRU)
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.ops = 0
+        self.session_upserts = 0
+        self.max_batch_seen = 0
+        self.flush_ms_total = 0.0
+        self.rollup_errors = 0
+        self.deferred = 0
+        self.deferred_ops = 0
+        self.deferred_errors = 0
+        self.last_error = None
+        atexit.register(self.close)
+
+    # ---------------- API ----------------
+    def submit(self, doc: Dict[str, Any], user_id: str, policy: str = "dkt", session_known: bool = False):
+        """
+        Met en tampon la réponse `doc` (format `responses`) et, si la session n'est pas
+        connue, son upsert. Ne modifie pas `doc`. En mode after_flush (ou écriture
+        directe), lève l'erreur d'écriture éventuelle.
+        """
+        d = dict(doc)
+        d.setdefault("_id", ObjectId())
+        sid = d.get("session_id")
+        with self._cond:
+            direct = self._closed or self.max_batch <= 1
+            # écriture directe : l'appelant voit l'échec, quel que soit le mode
+            fut = Future() if direct or self.ack == "after_flush" else None
+            if not session_known and sid not in self._known and sid not in self._sessions:
+                self._sessions[sid] = session_upsert(sid, user_id, policy)
+            self._responses.append(d)
+            self._users.append(str(user_id))
+            self._futures.append(fut)
+            if len(self._responses) == 1 or len(self._responses) >= self.max_batch:
+                self._cond.notify()  # réveille le thread : début de lot ou lot plein
+            batch = self._take() if direct else None
+        with self._stats_lock:
+            self.submitted += 1
+        if batch is not None:
+            self._flush(*batch)
+        else:
+            self._ensure_worker()
+        if fut is not None:
+            fut.result()
+
+    def write_many(self, items: List[Tuple[str, Dict[str, Any], str]]) -> Dict[int, str]:
+        """
+        Écriture synchrone d'un lot [(user_id, doc, policy)] (cf. parse_response) hors tampon (ingestion en masse) :
+        un bulk_write pour les sessions pas encore upsertées, un insert_many pour les réponses.
+        Renvoie {indice: message} des réponses refusées ; lève l'erreur si le lot entier échoue.
+        """
+        responses, users, sessions = [], [], {}
+        with self._cond:
+            for user_id, doc, policy in items:
+                d = dict(doc)
+                d.setdefault("_id", ObjectId())
+                sid = d.get("session_id")
+                if sid not in self._known and sid not in sessions:
+                    sessions[sid] = session_upsert(sid, user_id, policy)
+                responses.append(d)
+                users.append(str(user_id))
+        with self._stats_lock:
+            self.submitted += len(responses)
+        errors, error = self._write(responses, users, sessions)
+        if error is not None:
+            raise error
+        return errors
+
+    def ensure_session(self, session_id: str, user_id: str, policy: str = "dkt", started_at: dt.datetime = None):
+        """Upsert synchrone d'une session (/session/start) : une seule opération Mongo."""
+        self.db.usersessions.bulk_write([session_upsert(session_id, user_id, policy, started_at)])
+        with self._stats_lock:
+            self.ops += 1
+            self.session_upserts += 1
+        with self._cond:
+            self._remember([session_id])
+
+    def pending_for(self, user_id: str) -> List[Dict[str, Any]]:
+        """Réponses de l'utilisateur pas encore écrites (tampon + lots en cours d'écriture), copiées."""
+        user_id = str(user_id)
+        with self._cond:
+            batches = self._inflight + [(self._responses, self._users)]
+            return [dict(r) for responses, users in batches
+                    for r, uid in zip(responses, users) if uid == user_id]
+
+    def defer(self, task: Callable[[], int]):
+        """
+        Exécute `task` (renvoie son nb d'opérations Mongo, compté dans les stats) dans le
+        thread d'écriture, après le lot en cours. Écriture directe ou writer arrêté :
+        exécuté dans le thread appelant.
+        """
+        with self._cond:
+            direct = self._closed or self.max_batch <= 1
+            if not direct:
+                self._tasks.append(task)
+                self._cond.notify()
+        if direct:
+            self._run_tasks([task])
+        else:
+            self._ensure_worker()
+
+    def flush(self):
+        """Écrit immédiatement tout ce qui est en attente (dans le thread appelant)."""
+        with self._cond:
+            batch = self._take()
+            tasks, self._tasks = self._tasks, []
+        self._flush(*batch)
+        self._run_tasks(tasks)
+
+    def close(self, timeout: float = 10.0):
+        """Arrêt propre : plus d'attente, le tampon est vidé avant de rendre la main."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        w = self._worker
+        if w is not None and w.is_alive():
+            w.join(timeout)
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            pending = len(self._responses)
+            pending_tasks = len(self._tasks)
+        with self._stats_lock:
+            return {
+                "ack": self.ack,
+                "max_batch": self.max_batch,
+                "flush_ms": self.flush_s * 1000.0,
+                "pending": pending,
+                "submitted": self.submitted,
+                "written": self.written,
+                "failed": self.failed,
+                "batches": self.batches,
+                "session_upserts": self.session_upserts,
+                "rollups": self.rollup_event is not None,
+                "rollup_errors": self.rollup_errors,
+                "deferred_pending": pending_tasks,
+                "deferred": self.deferred,
+                "deferred_ops": self.deferred_ops,
+                "deferred_errors": self.deferred_errors,
+                "mongo_ops": self.ops,
+                "ops_per_response": round(self.ops / self.written, 4) if self.written else 0.0,
+                "avg_batch_size": round(self.written / self.batches, 2) if self.batches else 0.0,
+                "max_batch_size": self.max_batch_seen,
+                "avg_flush_ms": round(self.flush_ms_total / self.batches, 3) if self.batches else 0.0,
+                "last_error": self.last_error,
+            }
+
+    # ---------------- Worker ----------------
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._cond:
+            if not self._closed and (self._worker is None or not self._worker.is_alive()):
+                self._worker = threading.Thread(target=self._loop, name="response-writer", daemon=True)
+                self._worker.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._responses and not self._tasks and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return  # close() vide le reste
+                # after_flush : les appelants attendent, pas de délai de regroupement
+                wait = self.flush_s if self.ack == "before_flush" and self._responses else 0.0
+                deadline = time.monotonic() + wait
+                while len(self._responses) < self.max_batch and not self._closed:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                batch = self._take()
+                tasks, self._tasks = self._tasks, []
+            self._flush(*batch)
+            self._run_tasks(tasks)
+
+    def _run_tasks(self, tasks: List[Callable[[], int]]):
+        for task in tasks:
+            try:
+                ops = int(task() or 0)
+            except Exception as e:
+                with self._stats_lock:
+                    self.deferred_errors += 1
+                    self.last_error = f"deferred: {e}"
+                continue
+            with self._stats_lock:
+                self.deferred += 1
+                self.deferred_ops += ops
+                self.ops += ops
+
+    def _take(self):
+        """Détache le tampon courant, qui reste visible de pending_for jusqu'à la fin de _flush (appelé sous verrou)."""
+        batch = (self._responses, self._users, self._futures, self._sessions)
+        self._responses, self._users, self._futures, self._sessions = [], [], [], {}
+        if batch[0]:
+            self._inflight.append((batch[0], batch[1]))
+        return batch
+
+    def _remember(self, session_ids):
+        """Sessions présentes en base : plus d'upsert pour elles (appelé sous verrou)."""
+        if self.known_max <= 0:
+            return
+        for sid in session_ids:
+            self._known[sid] = None
+            self._known.move_to_end(sid)
+        while len(self._known) > self.known_max:
+            self._known.popitem(last=False)
+
+    def _flush(self, responses: List[Dict[str, Any]], users: List[str], futures: List[Optional[Future]],
+               sessions: Dict[str, UpdateOne]):
+        """Écrit un lot du tampon et règle les Future de ses appelants."""
+        try:
+            errors, error = self._write(responses, users, sessions)
+        finally:
+            with self._cond:
+                self._inflight = [b for b in self._inflight if b[0] is not responses]
+        for i, fut in enumerate(futures):
+            e = error or errors.get(i)
+            if fut is not None:
+                if e is None:
+                    fut.set_result(None)
+                else:
+                    fut.set_exception(e if isinstance(e, Exception) else RuntimeError(str(e)))
+
+    def _write(self, responses: List[Dict[str, Any]], users: List[str], sessions: Dict[str, UpdateOne]):
+        """
+        Sessions puis réponses ; erreurs réseau : nouvelles tentatives, puis échec de tout le lot.
+        Renvoie ({indice: message} des réponses refusées, erreur finale ou None).
+        """
+        if not responses and not sessions:
+            return {}, None
+        t0 = time.perf_counter()
+        written_from = dt.datetime.utcnow()  # cf. theme_rollups.apply_live
+        ops, errors, error = 0, {}, None
+        for attempt in range(self.retries + 1):
+            try:
+                if sessions:
+                    ops += 1
+                    self.db.usersessions.bulk_write(list(sessions.values()), ordered=False)
+                    with self._cond:
+                        self._remember(sessions)
+                    n_sessions, sessions = len(sessions), {}
+                    with self._stats_lock:
+                        self.session_upserts += n_sessions
+                if responses:
+                    ops += 1
+                    errors = self._insert(responses)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    time.sleep(min(1.0, 0.05 * 2 ** attempt))
+
+        if error is None and self.rollup_event is not None:
+            ops += self._rollup(responses, users, errors, written_from)
+        n_failed = len(responses) if error is not None else len(errors)
+        with self._stats_lock:
+            self.ops += ops
+            self.batches += 1
+            self.written += len(responses) - n_failed
+            self.failed += n_failed
+            self.max_batch_seen = max(self.max_batch_seen, len(responses))
+            self.flush_ms_total += (time.perf_counter() - t0) * 1000.0
+            if error is not None or errors:
+                self.last_error = str(error) if error is not None else next(iter(errors.values()))
+        return errors, error
+
+    def _rollup(self, responses: List[Dict[str, Any]], users: List[str], errors: Dict[int, str],
+                written_from: dt.datetime) -> int:
+        """$inc des cumuls par thème pour les réponses écrites ; renvoie le nb d'opérations Mongo."""
+        by_user: Dict[str, List[Dict[str, Any]]] = {}
+        try:
+            for i, (r, uid) in enumerate(zip(responses, users)):
+                if i not in errors:
+                    by_user.setdefault(uid, []).append(dict(self.rollup_event(r), _id=r["_id"]))
+            if not by_user:
+                return 0
+            return apply_live(self.db, by_user, written_from)
+        except Exception as e:
+            with self._stats_lock:
+                self.rollup_errors += 1
+                self.last_error = f"rollup: {e}"
+        return 1
+
+    def _insert(self, responses: List[Dict[str, Any]]) -> Dict[int, str]:
+        """insert_many(ordered=False) ; renvoie {indice: message} des réponses refusées (hors doublons)."""
+        try:
+            self.db.responses.insert_many(responses, ordered=False)
+            return {}
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors"):
+                raise
+            # doublon de _id = déjà écrite par une tentative précédente
+            return {w["index"]: w.get("errmsg", "write error") for w in e.details.get("writeErrors", [])
+                    if w.get("code") != _DUPLICATE_KEY}
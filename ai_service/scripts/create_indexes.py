@@ -23,7 +23,17 @@ def safe_create_index(coll, keys, **kwargs):
 # Idempotent: on ne force PAS de name -> réutilise l'existant si compatible
 safe_create_index(db.questions,    [("theme", ASCENDING), ("difficulty", ASCENDING)])
 safe_create_index(db.usersessions, [("user_id", ASCENDING), ("started_at", DESCENDING)])
+# upsert des sessions par /response et /session/start (ai_service/response_writer.py)
+safe_create_index(db.usersessions, [("user_session_id", ASCENDING)])
 safe_create_index(db.responses,    [("session_id", ASCENDING), ("answered_at", ASCENDING)])
 safe_create_index(db.responses,    [("question_id", ASCENDING)])
+# réponses par date (answered_at) ; le snapshot DKT (ai_service/dkt_snapshot.py) suit l'ordre d'insertion (_id)
+safe_create_index(db.responses,    [("answered_at", ASCENDING)])
+# ids denses stables des questions + bitsets de questions vues (ai_service)
+safe_create_index(db.question_index, [("question_id", ASCENDING)], unique=True)
+safe_create_index(db.user_seen,      [("user_id", ASCENDING)], unique=True)
+# cumuls journaliers par (utilisateur, thème) (ai_service/theme_rollups.py) ; day null = cumul global
+safe_create_index(db.user_theme_daily, [("user_id", ASCENDING), ("theme", ASCENDING), ("day", ASCENDING)], unique=True)
+safe_create_index(db.user_theme_rollup_state, [("user_id", ASCENDING)], unique=True)
 
 print("Indexes OK.")
@@ -0,0 +1,170 @@
+import os
+import hashlib
+import datetime as dt
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from bson.int64 import Int64
+
+# ----------------------- Config -----------------------
+SEEN_PERSIST = os.getenv("SEEN_PERSIST", "1") == "1"                      # persistance Mongo (user_seen)
+SEEN_BLOOM_MIN_BANK = int(os.getenv("SEEN_BLOOM_MIN_BANK", "1000000"))    # au-delà : Bloom plutôt que bitset
+SEEN_BLOOM_BITS = int(os.getenv("SEEN_BLOOM_BITS", str(1 << 20)))         # m (bits) du filtre de Bloom
+SEEN_BLOOM_HASHES = int(os.getenv("SEEN_BLOOM_HASHES", "4"))              # k fonctions de hachage
+
+WORD_BITS = 32  # mots de 32 bits : tiennent dans un Int64 Mongo sans souci de signe
+
+def bloom_slots(question_id: str, m: int, k: int) -> List[int]:
+    """k positions (double hachage) de `question_id` dans un filtre de m bits."""
+    h = hashlib.blake2b(str(question_id).encode("utf-8"), digest_size=16).digest()
+    h1 = int.from_bytes(h[:8], "little")
+    h2 = int.from_bytes(h[8:], "little") | 1
+    return [(h1 + i * h2) % m for i in range(k)]
+
+
+class _WordBits:
+    """Tableau de bits compact (mots uint32), opérations vectorisées."""
+
+    kind = None
+
+    def __init__(self, words: np.ndarray = None):
+        self.words = words if words is not None else np.zeros(0, dtype=np.uint32)
+        self.persisted_words = 0  # longueur du tableau côté Mongo
+
+    def _grow(self, n_words: int):
+        if n_words > len(self.words):
+            self.words = np.concatenate([self.words, np.zeros(n_words - len(self.words), dtype=np.uint32)])
+
+    def _set_bits(self, bits: np.ndarray) -> List[Tuple[int, int]]:
+        """Pose les bits ; renvoie [(index_mot, masque)] des bits réellement nouveaux."""
+        bits = np.asarray(bits, dtype=np.int64)
+        bits = bits[bits >= 0]
+        if bits.size == 0:
+            return []
+        self._grow(int(bits.max()) // WORD_BITS + 1)
+        w = bits // WORD_BITS
+        m = np.left_shift(np.uint32(1), (bits % WORD_BITS).astype(np.uint32))
+        new = (self.words[w] & m) == 0
+        w, m = w[new], m[new]
+        if w.size == 0:
+            return []
+        np.bitwise_or.at(self.words, w, m)
+        # regroupe par mot pour une seule opération $bit par mot
+        out: Dict[int, int] = {}
+        for wi, mi in zip(w.tolist(), m.tolist()):
+            out[wi] = out.get(wi, 0) | mi
+        return sorted(out.items())
+
+    def _test_bits(self, bits: np.ndarray) -> np.ndarray:
+        bits = np.asarray(bits, dtype=np.int64)
+        w = bits // WORD_BITS
+        inside = (bits >= 0) & (w < len(self.words))
+        out = np.zeros(bits.shape, dtype=bool)
+        if inside.any():
+            wi = w[inside]
+            out[inside] = ((self.words[wi] >> (bits[inside] % WORD_BITS).astype(np.uint32)) & 1).astype(bool)
+        return out
+
+    def count(self) -> int:
+        return int(np.unpackbits(self.words.view(np.uint8)).sum()) if len(self.words) else 0
+
+
+class SeenBits(_WordBits):
+    """Questions vues = bitset indexé par l'identifiant dense (stable) de la question."""
+
+    kind = "bitset"
+
+    def add(self, catalog_snap, question_ids: Iterable[str]) -> List[Tuple[int, int]]:
+        dense = [catalog_snap.dense_of(q) for q in question_ids]
+        return self._set_bits(np.asarray([d for d in dense if d is not None], dtype=np.int64))
+
+    def mask(self, catalog_snap) -> np.ndarray:
+        """Masque booléen aligné sur les positions du catalogue (True = déjà vue)."""
+        return self._test_bits(catalog_snap.dense_id)
+
+
+class SeenBloom(_WordBits):
+    """
+    Variante Bloom pour les très grosses banques : taille fixe (m bits) quel que
+    soit le nombre de questions, au prix de rares faux positifs (question non vue
+    considérée comme vue, donc juste non proposée).
+    """
+
+    kind = "bloom"
+
+    def __init__(self, m: int = SEEN_BLOOM_BITS, k: int = SEEN_BLOOM_HASHES, words: np.ndarray = None):
+        super().__init__(words)
+        self.m, self.k = int(m), int(k)
+        self._grow((self.m + WORD_BITS - 1) // WORD_BITS)
+
+    def add(self, catalog_snap, question_ids: Iterable[str]) -> List[Tuple[int, int]]:
+        slots = [s for q in question_ids if q for s in bloom_slots(q, self.m, self.k)]
+        return self._set_bits(np.asarray(slots, dtype=np.int64))
+
+    def mask(self, catalog_snap) -> np.ndarray:
+        slots = catalog_snap.bloom_slots(self.m, self.k)  # [N, k]
+        if slots.size == 0:
+            return np.zeros(len(catalog_snap), dtype=bool)
+        return self._test_bits(slots).all(axis=1)
+
+
+def new_seen_filter(catalog_snap):
+    """Bitset tant que la banque reste raisonnable, Bloom au-delà de SEEN_BLOOM_MIN_BANK."""
+    if catalog_snap.n_dense > SEEN_BLOOM_MIN_BANK:
+        return SeenBloom()
+    return SeenBits()
+
+
+class SeenStore:
+    """
+    Persistance Mongo (`user_seen`) des filtres de questions vues :
+      { user_id, kind, m, k, words: [Int64 (32 bits utiles)], updated_at }
+    Les ajouts sont incrémentaux via `$bit` (un OR par mot modifié).
+    """
+
+    def __init__(self, db):
+        self.coll = db["user_seen"]
+
+    def load(self, user_id: str, catalog_snap):
+        doc = self.coll.find_one({"user_id": str(user_id)}, {"_id": 0})
+        if not doc:
+            return None
+        expected = new_seen_filter(catalog_snap)
+        if doc.get("kind") != expected.kind:
+            return None  # changement de représentation : reconstruit depuis l'historique
+        words = np.asarray([int(w) for w in doc.get("words") or []], dtype=np.uint32)
+        if expected.kind == "bloom":
+            if (int(doc.get("m", 0)), int(doc.get("k", 0))) != (expected.m, expected.k):
+                return None
+            filt = SeenBloom(expected.m, expected.k, words=words)
+        else:
+            filt = SeenBits(words=words)
+        filt.persisted_words = len(words)
+        return filt
+
+    def save(self, user_id: str, filt):
+        doc = {
+            "user_id": str(user_id),
+            "kind": filt.kind,
+            "words": [Int64(int(w)) for w in filt.words.tolist()],
+            "updated_at": dt.datetime.utcnow(),
+        }
+        if filt.kind == "bloom":
+            doc.update({"m": filt.m, "k": filt.k})
+        self.coll.replace_one({"user_id": str(user_id)}, doc, upsert=True)
+        filt.persisted_words = len(filt.words)
+
+    def add_bits(self, user_id: str, filt, updates: List[Tuple[int, int]]):
+        """Applique les bits nouvellement posés ; réécrit le doc si le tableau a grandi."""
+        if not updates:
+            return
+        if max(w for w, _ in updates) >= getattr(filt, "persisted_words", 0):
+            self.save(user_id, filt)
+            return
+        self.coll.update_one(
+            {"user_id": str(user_id)},
+            {
+                "$bit": {f"words.{w}": {"or": Int64(m)} for w, m in updates},
+                "$set": {"updated_at": dt.datetime.utcnow()},
+            },
+        )
@@ -0,0 +1,64 @@
+import time
+import threading
+import datetime as dt
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+class StartupReport:
+    """
+    Chronométrage du démarrage, phase par phase (imports, connexion, warm-up...),
+    pour rendre mesurables les démarrages à froid des conteneurs.
+    `ready` passe à True quand le warm-up est terminé sans échec bloquant.
+    """
+
+    def __init__(self, t0: float = None):
+        self.t0 = t0 if t0 is not None else time.perf_counter()
+        self.started_at = dt.datetime.utcnow()
+        self.phases: List[Dict[str, Any]] = []
+        self.ready = False
+        self.ready_after_ms: Optional[float] = None
+        self.warming = False
+        self._lock = threading.Lock()
+
+    def record(self, name: str, ms: float, ok: bool = True, error: str = None, required: bool = True):
+        with self._lock:
+            self.phases.append({
+                "phase": name,
+                "ms": round(ms, 1),
+                "ok": ok,
+                "required": required,
+                "error": error,
+            })
+
+    @contextmanager
+    def phase(self, name: str, required: bool = True):
+        """Chronomètre un bloc ; une exception est enregistrée (puis relancée)."""
+        t = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record(name, (time.perf_counter() - t) * 1000.0, ok=False, error=str(e), required=required)
+            raise
+        self.record(name, (time.perf_counter() - t) * 1000.0, required=required)
+
+    def mark_ready(self):
+        with self._lock:
+            self.ready = True
+            self.ready_after_ms = round((time.perf_counter() - self.t0) * 1000.0, 1)
+
+    def failed_required(self) -> bool:
+        """Une phase bloquante a-t-elle échoué (dernier essai de chaque phase) ?"""
+        with self._lock:
+            last = {p["phase"]: p for p in self.phases}
+            return any(p["required"] and not p["ok"] for p in last.values())
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "started_at": self.started_at.isoformat(),
+                "uptime_ms": round((time.perf_counter() - self.t0) * 1000.0, 1),
+                "ready": self.ready,
+                "warming": self.warming,
+                "ready_after_ms": self.ready_after_ms,
+                "phases": list(self.phases),
+            }
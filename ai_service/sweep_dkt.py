@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import shutil
+import itertools
+import datetime as dt
+import multiprocessing as mp
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+import torch
+from pymongo import MongoClient
+from torch.utils.data import DataLoader
+
+from models.dkt import build_dkt
+from train_dkt import (MONGO_URI, DB_NAME, DKT_ARCH, DKT_EMBED_DIM, DKT_PARITY_SAMPLE, DKT_SNAPSHOT,
+                       BucketBatchSampler, batch_loss, build_skill_mapping, collate_dkt, collate_dkt_index,
+                       iter_windows, load_sequences, publish_model, refreshed_snapshot, training_module)
+from metrics import evaluate_sequences
+
+DKT_SWEEP_DIR = os.getenv("DKT_SWEEP_DIR", os.path.join("data", "dkt_sweeps"))
+DKT_SWEEP_WORKERS = int(os.getenv("DKT_SWEEP_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+DKT_SWEEP_EPOCHS = int(os.getenv("DKT_SWEEP_EPOCHS", "4"))
+DKT_SWEEP_VAL = float(os.getenv("DKT_SWEEP_VAL", "0.1"))  # share of users held out for validation
+
+DEFAULT_GRID = {"hidden": [64, 128], "dropout": [0.1, 0.3], "lr": [1e-3, 3e-3], "max_len": [100, 200]}
+DEFAULTS = {"hidden": 128, "dropout": 0.1, "lr": 1e-3, "max_len": 200, "batch_size": 64,
+            "arch": DKT_ARCH, "embed_dim": DKT_EMBED_DIM}
+
+# ---------- Search space ----------
+def sweep_configs(grid: Dict[str, List[Any]], mode: str = "grid", trials: int = 0, seed: int = 42) -> List[Dict[str, Any]]:
+    """Every combination of `grid` (mode "grid"), or `trials` distinct ones drawn at random ("random")."""
+    unknown = set(grid) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown sweep parameters: {sorted(unknown)}")
+    keys = sorted(grid)
+    combos = [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+    if mode == "random" and trials and trials < len(combos):
+        idx = np.random.default_rng(seed).choice(len(combos), size=trials, replace=False)
+        combos = [combos[i] for i in sorted(idx)]
+    return [dict(DEFAULTS, **c) for c in combos]
+
+# ---------- Shared dataset ----------
+def prepare_dataset(db, out_dir: str, val_frac: float = DKT_SWEEP_VAL, seed: int = 42) -> Dict[str, Any]:
+    """
+    Load and encode the sequences once: flat int32 interaction codes + per-user offsets
+    (.npy, memory-mapped read-only by every trial process, so the pages are shared),
+    and a seeded user-level train/validation split.
+    """
+    skill2idx = build_skill_mapping(db)
+    K = len(skill2idx)
+    if K == 0:
+        raise RuntimeError("No skills found. Ensure 'questions' collection has theme & difficulty populated.")
+    # responses answered up to data_until are in the dataset (same rule as train_dkt.train)
+    data_until = dt.datetime.utcnow().isoformat()
+    if DKT_SNAPSHOT:
+        snap = refreshed_snapshot(db)
+        data_until = snap.manifest.get("watermark") or data_until
+        seqs = snap.iter_sequences(skill2idx)
+    else:
+        seqs = load_sequences(db, skill2idx)
+    codes, lengths = array("i"), array("q")
+    for seq in seqs:
+        a = np.asarray(seq, dtype=np.int64).reshape(-1, 2)
+        codes.frombytes((a[:, 0] + K * (1 - a[:, 1])).astype(np.int32).tobytes())
+        lengths.append(len(a))
+    n_users = len(lengths)
+    if n_users < 2:
+        raise RuntimeError("Not enough sequences for a train/validation split.")
+    offsets = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(np.frombuffer(lengths, dtype=np.int64), out=offsets[1:])
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "codes.npy"), np.frombuffer(codes, dtype=np.int32))
+    np.save(os.path.join(out_dir, "offsets.npy"), offsets)
+
+    perm = np.random.default_rng(seed).permutation(n_users)
+    n_val = min(n_users - 1, max(1, int(round(val_frac * n_users))))
+    np.save(os.path.join(out_dir, "val_users.npy"), np.sort(perm[:n_val]))
+    np.save(os.path.join(out_dir, "train_users.npy"), np.sort(perm[n_val:]))
+    info = {"num_skills": K, "skill2idx": skill2idx, "users": n_users, "val_users": int(n_val),
+            "events": int(offsets[-1]), "data_until": data_until, "prepared_at": dt.datetime.utcnow().isoformat()}
+    with open(os.path.join(out_dir, "dataset.json"), "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    return info
+
+class _SharedData:
+    """Read-only view of a prepared dataset (memory-mapped)."""
+    def __init__(self, data_dir: str):
+        with open(os.path.join(data_dir, "dataset.json"), "r", encoding="utf-8") as f:
+            self.info = json.load(f)
+        self.K = int(self.info["num_skills"])
+        self.codes = np.load(os.path.join(data_dir, "codes.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(data_dir, "offsets.npy"))
+        self.train_users = np.load(os.path.join(data_dir, "train_users.npy"))
+        self.val_users = np.load(os.path.join(data_dir, "val_users.npy"))
+
+    def user_codes(self, u: int) -> np.ndarray:
+        return self.codes[self.offsets[u]:self.offsets[u + 1]]
+
+    def windows(self, users, max_len: int) -> List[np.ndarray]:
+        """Read-only views into the memory-mapped codes: no per-trial copy of the dataset."""
+        return [w for u in users for w in iter_windows(self.user_codes(int(u)), max_len, copy=False)]
+
+    def sequences(self, users):
+        """(skill_idx, correct) arrays, as evaluate_sequences expects them."""
+        for u in users:
+            c = self.user_codes(int(u)).astype(np.int64)
+            yield np.stack([c % self.K, (c < self.K).astype(np.int64)], axis=1)
+
+# ---------- Trials ----------
+def _run_trial(data_dir: str, trial_dir: str, config: Dict[str, Any], epochs: int, seed: int, threads: int):
+    """One configuration: train on the train users, walk-forward metrics on the validation users."""
+    t0 = time.perf_counter()
+    torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    data = _SharedData(data_dir)
+    K, arch = data.K, config["arch"]
+    windows = data.windows(data.train_users, int(config["max_len"]))
+    collate = collate_dkt_index if arch == "embed" else collate_dkt
+    sampler = BucketBatchSampler([len(w) for w in windows], int(config["batch_size"]), seed=seed)
+    dl = DataLoader(windows, batch_sampler=sampler, collate_fn=lambda b: collate(b, K))
+
+    model = build_dkt(K, arch=arch, hidden_size=int(config["hidden"]), embed_dim=int(config["embed_dim"]),
+                      dropout=float(config["dropout"]))
+    optim = torch.optim.Adam(model.parameters(), lr=float(config["lr"]))
+    net = training_module(model)
+    model.train()
+    train_loss = None
+    for _ in range(epochs):
+        total, n = 0.0, 0
+        for batch in dl:
+            optim.zero_grad()
+            loss, _ = batch_loss(net, batch, arch, K)
+            loss.backward()
+            optim.step()
+            total += float(loss.detach())
+            n += 1
+        train_loss = total / max(1, n)
+    train_s = time.perf_counter() - t0
+
+    model.eval()
+    val = evaluate_sequences(model, K, data.sequences(data.val_users))["overall"]
+    os.makedirs(trial_dir, exist_ok=True)
+    torch.save(model.state_dict(), os.path.join(trial_dir, "dkt.pt"))
+    result = {
+        "trial": os.path.basename(trial_dir),
+        "config": config,
+        "epochs": epochs,
+        "train_loss": round(train_loss, 4) if train_loss is not None else None,
+        "val_logloss": val.get("logloss"),
+        "val_auc": val.get("auc"),
+        "val_n": val.get("n"),
+        "train_s": round(train_s, 2),
+        "wall_s": round(time.perf_counter() - t0, 2),
+    }
+    with open(os.path.join(trial_dir, "result.json"), "w", encoding="utf-8") as f:
+        json.dump(result, f)
+    return result
+
+def _trial_or_error(args):
+    data_dir, trial_dir, config = args[:3]
+    try:
+        return _run_trial(*args)
+    except Exception as e:
+        return {"trial": os.path.basename(trial_dir), "config": config, "error": str(e)}
+
+def run_sweep(grid: Dict[str, List[Any]] = None, mode: str = "grid", trials: int = 0, epochs: int = DKT_SWEEP_EPOCHS,
+              workers: int = DKT_SWEEP_WORKERS, val_frac: float = DKT_SWEEP_VAL, seed: int = 42,
+              out_dir: str = None) -> Dict[str, Any]:
+    """
+    Hyperparameter sweep: dataset prepared once (prepare_dataset), configurations trained
+    concurrently in a process pool (CPU threads split between workers), each scored on
+    the held-out users. Writes leaderboard.json (best validation logloss first) in out_dir.
+    """
+    t0 = time.perf_counter()
+    out_dir = out_dir or os.path.join(DKT_SWEEP_DIR, dt.datetime.utcnow().strftime("%Y%m%dT%H%M%S"))
+    data_dir = os.path.join(out_dir, "data")
+    client = MongoClient(MONGO_URI)
+    dataset = prepare_dataset(client[DB_NAME], data_dir, val_frac=val_frac, seed=seed)
+    prepare_s = time.perf_counter() - t0
+
+    configs = sweep_configs(grid or DEFAULT_GRID, mode=mode, trials=trials, seed=seed)
+    workers = max(1, min(workers, len(configs)))
+    threads = max(1, torch.get_num_threads() // workers)
+    jobs = [(data_dir, os.path.join(out_dir, f"trial_{i:03d}"), c, epochs, seed, threads)
+            for i, c in enumerate(configs)]
+    # spawn: no fork of a process that already runs torch threads
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn")) as pool:
+        results = list(pool.map(_trial_or_error, jobs))
+
+    ok = sorted((r for r in results if "error" not in r),
+                key=lambda r: (r["val_logloss"] is None, r["val_logloss"] or 0.0))
+    leaderboard = {
+        "sweep_dir": out_dir,
+        "mode": mode,
+        "epochs": epochs,
+        "workers": workers,
+        "dataset": {k: v for k, v in dataset.items() if k != "skill2idx"},
+        "prepare_s": round(prepare_s, 2),
+        "wall_s": round(time.perf_counter() - t0, 2),
+        "leaderboard": ok,
+        "failed": [r for r in results if "error" in r],
+    }
+    with open(os.path.join(out_dir, "leaderboard.json"), "w", encoding="utf-8") as f:
+        json.dump(leaderboard, f, indent=2)
+    return leaderboard
+
+# ---------- Promotion ----------
+def promote(sweep_dir: str, trial: str = None) -> Dict[str, Any]:
+    """
+    Publish a sweep model to MODEL_DIR like train_dkt does (checkpoint, serving artifact,
+    meta last): `trial` (e.g. "trial_003"), or the leaderboard's best by default.
+    """
+    with open(os.path.join(sweep_dir, "leaderboard.json"), "r", encoding="utf-8") as f:
+        board = json.load(f)
+    if trial is None:
+        if not board["leaderboard"]:
+            raise RuntimeError("no successful trial to promote")
+        trial = board["leaderboard"][0]["trial"]
+    with open(os.path.join(sweep_dir, trial, "result.json"), "r", encoding="utf-8") as f:
+        result = json.load(f)
+    data = _SharedData(os.path.join(sweep_dir, "data"))
+    cfg = result["config"]
+    model = build_dkt(data.K, arch=cfg["arch"], hidden_size=int(cfg["hidden"]), embed_dim=int(cfg["embed_dim"]),
+                      dropout=float(cfg["dropout"]))
+    model.load_state_dict(torch.load(os.path.join(sweep_dir, trial, "dkt.pt"), map_location="cpu"))
+    skill2idx = data.info["skill2idx"]
+    meta = {
+        "num_skills": data.K,
+        "hidden_size": int(cfg["hidden"]),
+        "arch": cfg["arch"],
+        "embed_dim": int(cfg["embed_dim"]) if cfg["arch"] == "embed" else None,
+        "skill2idx": skill2idx,
+        "idx2skill": {v: k for k, v in skill2idx.items()},
+        "trained_at": dt.datetime.utcnow().isoformat(),
+        "data_until": data.info.get("data_until") or data.info["prepared_at"],  # older sweeps: no watermark
+        "warm_start": None,
+        "sweep": {"dir": sweep_dir, "trial": trial, "config": cfg, "val_logloss": result.get("val_logloss"),
+                  "val_auc": result.get("val_auc")},
+    }
+    publish_model(model, meta, data.windows(data.val_users[:DKT_PARITY_SAMPLE], int(cfg["max_len"])))
+    return meta["sweep"]
+
+# ---------- CLI ----------
+if __name__ == "__main__":
+    # simple CLI via envs (optional)
+    #   DKT_SWEEP_GRID='{"hidden":[64,128],"lr":[0.001,0.003]}'  DKT_SWEEP_MODE=grid|random  DKT_SWEEP_TRIALS=8
+    #   DKT_SWEEP_PROMOTE=<sweep_dir>[:trial_XXX]  -> publish without sweeping
+    #   DKT_SWEEP_PROMOTE_BEST=1                   -> publish the best trial of this sweep
+    PROMOTE = os.getenv("DKT_SWEEP_PROMOTE")
+    if PROMOTE:
+        sweep_dir, _, trial = PROMOTE.partition(":")
+        print(json.dumps(promote(sweep_dir, trial or None), indent=2))
+    else:
+        GRID = json.loads(os.getenv("DKT_SWEEP_GRID", "null") or "null")
+        board = run_sweep(GRID, mode=os.getenv("DKT_SWEEP_MODE", "grid"), trials=int(os.getenv("DKT_SWEEP_TRIALS", "0")))
+        for r in board["leaderboard"]:
+            print(f"{r['trial']}  val_logloss={r['val_logloss']}  val_auc={r['val_auc']}  "
+                  f"wall={r['wall_s']}s  {json.dumps(r['config'])}")
+        for r in board["failed"]:
+            print(f"{r['trial']}  FAILED: {r['error']}")
+        print(f"leaderboard -> {os.path.join(board['sweep_dir'], 'leaderboard.json')}")
+        if os.getenv("DKT_SWEEP_PROMOTE_BEST", "0") == "1" and board["leaderboard"]:
+            print(json.dumps(promote(board["sweep_dir"]), indent=2))
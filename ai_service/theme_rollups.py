@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import datetime as dt
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+# ----------------------- Config -----------------------
+THEME_ROLLUPS = os.getenv("THEME_ROLLUPS", "0") == "1"  # stats par thème lues depuis les cumuls journaliers
+ROLLUP_COLLECTION = os.getenv("THEME_ROLLUPS_COLLECTION", "user_theme_daily")
+# état par utilisateur : pause pendant une reconstruction, cumul douteux (dirty), date de reconstruction
+ROLLUP_STATE_COLLECTION = os.getenv("THEME_ROLLUPS_STATE_COLLECTION", "user_theme_rollup_state")
+ROLLUP_PAUSE_GRACE_S = float(os.getenv("THEME_ROLLUPS_PAUSE_GRACE_S", "2"))  # > durée d'un lot du ResponseWriter
+ROLLUP_PAUSE_TTL_S = float(os.getenv("THEME_ROLLUPS_PAUSE_TTL_S", "600"))    # pause plus vieille : rebuild mort
+ROLLUP_REBUILD_CHUNK = int(os.getenv("THEME_ROLLUPS_REBUILD_CHUNK", "500"))  # utilisateurs mis en pause ensemble
+
+def day_of(ts: Optional[dt.datetime], now: dt.datetime = None) -> dt.datetime:
+    """Jour (minuit UTC, naïf) d'un horodatage ; sans date : aujourd'hui."""
+    ts = ts or now or dt.datetime.utcnow()
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return dt.datetime(ts.year, ts.month, ts.day)
+
+def _buckets(events: Iterable[Dict[str, Any]], now: dt.datetime = None) -> Dict[Tuple[str, Optional[dt.datetime]], List[float]]:
+    """
+    Événements normalisés (theme, correct, response_time_ms, ts) -> {(theme, jour): [essais, bonnes, temps_ms]},
+    plus un cumul toutes dates (jour None) par thème. Événements sans thème ignorés (comme UserHistory).
+    """
+    out: Dict[Tuple[str, Optional[dt.datetime]], List[float]] = {}
+    for ev in events:
+        theme = ev.get("theme")
+        if not theme:
+            continue
+        rt = ev.get("response_time_ms")
+        inc = (1, 1 if ev.get("correct") else 0, float(rt) if isinstance(rt, (int, float)) else 0.0)
+        for key in ((theme, day_of(ev.get("ts"), now)), (theme, None)):
+            b = out.setdefault(key, [0, 0, 0.0])
+            b[0] += inc[0]
+            b[1] += inc[1]
+            b[2] += inc[2]
+    return out
+
+def rollup_updates(user_id: str, events: Iterable[Dict[str, Any]]) -> List[UpdateOne]:
+    """Upserts $inc des cumuls (user_id, theme, day) pour de nouveaux événements d'un utilisateur."""
+    return [UpdateOne({"user_id": str(user_id), "theme": theme, "day": day},
+                      {"$inc": {"attempts": a, "correct": c, "time_ms": t}}, upsert=True)
+            for (theme, day), (a, c, t) in _buckets(events).items()]
+
+def rollup_docs(user_id: str, events: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Documents complets des cumuls d'un utilisateur (reconstruction)."""
+    return [{"user_id": str(user_id), "theme": theme, "day": day, "attempts": a, "correct": c, "time_ms": t}
+            for (theme, day), (a, c, t) in _buckets(events).items()]
+
+def theme_counters(db, user_id: str, window_days: int, now: dt.datetime = None) -> Dict[str, Dict[str, float]]:
+    """
+    Compteurs par thème au format UserHistory.theme_counters, depuis au plus
+    2*window_days + 1 cumuls journaliers et le cumul toutes dates (une requête) :
+      - récent    : jours >= jour(now - window_days)
+      - précédent : jour(now - 2*window_days) <= jour < jour(now - window_days)
+    (fenêtres alignées sur les jours UTC, là où UserHistory compare les horodatages).
+    """
+    now = now or dt.datetime.utcnow()
+    recent_from = day_of(now - dt.timedelta(days=window_days))
+    prev_from = day_of(now - dt.timedelta(days=2 * window_days))
+    cur = db[ROLLUP_COLLECTION].find(
+        {"user_id": str(user_id), "$or": [{"day": None}, {"day": {"$gte": prev_from}}]},
+        {"_id": 0, "theme": 1, "day": 1, "attempts": 1, "correct": 1, "time_ms": 1},
+    )
+    out: Dict[str, Dict[str, float]] = {}
+    for d in cur:
+        c = out.get(d["theme"])
+        if c is None:
+            c = out[d["theme"]] = {
+                "attempts": 0, "correct": 0, "time": 0.0,
+                "r_attempts": 0, "r_correct": 0,
+                "p_attempts": 0, "p_correct": 0,
+            }
+        day = d.get("day")
+        if day is None:
+            c["attempts"] += d.get("attempts", 0)
+            c["correct"] += d.get("correct", 0)
+            c["time"] += float(d.get("time_ms", 0.0))
+        elif day >= recent_from:
+            c["r_attempts"] += d.get("attempts", 0)
+            c["r_correct"] += d.get("correct", 0)
+        else:
+            c["p_attempts"] += d.get("attempts", 0)
+            c["p_correct"] += d.get("correct", 0)
+    # thème présent seulement dans des jours sans cumul global : pas d'essais comptés
+    return {t: c for t, c in out.items() if c["attempts"] > 0}
+
+def rollups_usable(db, user_id: str) -> bool:
+    """
+    Les cumuls de l'utilisateur reflètent-ils tout son historique ? Non s'ils n'ont
+    jamais été reconstruits (pas de `rebuilt_at` : seuls les $inc en direct, sans
+    l'historique antérieur), si une reconstruction est en cours (pause), s'ils sont
+    marqués douteux (dirty), ou si le backend Node a écrit des sessions (Game/Training,
+    datées createdAt/end_time/start_time) depuis la dernière reconstruction : elles ne
+    passent pas par ai_service.
+    Deux lectures indexées (état, puis usersessions par user_id).
+    """
+    st = db[ROLLUP_STATE_COLLECTION].find_one({"user_id": str(user_id)},
+                                              {"_id": 0, "paused": 1, "dirty": 1, "rebuilt_at": 1}) or {}
+    since = st.get("rebuilt_at")
+    if since is None or st.get("paused") or st.get("dirty"):
+        return False
+    cond = {"$gt": since}
+    node = db.usersessions.find_one(
+        {"user_id": str(user_id), "$or": [{"createdAt": cond}, {"end_time": cond}, {"start_time": cond}]},
+        {"_id": 1},
+    )
+    return node is None
+
+def apply_live(db, by_user: Dict[str, List[Dict[str, Any]]], written_from: dt.datetime) -> int:
+    """
+    $inc des cumuls pour des réponses que ResponseWriter vient d'écrire (événements
+    normalisés portant le _id de la réponse), sans se croiser avec `rebuild` :
+      - utilisateur en pause (reconstruction en cours) : événements mis de côté dans son
+        état (`held`) ; rebuild applique ceux qui manquent à l'historique qu'il a relu
+      - reconstruit depuis le début de l'écriture (la réponse y est peut-être déjà), ou pause
+        expirée : utilisateur marqué dirty, lu depuis l'historique jusqu'au prochain rebuild
+    Renvoie le nb d'opérations Mongo.
+    """
+    state = db[ROLLUP_STATE_COLLECTION]
+    now = dt.datetime.utcnow()
+    states = {d["user_id"]: d for d in state.find({"user_id": {"$in": list(by_user)}},
+                                                  {"_id": 0, "user_id": 1, "paused": 1, "paused_at": 1, "rebuilt_at": 1})}
+    ops, updates, held, dirty = 1, [], {}, []
+    for uid, evs in by_user.items():
+        st = states.get(uid) or {}
+        if st.get("paused"):
+            if st.get("paused_at") and (now - st["paused_at"]).total_seconds() < ROLLUP_PAUSE_TTL_S:
+                held[uid] = evs
+            else:
+                dirty.append(uid)
+        elif st.get("rebuilt_at") is not None and st["rebuilt_at"] >= written_from:
+            dirty.append(uid)
+        else:
+            updates += rollup_updates(uid, evs)
+    if updates:
+        ops += 1
+        db[ROLLUP_COLLECTION].bulk_write(updates, ordered=False)
+    for uid, evs in held.items():
+        ops += 1
+        res = state.update_one({"user_id": uid, "paused": True}, {"$push": {"held": {"$each": evs}}})
+        if not res.matched_count:
+            dirty.append(uid)  # reconstruction terminée entre-temps
+    if dirty:
+        ops += 1
+        state.bulk_write([UpdateOne({"user_id": uid}, {"$set": {"dirty": True}}, upsert=True) for uid in dirty],
+                         ordered=False)
+    return ops
+
+# ---------- Reconstruction (backfill) ----------
+def rebuild(db, user_ids: Iterable[str] = None, catalog=None, chunk: int = ROLLUP_REBUILD_CHUNK,
+            grace_s: float = ROLLUP_PAUSE_GRACE_S) -> Dict[str, Any]:
+    """
+    (Re)construit les cumuls depuis l'historique fusionné (iter_user_history : sessions
+    Game/Training écrites par le backend + `responses`). Par défaut : tous les user_id de usersessions.
+    À relancer périodiquement si le backend Node écrit des sessions sans passer par ai_service
+    (d'ici là, rollups_usable renvoie ces utilisateurs vers l'historique).
+
+    Par paquets de `chunk` utilisateurs : mise en pause des $inc en direct (apply_live les met
+    de côté), attente de `grace_s` (les lots vérifiés avant la pause ont atterri), puis par
+    utilisateur : relecture de l'historique, delete_many + insert_many, reprise, et $inc des
+    réponses mises de côté absentes de la relecture (repérées par _id).
+    """
+    from recommender import iter_user_history  # différé : recommender importe ce module
+
+    t0 = time.perf_counter()
+    coll, state = db[ROLLUP_COLLECTION], db[ROLLUP_STATE_COLLECTION]
+    if user_ids is None:
+        user_ids = [u for u in db.usersessions.distinct("user_id") if u is not None]
+    user_ids = [str(u) for u in user_ids]
+    users, docs_written, late = 0, 0, 0
+    for i in range(0, len(user_ids), max(1, chunk)):
+        part = user_ids[i:i + max(1, chunk)]
+        paused_at = dt.datetime.utcnow()
+        state.bulk_write([UpdateOne({"user_id": uid}, {"$set": {"paused": True, "paused_at": paused_at, "held": []}},
+                                    upsert=True) for uid in part], ordered=False)
+        time.sleep(grace_s)
+        for uid in part:
+            read_at = dt.datetime.utcnow()
+            seen_ids = set()
+            docs = rollup_docs(uid, iter_user_history(db, uid, catalog=catalog, response_ids=seen_ids))
+            coll.delete_many({"user_id": uid})
+            if docs:
+                coll.insert_many(docs)
+            before = state.find_one_and_update(
+                {"user_id": uid},
+                {"$set": {"paused": False, "dirty": False, "rebuilt_at": read_at, "held": []}},
+                projection={"_id": 0, "held": 1},
+            ) or {}
+            missing = [ev for ev in before.get("held") or [] if ev.get("_id") not in seen_ids]
+            if missing:
+                coll.bulk_write(rollup_updates(uid, missing), ordered=False)
+                late += len(missing)
+            users += 1
+            docs_written += len(docs)
+    return {"users": users, "docs": docs_written, "late_responses": late,
+            "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+if __name__ == "__main__":
+    # backfill : THEME_ROLLUPS_USERS=u1,u2 pour quelques utilisateurs, sinon tous
+    from recommender import _connect_db
+
+    _, db = _connect_db()
+    only = [u.strip() for u in os.getenv("THEME_ROLLUPS_USERS", "").split(",") if u.strip()]
+    print(json.dumps(rebuild(db, only or None), indent=2))
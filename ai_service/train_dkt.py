@@ -1,31 +1,66 @@
 import os
 import json
 import math
+import time
+import queue
+import socket
 import numpy as np
 import datetime as dt
-from typing import List, Dict, Tuple
+from functools import partial
+from itertools import islice
+from typing import Any, List, Dict, Sequence, Tuple
 from pymongo import MongoClient
 from dotenv import load_dotenv
 
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+import torch.multiprocessing as torch_mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, get_worker_info
+from torch.utils.data.distributed import DistributedSampler
 
-from models.dkt import DKT
+from models.dkt import build_dkt, grow_skills, model_input
+from model_registry import MODEL_DIR, meta_path, model_path
+from dkt_snapshot import DKT_SNAPSHOT_DIR, DKTSnapshot, refreshed_snapshot
+from dkt_extract import extract_sequences
 
 load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 DB_NAME   = os.getenv("MONGO_DB", "quiz_app")
-MODEL_DIR = os.getenv("MODEL_DIR", "model")
 os.makedirs(MODEL_DIR, exist_ok=True)
 
-META_PATH  = os.path.join(MODEL_DIR, "dkt_meta.json")
-MODEL_PATH = os.path.join(MODEL_DIR, "dkt.pt")
+# same MODEL_DIR as the serving registry (model_registry)
+META_PATH  = meta_path(MODEL_DIR)
+MODEL_PATH = model_path(MODEL_DIR)
+SERVING_PATH = os.path.join(MODEL_DIR, "dkt_serving.pt")  # TorchScript artifact for CPU inference
+
+DKT_SERVING = os.getenv("DKT_SERVING", "int8").strip().lower()  # "int8" | "fp32" | "off"
+DKT_PARITY_SAMPLE = int(os.getenv("DKT_PARITY_SAMPLE", "256"))   # validation windows for parity check
+DKT_ARCH = os.getenv("DKT_ARCH", "onehot").strip().lower()        # "onehot" (DKT) | "embed" (DKTEmbed)
+DKT_EMBED_DIM = int(os.getenv("DKT_EMBED_DIM", "64"))
+DKT_BUCKET = os.getenv("DKT_BUCKET", "1") == "1"                 # length-bucketed batches
+DKT_BUCKET_POOL = int(os.getenv("DKT_BUCKET_POOL", "50"))         # batches per sorting pool
+# packed LSTM (pack_padded_sequence): no work on padding, but on CPU the packed path is
+# slower than the fused padded kernel once batches are bucketed -> opt-in
+DKT_PACK = os.getenv("DKT_PACK", "0") == "1"
+# streaming: windows built from the aggregation cursor instead of a fully materialized dataset
+DKT_STREAM = os.getenv("DKT_STREAM", "0") == "1"
+DKT_SHUFFLE_BUFFER = int(os.getenv("DKT_SHUFFLE_BUFFER", "10000"))  # windows held for shuffling
+DKT_LOADER_WORKERS = int(os.getenv("DKT_LOADER_WORKERS", "0"))     # DataLoader workers (user shards)
+DKT_STREAM_SHARDS = int(os.getenv("DKT_STREAM_SHARDS", "0"))       # user_id ranges per epoch; 0 = 4 x workers
+# sequences read from the on-disk snapshot (dkt_snapshot), refreshed incrementally before training
+DKT_SNAPSHOT = os.getenv("DKT_SNAPSHOT", "1") == "1"
+# incremental mode: users active since the last model + a replay sample of the others
+DKT_REPLAY_RATIO = float(os.getenv("DKT_REPLAY_RATIO", "1.0"))  # replay users per fresh user
+# data-parallel training: N local processes (torch.distributed, gloo, CPU only)
+DKT_WORLD_SIZE = int(os.getenv("DKT_WORLD_SIZE", "1"))
 
 # ---------- Utils: build skill mapping (theme x difficulty) ----------
-def build_skill_mapping(db) -> Dict[str, int]:
+def build_skill_mapping(db, base: Dict[str, int] = None) -> Dict[str, int]:
     # key = f"{theme}|||{difficulty}"
+    # base: mapping of a previous model; its indices are kept and new skills appended after
     skills = []
     for doc in db.questions.aggregate([
         {"$group": {"_id": {"theme": "$theme", "difficulty": "$difficulty"}}},
@@ -33,61 +68,157 @@ def build_skill_mapping(db) -> Dict[str, int]:
     ]):
         k = f"{doc['_id']['theme']}|||{doc['_id']['difficulty']}"
         skills.append(k)
+    if base:
+        mapping = {k: int(i) for k, i in base.items()}
+        for k in skills:
+            if k not in mapping:
+                mapping[k] = len(mapping)
+        return mapping
     return {k: i for i, k in enumerate(skills)}
 
 # ---------- Dataset ----------
+def encode_interactions(seq: List[Tuple[int, int]], num_skills: int) -> np.ndarray:
+    """(skill, correct) -> interaction index: skill if correct else K + skill (the one-hot column)."""
+    a = np.asarray(seq, dtype=np.int64).reshape(-1, 2)
+    return (a[:, 0] + num_skills * (1 - a[:, 1])).astype(np.int32)
+
+def iter_windows(codes: np.ndarray, max_len: int, copy: bool = True):
+    """
+    Chop one user's codes into windows of max_len (windows shorter than 2 carry no target).
+    copy=False yields views into `codes` (e.g. a read-only memmap); the collate functions
+    copy each batch anyway.
+    """
+    for s in range(0, len(codes), max_len):
+        window = codes[s:s+max_len]
+        if len(window) >= 2:
+            yield window.copy() if copy else window
+
 class DKTDataset(Dataset):
     def __init__(self, sequences: List[List[Tuple[int, int]]], num_skills: int, max_len: int = 200):
         """
         sequences: list of user sequences
           a sequence is a list of (skill_index, is_correct) ordered by time
+        Windows are stored as compact int32 interaction indices (see encode_interactions);
+        the one-hot expansion happens per batch in collate_dkt.
         """
         self.num_skills = num_skills
         self.max_len = max_len
-        self.data = []
+        self.data: List[np.ndarray] = []
         for seq in sequences:
             if len(seq) < 2:
                 continue
-            # chop into windows of max_len
-            for s in range(0, len(seq), max_len):
-                window = seq[s:s+max_len]
-                if len(window) >= 2:
-                    self.data.append(window)
+            self.data.extend(iter_windows(encode_interactions(seq, num_skills), max_len))
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
-        seq = self.data[idx]
-        T = len(seq)
-        # Input X_t encodes the PREVIOUS interaction; target is at SAME t (next skill correctness)
-        # We shift by 1 so first input is the first interaction and target is the second, etc.
-        # Build one-hot 2K
-        K = self.num_skills
-        x = np.zeros((T-1, 2*K), dtype=np.float32)
-        y = np.zeros((T-1, K), dtype=np.float32)
-        for t in range(T-1):
-            s_prev, c_prev = seq[t]
-            s_next, c_next = seq[t+1]
-            # encode previous (s_prev, c_prev)
-            if c_prev == 1:
-                x[t, s_prev] = 1.0
-            else:
-                x[t, K + s_prev] = 1.0
-            # target is correctness on skill s_next at next step
-            y[t, s_next] = c_next
-        return torch.from_numpy(x), torch.from_numpy(y)
+        return self.data[idx]
+
+def collate_dkt(batch: List[np.ndarray], num_skills: int):
+    """
+    Vectorized batch expansion of interaction windows (variable lengths, right padded).
+    Input x_t encodes interaction t; target y_t is the correctness of interaction t+1 on its skill.
+    Returns x [B,T,2K], y [B,T,K], mask [B,T] (True = real step), lengths [B], with T = max(len) - 1.
+    """
+    K = num_skills
+    lengths = np.asarray([len(w) - 1 for w in batch], dtype=np.int64)
+    B, T = len(batch), int(lengths.max())
+    codes = np.zeros((B, T + 1), dtype=np.int64)
+    for b, w in enumerate(batch):
+        codes[b, :len(w)] = w
+    mask = np.arange(T)[None, :] < lengths[:, None]
+    bi, ti = np.nonzero(mask)
+    nxt = codes[bi, ti + 1]
+
+    x = np.zeros((B, T, 2 * K), dtype=np.float32)
+    x[bi, ti, codes[bi, ti]] = 1.0
+    y = np.zeros((B, T, K), dtype=np.float32)
+    y[bi, ti, nxt % K] = (nxt < K).astype(np.float32)
+    return torch.from_numpy(x), torch.from_numpy(y), torch.from_numpy(mask), torch.from_numpy(lengths)
+
+def collate_dkt_index(batch: List[np.ndarray], num_skills: int):
+    """
+    Index batch for the embedding variant (nothing K-wide is materialized).
+    Returns codes [B,T] (input interactions), next_skill [B,T], next_correct [B,T] float,
+    mask [B,T], lengths [B].
+    """
+    K = num_skills
+    lengths = np.asarray([len(w) - 1 for w in batch], dtype=np.int64)
+    B, T = len(batch), int(lengths.max())
+    codes = np.zeros((B, T + 1), dtype=np.int64)
+    for b, w in enumerate(batch):
+        codes[b, :len(w)] = w
+    mask = np.arange(T)[None, :] < lengths[:, None]
+    nxt = codes[:, 1:]
+    return (torch.from_numpy(codes[:, :-1].copy()), torch.from_numpy(nxt % K),
+            torch.from_numpy((nxt < K).astype(np.float32)), torch.from_numpy(mask), torch.from_numpy(lengths))
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches of windows with similar lengths (little padding) that stay random: each
+    epoch shuffles the windows, sorts them by length inside pools of `pool` batches,
+    cuts the pools into batches, then shuffles the batch order.
+    rank/world_size: data-parallel shard. Every rank draws the same batches (same seed)
+    and keeps one out of world_size, padded by repeating batches so that all ranks run the
+    same number of steps.
+    """
+    def __init__(self, lengths: List[int], batch_size: int, pool: int = DKT_BUCKET_POOL, seed: int = 42,
+                 rank: int = 0, world_size: int = 1):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.pool = max(1, pool) * batch_size
+        self.rng = np.random.default_rng(seed)
+        self.rank = rank
+        self.world_size = world_size
+
+    def __iter__(self):
+        idx = self.rng.permutation(len(self.lengths))
+        batches = []
+        for p in range(0, len(idx), self.pool):
+            chunk = idx[p:p + self.pool]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind="stable")]
+            batches += [chunk[i:i + self.batch_size].tolist() for i in range(0, len(chunk), self.batch_size)]
+        order = self.rng.permutation(len(batches))
+        if self.world_size > 1:
+            order = np.resize(order, math.ceil(len(order) / self.world_size) * self.world_size)
+        for i in order[self.rank::self.world_size]:
+            yield batches[i]
+
+    def __len__(self):
+        n = len(self.lengths)
+        full, rest = divmod(n, self.pool)
+        n_batches = full * math.ceil(self.pool / self.batch_size) + math.ceil(rest / self.batch_size)
+        return math.ceil(n_batches / self.world_size)
 
 # ---------- Load sequences from Mongo ----------
-def load_sequences(db, skill2idx: Dict[str, int]) -> List[List[Tuple[int, int]]]:
-    """Return list of per-user sequences: [(skill_idx, is_correct), ...] time-ordered."""
-    pipeline = [
-        {"$lookup": { "from": "usersessions", "localField": "session_id", "foreignField": "user_session_id", "as": "us" }},
-        {"$unwind": "$us"},
+def user_ranges(db, n: int) -> List[Tuple[Any, Any]]:
+    """
+    Split the users of `usersessions` into about n contiguous user_id ranges [lo, hi)
+    with similar user counts (one $bucketAuto), in user_id order; None = open bound.
+    """
+    if n <= 1:
+        return [(None, None)]
+    buckets = list(db.usersessions.aggregate([
+        {"$match": {"user_id": {"$ne": None}}},
+        {"$group": {"_id": "$user_id"}},
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": n}},
+    ], allowDiskUse=True))
+    edges = [None] + [b["_id"]["min"] for b in buckets[1:]] + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+def iter_sequences(db, skill2idx: Dict[str, int], user_range: Tuple[Any, Any] = None):
+    """
+    Stream per-user sequences [(skill_idx, is_correct), ...] time-ordered, one user at a
+    time straight from the aggregation cursor (memory bounded by the longest user).
+    user_range: (lo, hi) from user_ranges -> only those users; the aggregation then starts
+    from their sessions, so the other users' responses are never read or joined.
+    """
+    tail = [
         {"$lookup": { "from": "questions", "localField": "question_id", "foreignField": "question_id", "as": "q" }},
         {"$unwind": "$q"},
         {"$project": {
-            "user_id": "$us.user_id",
+            "user_id": 1,
             "answered_at": 1,
             "is_correct": 1,
             "theme": "$q.theme",
@@ -95,10 +226,32 @@ def load_sequences(db, skill2idx: Dict[str, int]) -> List[List[Tuple[int, int]]]
         }},
         {"$sort": {"user_id": 1, "answered_at": 1}}
     ]
-    seqs = []
+    if user_range is None:
+        coll = db.responses
+        pipeline = [
+            {"$lookup": { "from": "usersessions", "localField": "session_id", "foreignField": "user_session_id", "as": "us" }},
+            {"$unwind": "$us"},
+            {"$set": {"user_id": "$us.user_id"}},
+        ] + tail
+    else:
+        lo, hi = user_range
+        users = {"$ne": None}
+        if lo is not None:
+            users["$gte"] = lo
+        if hi is not None:
+            users["$lt"] = hi
+        coll = db.usersessions
+        pipeline = [
+            {"$match": {"user_id": users, "user_session_id": {"$ne": None}}},
+            {"$project": {"user_id": 1, "user_session_id": 1}},
+            {"$lookup": { "from": "responses", "localField": "user_session_id", "foreignField": "session_id", "as": "r" }},
+            {"$unwind": "$r"},
+            {"$project": {"user_id": 1, "question_id": "$r.question_id", "answered_at": "$r.answered_at",
+                          "is_correct": "$r.is_correct"}},
+        ] + tail
     current_user = None
     buf = []
-    for r in db.responses.aggregate(pipeline):
+    for r in coll.aggregate(pipeline, allowDiskUse=True):
         uid = r["user_id"]
         key = f"{r['theme']}|||{r['difficulty']}"
         if key not in skill2idx:
@@ -110,67 +263,501 @@ def load_sequences(db, skill2idx: Dict[str, int]) -> List[List[Tuple[int, int]]]
             current_user = uid
         if uid != current_user:
             if len(buf) >= 2:
-                seqs.append(buf)
+                yield buf
             buf = []
             current_user = uid
         buf.append((sidx, c))
     if len(buf) >= 2:
-        seqs.append(buf)
+        yield buf
+
+def load_sequences(db, skill2idx: Dict[str, int]) -> List[np.ndarray]:
+    """
+    Return list of per-user sequences, arrays [n, 2] of (skill_idx, is_correct) time-ordered.
+    Same sequences as iter_sequences, extracted in parallel shards with client-side joins
+    (dkt_extract) instead of the $lookup/$sort aggregation.
+    """
+    stats = {}
+    seqs = list(extract_sequences(db, skill2idx, mongo_uri=MONGO_URI, stats=stats))
+    print(f"[DKT] extracted {stats['rows']} responses / {stats['users']} users in {stats['shards']} shards "
+          f"(lookups {stats['lookups_ms']} ms, scan {stats['scan_ms']} ms, sort {stats['sort_ms']} ms)")
     return seqs
 
+# ---------- Streaming dataset ----------
+class StreamingDKTDataset(IterableDataset):
+    """
+    Windows streamed from the sorted aggregation (iter_sequences): a user's windows are
+    emitted as soon as the cursor moves past that user, so memory stays bounded by the
+    shuffle buffer whatever the size of the response history.
+    - users are split into `shards` user_id ranges (user_ranges, planned in the main process
+      each epoch) dealt round-robin to the DataLoader workers; each worker opens its own
+      connection and runs one aggregation per range, restricted to that range in the query;
+    - a bounded shuffle buffer mixes windows across users (reseeded every epoch);
+    - every epoch re-runs the aggregation, or re-reads `snapshot_dir` when given
+      (memory-mapped DKTSnapshot: no Mongo at all).
+    """
+    def __init__(self, skill2idx: Dict[str, int], num_skills: int, max_len: int = 200,
+                 buffer_size: int = DKT_SHUFFLE_BUFFER, seed: int = 42,
+                 mongo_uri: str = MONGO_URI, db_name: str = DB_NAME, snapshot_dir: str = None,
+                 shards: int = 1):
+        self.skill2idx = skill2idx
+        self.num_skills = num_skills
+        self.max_len = max_len
+        self.buffer_size = max(1, buffer_size)
+        self.seed = seed
+        self.mongo_uri = mongo_uri
+        self.db_name = db_name
+        self.snapshot_dir = snapshot_dir
+        self.shards = max(1, shards)
+        self.epoch = 0
+        self.ranges = self._plan_ranges()
+
+    def set_epoch(self, epoch: int):
+        """Different shuffle per epoch (workers get a fresh copy of the dataset each epoch)."""
+        self.epoch = epoch
+        self.ranges = self._plan_ranges()
+
+    def _plan_ranges(self) -> List[Tuple[Any, Any]]:
+        """user_id ranges of the epoch, computed once so that every worker splits the same way."""
+        if self.snapshot_dir is not None or self.shards <= 1:
+            return [(None, None)]
+        client = MongoClient(self.mongo_uri)
+        try:
+            return user_ranges(client[self.db_name], self.shards)
+        finally:
+            client.close()
+
+    def windows(self, shard: int = 0, num_shards: int = 1):
+        """Unshuffled windows of the users of one shard, in cursor (or snapshot) order."""
+        if self.snapshot_dir is not None:
+            snap = DKTSnapshot(self.snapshot_dir).open()
+            for seq in snap.iter_sequences(self.skill2idx, shard, num_shards):
+                yield from iter_windows(encode_interactions(seq, self.num_skills), self.max_len)
+            return
+        client = MongoClient(self.mongo_uri)  # one per worker: clients do not survive a fork
+        try:
+            for rng in self.ranges[shard::num_shards]:
+                user_range = None if rng == (None, None) else rng
+                for seq in iter_sequences(client[self.db_name], self.skill2idx, user_range=user_range):
+                    yield from iter_windows(encode_interactions(seq, self.num_skills), self.max_len)
+        finally:
+            client.close()
+
+    def __iter__(self):
+        info = get_worker_info()
+        shard, num_shards = (info.id, info.num_workers) if info is not None else (0, 1)
+        rng = np.random.default_rng([self.seed, self.epoch, shard])
+        buf: List[np.ndarray] = []
+        for w in self.windows(shard, num_shards):
+            if len(buf) < self.buffer_size:
+                buf.append(w)
+                continue
+            i = int(rng.integers(len(buf)))
+            yield buf[i]
+            buf[i] = w
+        rng.shuffle(buf)
+        yield from buf
+
+# ---------- Save helpers ----------
+def _atomic_save(path: str, write):
+    """Write to a temp file then rename: the serving registry never reads a half-written file."""
+    tmp = f"{path}.tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+# ---------- Serving artifact ----------
+def export_serving_artifact(model: nn.Module, ds: Sequence[np.ndarray], mode: str = DKT_SERVING,
+                            path: str = SERVING_PATH, sample: int = DKT_PARITY_SAMPLE, seed: int = 42):
+    """
+    Export a TorchScript copy of the trained model for CPU serving, optionally with
+    dynamic int8 quantization of the LSTM and Linear layers. Parity against the eager
+    float32 model is measured on a sample of training windows (a DKTDataset or a plain
+    list of windows) and returned for the meta.
+    """
+    if mode not in ("int8", "fp32"):
+        return None
+    model.eval()
+    serving = model
+    if mode == "int8":
+        serving = torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    scripted = torch.jit.script(serving)
+    _atomic_save(path, lambda p: torch.jit.save(scripted, p))
+    scripted = torch.jit.load(path, map_location="cpu")  # check what will actually be served
+
+    rng = np.random.default_rng(seed)
+    idx = rng.choice(len(ds), size=min(sample, len(ds)), replace=False) if len(ds) else []
+    max_diff, sum_diff, n_pred = 0.0, 0.0, 0
+    with torch.no_grad():
+        for i in idx:
+            x = model_input(model, torch.from_numpy(ds[int(i)][None, :-1].astype(np.int64)))
+            d = (scripted(x) - model(x)).abs()
+            max_diff = max(max_diff, float(d.max()))
+            sum_diff += float(d.sum())
+            n_pred += d.numel()
+    return {
+        "file": os.path.basename(path),
+        "format": "torchscript",
+        "quantization": "dynamic_int8" if mode == "int8" else None,
+        "size_bytes": os.path.getsize(path),
+        "parity": {
+            "windows": len(idx),
+            "max_abs_diff": max_diff,
+            "mean_abs_diff": sum_diff / max(1, n_pred),
+        },
+    }
+
+# ---------- Publish ----------
+def publish_model(model: nn.Module, meta: Dict[str, object], windows: Sequence[np.ndarray]):
+    """
+    Publish a trained model to MODEL_DIR: checkpoint, serving artifact (parity measured on
+    `windows`), then the meta (which gets the "serving" entry) last.
+    """
+    model.eval()
+    _atomic_save(MODEL_PATH, lambda p: torch.save(model.state_dict(), p))
+    try:
+        serving = export_serving_artifact(model, windows)
+    except Exception as e:
+        # the eager checkpoint stays usable: serving falls back to it
+        print(f"[DKT] serving artifact export failed: {e}")
+        serving = {"error": str(e)}
+    meta = dict(meta, serving=serving)
+    # meta last: it is what marks a new model as complete for the registry
+    def _write_meta(p):
+        with open(p, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+    _atomic_save(META_PATH, _write_meta)
+    print(f"Saved model -> {MODEL_PATH}, meta -> {META_PATH}")
+
 # ---------- Train ----------
-def train(epochs=8, batch_size=64, hidden=128, dropout=0.1, max_len=200, lr=1e-3, seed=42):
+def _published_meta():
+    """Meta of the model currently in MODEL_DIR (None if there is no complete model)."""
+    if not (os.path.exists(META_PATH) and os.path.exists(MODEL_PATH)):
+        return None
+    with open(META_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class TrainingCancelled(Exception):
+    """Raised inside train() when `should_stop()` turns true; nothing is saved."""
+
+PROGRESS_EVERY_S = 1.0  # min interval between two intra-epoch progress reports
+
+class _TargetLogits(nn.Module):
+    """DKTEmbed.target_logits exposed as forward, so that DDP sees (and syncs) the training call."""
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, codes, next_skill, lengths=None):
+        return self.model.target_logits(codes, next_skill, lengths)
+
+def training_module(model: nn.Module) -> nn.Module:
+    """Module called by the training step: the model itself, or its target_logits (embed)."""
+    return _TargetLogits(model) if model.input_kind == "index" else model
+
+def batch_loss(net: nn.Module, batch, arch: str, num_skills: int, pack: bool = False):
+    """
+    Masked loss of one collated batch (collate_dkt_index for "embed", collate_dkt otherwise)
+    and its number of windows. net = training_module(model), possibly wrapped in DDP.
+    """
+    if arch == "embed":
+        # codes/next_skill/next_correct/mask: [B,T]; one logit per step instead of K
+        codes, next_skill, next_correct, mask, lengths = batch
+        m = mask.float()
+        logit = net(codes, next_skill, lengths if pack else None)
+        loss = nn.functional.binary_cross_entropy_with_logits(logit, next_correct, reduction="none")
+        return (loss * m).sum() / m.sum(), mask.shape[0]
+    # x:[B,T,2K], y:[B,T,K], mask:[B,T] (padded steps excluded from the loss)
+    x, y, mask, lengths = batch
+    m = mask.unsqueeze(-1).float()
+    loss = nn.functional.binary_cross_entropy(net(x, lengths if pack else None), y, reduction="none")
+    return (loss * m).sum() / (m.sum() * num_skills), mask.shape[0]
+
+def train(epochs=8, batch_size=64, hidden=128, dropout=0.1, max_len=200, lr=1e-3, seed=42,
+          progress=None, should_stop=None, arch=DKT_ARCH, embed_dim=DKT_EMBED_DIM, bucket=DKT_BUCKET,
+          pack=DKT_PACK, stream=DKT_STREAM, workers=DKT_LOADER_WORKERS, snapshot=DKT_SNAPSHOT,
+          incremental=False, replay_ratio=DKT_REPLAY_RATIO, world_size=DKT_WORLD_SIZE, publish=True):
+    """
+    Train DKT on all sequences and publish it to MODEL_DIR.
+    progress(info): optional callback (epoch, batch, loss, sequences/s...), called at
+    most every PROGRESS_EVERY_S and at each epoch end.
+    should_stop(): optional predicate polled between batches (cancellation).
+    arch: "onehot" = DKT, BCE over all K outputs (original objective);
+          "embed" = DKTEmbed, BCE on the logit of the skill answered at t+1 only.
+    bucket: length-bucketed batches (little padding); pack: run the LSTM on packed sequences.
+    stream: windows streamed from the aggregation (StreamingDKTDataset) with flat memory;
+          batches then follow the shuffle buffer (no bucketing) and their count is unknown.
+    workers: DataLoader worker processes (in streaming mode, each one reads a shard of users).
+    snapshot: bring the on-disk snapshot up to date (new responses only) and read the
+          sequences from it instead of running the full aggregation.
+    incremental: warm start from the published model (same arch/hidden, layers grown for
+          new skills, existing skill indices kept) and fine-tune on the users with responses
+          inserted after its data watermark (whatever their answered_at), plus replay_ratio x
+          as many other users drawn at random.
+          Always reads the snapshot, never streams; full training if no model exists yet.
+    world_size: > 1 = data-parallel training over that many local processes (see
+          train_distributed); each rank trains on its shard of the batches, gradients are
+          all-reduced (gloo) and rank 0 alone reports and saves. Reads the snapshot, never streams.
+          The effective batch is world_size x batch_size (fewer optimizer steps per epoch).
+    publish: False = train and measure only, MODEL_DIR untouched.
+    Padded steps are masked out of the loss either way, so results do not depend on them.
+    Returns a summary (final loss, sequences/s, training time), None if incremental found nothing new.
+    """
+    if world_size > 1 and not dist.is_initialized():
+        params = {k: v for k, v in locals().items() if k not in ("progress", "should_stop", "world_size")}
+        return train_distributed(world_size, progress=progress, should_stop=should_stop, **params)
+    distributed = dist.is_initialized()
+    rank, world = (dist.get_rank(), dist.get_world_size()) if distributed else (0, 1)
+    main = rank == 0
+    log = print if main else (lambda *a, **k: None)
+
+    def _report(**info):
+        if progress is not None and main:
+            progress(info)
+
+    def _check_stop():
+        stop = should_stop is not None and should_stop()
+        if distributed:
+            # same decision on every rank, otherwise the others would wait in all_reduce
+            flag = torch.tensor([1.0 if stop else 0.0])
+            dist.all_reduce(flag)
+            stop = flag.item() > 0
+        if stop:
+            raise TrainingCancelled()
+
     np.random.seed(seed)
     torch.manual_seed(seed)
 
     client = MongoClient(MONGO_URI)
     db = client[DB_NAME]
 
-    skill2idx = build_skill_mapping(db)
+    base_meta = _published_meta() if incremental else None
+    if incremental and base_meta is None:
+        log("[DKT] incremental: no published model, full training")
+    if base_meta is not None:
+        # warm start keeps the architecture of the published model
+        arch = base_meta.get("arch") or "onehot"
+        hidden = int(base_meta.get("hidden_size", hidden))
+        embed_dim = int(base_meta.get("embed_dim") or embed_dim)
+        skill2idx = build_skill_mapping(db, base=base_meta["skill2idx"])
+    else:
+        skill2idx = build_skill_mapping(db)
     idx2skill = {v: k for k, v in skill2idx.items()}
     K = len(skill2idx)
     if K == 0:
         raise RuntimeError("No skills found. Ensure 'questions' collection has theme & difficulty populated.")
 
-    seqs = load_sequences(db, skill2idx)
-    if len(seqs) == 0:
-        raise RuntimeError("No sequences found. You need responses to train DKT.")
+    collate = partial(collate_dkt_index if arch == "embed" else collate_dkt, num_skills=K)
+    stream = stream and base_meta is None and not distributed
+    snap, users, warm_start = None, None, None
+    data_until = dt.datetime.utcnow().isoformat()
+    if snapshot or base_meta is not None or distributed:
+        _report(stage="snapshot")
+        if main:
+            snap = refreshed_snapshot(db)
+        if distributed:
+            dist.barrier()  # rank 0 refreshes, the others map the result
+            snap = snap or DKTSnapshot().open()
+        data_until = snap.manifest.get("watermark") or data_until
+        _check_stop()
+    if base_meta is not None:
+        since = dt.datetime.fromisoformat(base_meta.get("data_until") or base_meta["trained_at"])
+        fresh = snap.users_since(since)
+        if len(fresh) == 0:
+            log(f"[DKT] incremental: no response inserted since {since.isoformat()}, model unchanged")
+            return
+        others = np.setdiff1d(np.arange(len(snap)), fresh)
+        n_replay = min(len(others), int(round(replay_ratio * len(fresh))))
+        replay = np.random.default_rng(seed).choice(others, size=n_replay, replace=False)
+        users = np.sort(np.concatenate([fresh, replay]))
+        warm_start = {
+            "from_trained_at": base_meta.get("trained_at"),
+            "since": since.isoformat(),
+            "fresh_users": int(len(fresh)),
+            "replay_users": int(n_replay),
+            "new_skills": K - int(base_meta["num_skills"]),
+        }
+        log(f"[DKT] incremental: {len(fresh)} users with new responses + {n_replay} replay users, "
+              f"{warm_start['new_skills']} new skills")
+    if stream:
+        ds = StreamingDKTDataset(skill2idx, K, max_len=max_len, seed=seed,
+                                 snapshot_dir=snap.path if snap is not None else None,
+                                 shards=(DKT_STREAM_SHARDS or 4 * workers) if workers > 1 else 1)
+        dl = DataLoader(ds, batch_size=batch_size, collate_fn=collate, num_workers=workers)
+        total_batches = None
+    else:
+        _report(stage="loading")
+        seqs = snap.iter_sequences(skill2idx, users=users) if snap is not None else load_sequences(db, skill2idx)
+        _check_stop()
 
-    ds = DKTDataset(seqs, num_skills=K, max_len=max_len)
-    dl = DataLoader(ds, batch_size=batch_size, shuffle=True)
+        ds = DKTDataset(seqs, num_skills=K, max_len=max_len)
+        del seqs
+        if len(ds) == 0:
+            raise RuntimeError("No sequences found. You need responses to train DKT.")
+        if bucket:
+            sampler = BucketBatchSampler([len(w) for w in ds.data], batch_size, seed=seed, rank=rank, world_size=world)
+            dl = DataLoader(ds, batch_sampler=sampler, collate_fn=collate, num_workers=workers)
+        elif distributed:
+            sampler = DistributedSampler(ds, num_replicas=world, rank=rank, shuffle=True, seed=seed)
+            dl = DataLoader(ds, batch_size=batch_size, sampler=sampler, collate_fn=collate, num_workers=workers)
+        else:
+            dl = DataLoader(ds, batch_size=batch_size, shuffle=True, collate_fn=collate, num_workers=workers)
+        total_batches = len(dl)
 
-    model = DKT(num_skills=K, hidden_size=hidden, dropout=dropout)
+    if base_meta is not None:
+        model = build_dkt(int(base_meta["num_skills"]), arch=arch, hidden_size=hidden, embed_dim=embed_dim,
+                          dropout=dropout)
+        model.load_state_dict(torch.load(MODEL_PATH, map_location="cpu"))
+        if K > model.num_skills:
+            model = grow_skills(model, K)
+    else:
+        model = build_dkt(K, arch=arch, hidden_size=hidden, embed_dim=embed_dim, dropout=dropout)
     optim = torch.optim.Adam(model.parameters(), lr=lr)
-    bce = nn.BCELoss()
+    net = training_module(model)
+    if distributed:
+        net = DistributedDataParallel(net)  # broadcasts rank 0 weights, all-reduces gradients
 
     model.train()
+    t_train = time.perf_counter()
+    ep_loss, n_seqs = None, 0  # epochs=0: nothing trained, the summary still builds
     for ep in range(1, epochs+1):
         total_loss = 0.0
         n_batches = 0
-        for x, y in dl:
-            # x:[B,T,2K], y:[B,T,K]
+        n_seqs = 0
+        t_ep = last_report = time.perf_counter()
+        if stream:
+            ds.set_epoch(ep)
+        if isinstance(getattr(dl, "sampler", None), DistributedSampler):
+            dl.sampler.set_epoch(ep)
+        for batch in dl:
+            _check_stop()
             optim.zero_grad()
-            yhat = model(x)
-            loss = bce(yhat, y)
+            loss, n_windows = batch_loss(net, batch, arch, K, pack)
             loss.backward()
             optim.step()
             total_loss += float(loss.detach().cpu().item())
             n_batches += 1
-        print(f"[DKT] epoch {ep}/{epochs} | loss={total_loss/max(1,n_batches):.4f}")
+            n_seqs += n_windows
+            now = time.perf_counter()
+            if now - last_report >= PROGRESS_EVERY_S:
+                last_report = now
+                # rank 0 view, scaled to all ranks (same number of steps everywhere)
+                _report(stage="training", epoch=ep, epochs=epochs, batch=n_batches, batches=total_batches,
+                        loss=total_loss / n_batches, sequences_per_s=world * n_seqs / max(1e-9, now - t_ep))
+        if distributed:
+            totals = torch.tensor([total_loss, n_batches, n_seqs], dtype=torch.float64)
+            dist.all_reduce(totals)
+            total_loss, n_batches, n_seqs = float(totals[0]), int(totals[1]), int(totals[2])
+        if n_batches == 0:
+            raise RuntimeError("No sequences found. You need responses to train DKT.")
+        ep_loss = total_loss / max(1, n_batches)
+        log(f"[DKT] epoch {ep}/{epochs} | loss={ep_loss:.4f}")
+        _report(stage="training", epoch=ep, epochs=epochs, batch=n_batches // world, batches=total_batches,
+                loss=ep_loss, sequences_per_s=n_seqs / max(1e-9, time.perf_counter() - t_ep), epoch_done=True)
+    train_s = time.perf_counter() - t_train
+    _check_stop()
+    summary = {
+        "epochs": epochs,
+        "world_size": world,
+        "loss": ep_loss,
+        "train_s": round(train_s, 3),
+        "sequences_per_s": round(epochs * n_seqs / max(1e-9, train_s), 1),
+    }
+    if not (main and publish):
+        return summary
+    _report(stage="saving")
 
-    # save
-    torch.save(model.state_dict(), MODEL_PATH)
     meta = {
         "num_skills": K,
+        "hidden_size": hidden,
+        "arch": arch,
+        "embed_dim": embed_dim if arch == "embed" else None,
         "skill2idx": skill2idx,
         "idx2skill": idx2skill,
-        "trained_at": dt.datetime.utcnow().isoformat()
+        "trained_at": dt.datetime.utcnow().isoformat(),
+        "data_until": data_until,  # responses answered up to here are in the model
+        "warm_start": warm_start,
     }
-    with open(META_PATH, "w", encoding="utf-8") as f:
-        json.dump(meta, f)
-    print(f"Saved model -> {MODEL_PATH}, meta -> {META_PATH}")
+    # streaming: parity on the first shuffled windows (one buffer fill, nothing kept from training)
+    publish_model(model, meta, list(islice(iter(ds), DKT_PARITY_SAMPLE)) if stream else ds)
+    return summary
+
+# ---------- Data-parallel training ----------
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _ddp_worker(rank: int, world_size: int, port: int, threads: int, params: dict, events, stop):
+    """One rank of train_distributed (spawned process)."""
+    torch.set_num_threads(threads)
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+    try:
+        progress = (lambda info: events.put(("progress", info))) if rank == 0 else None
+        summary = train(**params, progress=progress, should_stop=stop.is_set)
+        if rank == 0:
+            events.put(("done", summary))
+    except TrainingCancelled:
+        if rank == 0:
+            events.put(("cancelled", None))
+    finally:
+        dist.destroy_process_group()
+
+def train_distributed(world_size: int, progress=None, should_stop=None, threads_per_worker: int = None, **params):
+    """
+    Launch `world_size` local training processes (torch.distributed, gloo backend, CPU)
+    and wait for them. The CPU threads of this process are split between the ranks;
+    progress and cancellation are relayed from/to the ranks. Same summary as train().
+    """
+    threads = threads_per_worker or max(1, torch.get_num_threads() // world_size)
+    ctx = torch_mp.get_context("spawn")
+    events, stop = ctx.Queue(), ctx.Event()
+    procs = torch_mp.start_processes(_ddp_worker, args=(world_size, _free_port(), threads, params, events, stop),
+                                     nprocs=world_size, join=False, start_method="spawn")
+    outcome = {}
+
+    def _drain():
+        while True:
+            try:
+                kind, payload = events.get_nowait()
+            except queue.Empty:
+                return
+            if kind == "progress":
+                if progress is not None:
+                    progress(payload)
+            else:
+                outcome[kind] = payload
+
+    while not procs.join(timeout=0.5):
+        _drain()
+        if should_stop is not None and should_stop():
+            stop.set()
+    _drain()
+    if "cancelled" in outcome:
+        raise TrainingCancelled()
+    return outcome.get("done")
+
+def scaling_report(worker_counts: List[int], epochs: int = 1, **params) -> Dict[str, object]:
+    """
+    Data-parallel scaling: the same training (nothing published) for each worker count.
+    efficiency = speedup over the smallest count / ratio of worker counts (1.0 = linear).
+    """
+    counts = sorted(set(int(n) for n in worker_counts))
+    runs = []
+    for n in counts:
+        summary = train(epochs=epochs, world_size=n, publish=False, **params)
+        runs.append({"workers": n, "train_s": summary["train_s"], "sequences_per_s": summary["sequences_per_s"],
+                     "loss": summary["loss"]})
+    base = runs[0]
+    for r in runs:
+        speedup = r["sequences_per_s"] / max(1e-9, base["sequences_per_s"])
+        r["speedup"] = round(speedup, 2)
+        r["efficiency"] = round(speedup * base["workers"] / r["workers"], 2)
+    return {"cpu_count": os.cpu_count(), "torch_threads": torch.get_num_threads(), "runs": runs}
 
 if __name__ == "__main__":
     # simple CLI via envs (optional)
     EPOCHS = int(os.getenv("DKT_EPOCHS", "8"))
-    train(epochs=EPOCHS)
+    SCALING = os.getenv("DKT_SCALING")  # e.g. "1,2,4,8": scaling report, no model published
+    if SCALING:
+        print(json.dumps(scaling_report([int(n) for n in SCALING.split(",")], epochs=EPOCHS), indent=2))
+    else:
+        train(epochs=EPOCHS, incremental=os.getenv("DKT_INCREMENTAL", "0") == "1")
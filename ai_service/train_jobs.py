@@ -0,0 +1,171 @@
+import os
+import uuid
+import queue
+import atexit
+import threading
+import datetime as dt
+import multiprocessing as mp
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+# ----------------------- Config -----------------------
+DKT_TRAIN_THREADS = int(os.getenv("DKT_TRAIN_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))  # threads torch du job
+DKT_TRAIN_NICE = int(os.getenv("DKT_TRAIN_NICE", "10"))        # priorité CPU abaissée : le service reste prioritaire
+TRAIN_JOBS_KEEP = int(os.getenv("TRAIN_JOBS_KEEP", "20"))      # nb de jobs terminés gardés pour consultation
+CANCEL_GRACE_S = float(os.getenv("TRAIN_CANCEL_GRACE_S", "30"))  # au-delà : le process est tué
+
+class JobAlreadyRunning(Exception):
+    def __init__(self, job_id: str):
+        super().__init__(f"training job {job_id} already running")
+        self.job_id = job_id
+
+
+def _train_worker(params: Dict[str, Any], events, stop):
+    """Point d'entrée du process d'entraînement (spawn) : relaie la progression au parent."""
+    try:
+        os.nice(DKT_TRAIN_NICE)
+    except (AttributeError, OSError):
+        pass
+    import torch
+    torch.set_num_threads(DKT_TRAIN_THREADS)
+    from train_dkt import train, TrainingCancelled
+
+    try:
+        train(**params, progress=lambda info: events.put(("progress", info)), should_stop=stop.is_set)
+        events.put(("succeeded", None))
+    except TrainingCancelled:
+        events.put(("cancelled", None))
+    except Exception as e:
+        events.put(("failed", str(e)))
+
+
+class TrainJobManager:
+    """
+    Entraînements DKT dans un process séparé (spawn) : la requête HTTP rend un job_id
+    immédiatement, la progression (epoch, loss, séquences/s) est relayée par une queue
+    et suivie par un thread du process Flask. Un seul job actif à la fois ; annulation
+    coopérative (vérifiée entre deux batchs), puis kill après CANCEL_GRACE_S.
+    """
+
+    def __init__(self, on_success: Callable[[], Any] = None, keep: int = TRAIN_JOBS_KEEP):
+        self.on_success = on_success
+        self.keep = max(1, int(keep))
+        self._ctx = mp.get_context("spawn")  # pas de fork d'un process avec threads/MongoClient
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._procs: Dict[str, Any] = {}
+        self._stops: Dict[str, Any] = {}
+        self._active: Optional[str] = None
+        self._lock = threading.Lock()
+        atexit.register(self._shutdown)
+
+    # ---------------- API ----------------
+    def submit(self, **params) -> Dict[str, Any]:
+        with self._lock:
+            if self._active is not None:
+                raise JobAlreadyRunning(self._active)
+            job_id = uuid.uuid4().hex[:12]
+            job = {
+                "job_id": job_id,
+                "status": "running",
+                "params": params,
+                "stage": "starting",
+                "epoch": 0,
+                "epochs": params.get("epochs"),
+                "batch": 0,
+                "batches": None,
+                "loss": None,
+                "sequences_per_s": None,
+                "history": [],  # loss par epoch
+                "error": None,
+                "created_at": dt.datetime.utcnow().isoformat(),
+                "finished_at": None,
+                "pid": None,
+            }
+            events, stop = self._ctx.Queue(), self._ctx.Event()
+            # non démon : un entraînement data-parallel (world_size > 1) lance ses propres process ;
+            # l'arrêt du service est géré par _shutdown
+            proc = self._ctx.Process(target=_train_worker, args=(params, events, stop),
+                                     name=f"dkt-train-{job_id}", daemon=False)
+            proc.start()
+            job["pid"] = proc.pid
+            self._jobs[job_id] = job
+            self._procs[job_id] = proc
+            self._stops[job_id] = stop
+            self._active = job_id
+            self._trim()
+        threading.Thread(target=self._monitor, args=(job_id, proc, events), name=f"dkt-train-monitor-{job_id}",
+                         daemon=True).start()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job, history=list(job["history"])) if job else None
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job["status"] == "running":
+                job["status"] = "cancelling"
+                self._stops[job_id].set()
+                timer = threading.Timer(CANCEL_GRACE_S, self._kill, args=(job_id,))
+                timer.daemon = True
+                timer.start()
+        return self.get(job_id)
+
+    def active(self) -> Optional[str]:
+        return self._active
+
+    # ---------------- suivi ----------------
+    def _monitor(self, job_id: str, proc, events):
+        outcome, error = None, None
+        while outcome is None:
+            try:
+                kind, payload = events.get(timeout=1.0)
+            except queue.Empty:
+                if not proc.is_alive():
+                    outcome, error = "failed", f"training process exited (code {proc.exitcode})"
+                continue
+            if kind == "progress":
+                with self._lock:
+                    job = self._jobs[job_id]
+                    job.update({k: v for k, v in payload.items() if k in job})
+                    if payload.get("epoch_done"):
+                        job["history"].append({"epoch": payload["epoch"], "loss": payload.get("loss")})
+            else:
+                outcome, error = kind, payload
+        proc.join(timeout=10)
+
+        with self._lock:
+            job = self._jobs[job_id]
+            if job["status"] == "cancelling" and outcome == "failed":
+                outcome, error = "cancelled", None  # tué après le délai de grâce
+            job.update(status=outcome, error=error, finished_at=dt.datetime.utcnow().isoformat())
+            self._procs.pop(job_id, None)
+            self._stops.pop(job_id, None)
+            if self._active == job_id:
+                self._active = None
+        if outcome == "succeeded" and self.on_success is not None:
+            try:
+                self.on_success()
+            except Exception:
+                pass
+
+    def _kill(self, job_id: str):
+        proc = self._procs.get(job_id)
+        if proc is not None and proc.is_alive():
+            proc.terminate()
+
+    def _shutdown(self):
+        """À la sortie du service : termine le job en cours au lieu de l'attendre."""
+        for proc in list(self._procs.values()):
+            if proc.is_alive():
+                proc.terminate()
+
+    def _trim(self):
+        """Oublie les plus vieux jobs terminés au-delà de `keep`."""
+        done = [j for j, job in self._jobs.items() if job["status"] not in ("running", "cancelling")]
+        for j in done[:max(0, len(self._jobs) - self.keep)]:
+            del self._jobs[j]